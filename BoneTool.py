@@ -696,29 +696,237 @@ def create_bones_from_curve(curveObj,
 
     return arma, created_bones
 
+################################################################
+@dataclass
+class ArmatureTopology:
+    """
+    アーマチュアの骨の階層構造。骨のインデックスは arma.data.bones の順
+    """
+    names : list               # インデックス -> 骨の名前
+    name_to_index : dict       # 骨の名前 -> インデックス
+    parents : np.ndarray       # 親のインデックス。ルートは -1
+    connected : np.ndarray     # use_connect
+    deform : np.ndarray        # use_deform
+    depths : np.ndarray        # ルートを 0 とした深さ
+    tree_ids : np.ndarray      # 属するツリーの番号 (roots のインデックス)
+    roots : np.ndarray         # ツリーごとのルートのインデックス
+    level_order : np.ndarray   # ツリーごとに、深さ→インデックスの順に並べた骨
+    levels : list              # 深さごとの骨のインデックスの配列
+    preorder : np.ndarray      # 深さ優先の行きがけ順
+    postorder : np.ndarray     # 深さ優先の帰りがけ順
+    subtree_start : np.ndarray # preorder 中の位置
+    subtree_end : np.ndarray   # preorder 中の子孫の終わりの位置 (含まない)
+    flip_indices : np.ndarray  # 名前の左右を反転した骨のインデックス
+    matrix_local : np.ndarray  # (N, 4, 4) のレストポーズの行列
+    rest_offsets : np.ndarray  # (N, 4, 4) の親のレストポーズから見た行列
+    simple_inherit : np.ndarray # 親の変形を既定の方法で継承するか
+
+    def __len__(self):
+        return len(self.names)
+
+    def indices(self, names):
+        return np.array([self.name_to_index[name] for name in names], dtype=np.int64)
+
+    def descendants(self, index):
+        """index の子孫 (自身を含まない) のインデックス"""
+        return self.preorder[self.subtree_start[index] + 1:self.subtree_end[index]]
+
+    def propagate_down(self, values, func):
+        """
+        親から子の順に、values[i] = func(values[i], values[parents[i]]) を
+        深さごとにまとめて計算する
+        """
+        for level in self.levels[1:]:
+            values[level] = func(values[level], values[self.parents[level]])
+        return values
+
+################
+def build_armature_topology(arma):
+    bones = arma.data.bones
+    count = len(bones)
+    names = [bone.name for bone in bones]
+    name_to_index = {name: idx for idx, name in enumerate(names)}
+    parents = np.array([name_to_index[bone.parent.name] if bone.parent else -1
+                        for bone in bones], dtype=np.int64)
+    connected = np.zeros(count, dtype=bool)
+    bones.foreach_get('use_connect', connected)
+    deform = np.zeros(count, dtype=bool)
+    bones.foreach_get('use_deform', deform)
+
+    # 子のリスト (骨の順)
+    children = [[] for _ in range(count)]
+    for idx, parent in enumerate(parents.tolist()):
+        if parent >= 0:
+            children[parent].append(idx)
+    roots = np.flatnonzero(parents < 0)
+
+    # 深さ優先探索
+    depths = np.zeros(count, dtype=np.int64)
+    tree_ids = np.zeros(count, dtype=np.int64)
+    preorder = []
+    postorder = []
+    subtree_end = np.zeros(count, dtype=np.int64)
+    for tree, root in enumerate(roots.tolist()):
+        stack = [(root, False)]
+        while stack:
+            idx, done = stack.pop()
+            if done:
+                postorder.append(idx)
+                subtree_end[idx] = len(preorder)
+                continue
+            preorder.append(idx)
+            tree_ids[idx] = tree
+            stack.append((idx, True))
+            for child in reversed(children[idx]):
+                depths[child] = depths[idx] + 1
+                stack.append((child, False))
+    preorder = np.array(preorder, dtype=np.int64)
+    subtree_start = np.empty(count, dtype=np.int64)
+    subtree_start[preorder] = np.arange(count)
+
+    # Bone.children_recursive と同じく、ツリーごとに近い順に並べる
+    level_order = np.lexsort((np.arange(count), depths, tree_ids))
+    max_depth = int(depths.max()) if count else -1
+    levels = [np.flatnonzero(depths == depth) for depth in range(max_depth + 1)]
+
+    name_set = set(names)
+    flip_indices = np.array([name_to_index[iu.find_flip_side_name_or_self(name_set, name)]
+                             for name in names], dtype=np.int64)
+
+    # 親のレストポーズから見た行列
+    matrix_local = get_bone_matrices(bones, 'matrix_local')
+    rest_offsets = matrix_local.copy()
+    has_parent = parents >= 0
+    rest_offsets[has_parent] = np.linalg.inv(matrix_local[parents[has_parent]]) @ matrix_local[has_parent]
+
+    # pose.matrix = parent.matrix @ rest_offset @ matrix_basis となるか
+    simple_inherit = np.array([bone.use_inherit_rotation and
+                               bone.use_local_location and
+                               bone.inherit_scale == 'FULL'
+                               for bone in bones], dtype=bool)
+
+    return ArmatureTopology(names=names,
+                            name_to_index=name_to_index,
+                            parents=parents,
+                            connected=connected,
+                            deform=deform,
+                            depths=depths,
+                            tree_ids=tree_ids,
+                            roots=roots,
+                            level_order=level_order,
+                            levels=levels,
+                            preorder=preorder,
+                            postorder=np.array(postorder, dtype=np.int64),
+                            subtree_start=subtree_start,
+                            subtree_end=subtree_end,
+                            flip_indices=flip_indices,
+                            matrix_local=matrix_local,
+                            rest_offsets=rest_offsets,
+                            simple_inherit=simple_inherit)
+
+################
+# アーマチュアデータの session_uid -> ArmatureTopology
+_topology_cache = dict()
+
+################
+def get_armature_topology(arma):
+    """
+    アーマチュアの骨の階層構造を得る。
+    骨が編集されるまでキャッシュされる (clear_armature_topology() を参照)。
+    エディットモード中は EditBone の変更が反映されていないのでキャッシュしない
+
+    Parameters:
+    -----------
+    arma : bpy.types.Object
+      アーマチュアオブジェクト
+
+    Returns:
+    --------
+    ArmatureTopology
+    """
+    if arma.mode == 'EDIT':
+        return build_armature_topology(arma)
+
+    key = arma.data.session_uid
+    topology = _topology_cache.get(key)
+    if topology is None or len(topology) != len(arma.data.bones):
+        topology = build_armature_topology(arma)
+        _topology_cache[key] = topology
+    return topology
+
+################
+def clear_armature_topology(armature=None):
+    """
+    キャッシュした骨の階層構造を破棄する
+
+    Parameters:
+    -----------
+    armature : bpy.types.Armature
+      破棄するアーマチュアデータ。None なら全て
+    """
+    if armature is None:
+        _topology_cache.clear()
+    else:
+        _topology_cache.pop(armature.session_uid, None)
+
+################
+def compute_hierarchy_distances(arma, locations, selection):
+    """
+    骨の階層をたどった、選択した骨までの最短距離を得る。
+    親子の間の距離は骨の根元の間の距離とする (接続された骨では親の骨の長さ)。
+    子から親、親から子の順に深さごとにまとめて一度ずつ更新するので O(N) で済む
+
+    Parameters:
+    -----------
+    arma : bpy.types.Object
+      アーマチュアオブジェクト
+    locations : np.ndarray
+      (N, 3) の骨の根元の座標
+    selection : np.ndarray
+      選択した骨を示す bool の配列
+
+    Returns:
+    --------
+    np.ndarray
+      骨ごとの距離。選択した骨とつながっていなければ inf
+    """
+    topology = get_armature_topology(arma)
+    parents = topology.parents
+    has_parent = parents >= 0
+    lengths = np.zeros(len(topology))
+    lengths[has_parent] = np.linalg.norm(
+        locations[has_parent] - locations[parents[has_parent]], axis=1)
+
+    distances = np.where(selection, 0.0, np.inf)
+
+    # 子孫の中で最も近い選択した骨までの距離
+    for level in reversed(topology.levels[1:]):
+        np.minimum.at(distances, parents[level], distances[level] + lengths[level])
+
+    # 親を経由する経路と比べる
+    for level in topology.levels[1:]:
+        distances[level] = np.minimum(distances[level],
+                                      distances[parents[level]] + lengths[level])
+    return distances
+
 ################
 # ボーンのツリーごとの、ルートを 0 としたインデックスを取得する
 # インデックスは親より子が必ず大きいことが保証されている
 def getBoneIndexDictionary(arma):
-    result = dict()
-    for bone in arma.data.bones:
-        if not bone.parent:
-            result[bone.name] = 0
-            for idx, child in enumerate(bone.children_recursive):
-                result[child.name] = idx + 1
-    return result
+    topology = get_armature_topology(arma)
+    order = topology.level_order
+    positions = np.empty(len(order), dtype=np.int64)
+    positions[order] = np.arange(len(order))
+    ranks = positions - positions[topology.roots[topology.tree_ids]]
+    return dict(zip(topology.names, ranks.tolist()))
 
 ################
 def get_sorted_bone_names(arma):
     """
     親から子の順にソートしたボーン名の配列を得る
     """
-    sorted_list = []
-    for bone in arma.data.bones:
-        if not bone.parent:
-            sorted_list.append(bone.name)
-            sorted_list.extend([b.name for b in bone.children_recursive])
-    return sorted_list
+    topology = get_armature_topology(arma)
+    return [topology.names[idx] for idx in topology.level_order.tolist()]
 
 ################
 def createMeshFromSelectedBones(armaObj):
@@ -824,22 +1032,27 @@ def select_bones(arma, selectBoneNames):
 ################
 # boneNames の中で、最も先祖に近い骨達だけを得る
 def get_ancestral_bones(arma, boneNames):
-    bones_left = set(boneNames)
-    result = set(boneNames)
+    topology = get_armature_topology(arma.obj)
 
-    while bones_left:
-        boneName = bones_left.pop()
-        bone = arma.obj.data.bones.get(boneName)
-        if not bone:
+    indices = []
+    for boneName in set(boneNames):
+        idx = topology.name_to_index.get(boneName)
+        if idx is None:
             print(f'Cannot find {boneName} in {arma}')
-            print([b.name for b in arma.obj.data.bones])
-            result.discard(boneName)
+            print(topology.names)
         else:
-            children = set([b.name for b in bone.children_recursive])
-            result -= children
-            bones_left -= children
+            indices.append(idx)
+    indices = np.array(indices, dtype=np.int64)
 
-    return result
+    # 指定した骨の子孫の範囲を preorder 上で塗りつぶす
+    count = len(topology)
+    diff = np.zeros(count + 1, dtype=np.int64)
+    np.add.at(diff, topology.subtree_start[indices] + 1, 1)
+    np.add.at(diff, topology.subtree_end[indices], -1)
+    covered = np.empty(count, dtype=bool)
+    covered[topology.preorder] = np.cumsum(diff[:-1]) > 0
+
+    return {topology.names[idx] for idx in indices[~covered[indices]].tolist()}
 
 ################
 @dataclass
@@ -887,19 +1100,19 @@ def getSkinMesh(mesh,
     origs = np.dot(
         np.stack((xx * params.radius, yy, zz * params.radius, ones), axis=-1),
         mtxB2M.T)[:, :, :3]
-    cylindricalRays = np.stack((origs, dirs), axis=-2)
-    #print(cylindricalRays)
-
-    # レイを飛ばし、当たった点と軸との距離を配列として作成する
-    # 0 で初期化しておく
-    dists_mesh = np.zeros((cylindricalRays.shape[0], cylindricalRays.shape[1]))
-    for i, rays in enumerate(cylindricalRays):
-        for j, (orig, dir) in enumerate(rays):
-            rad = np.linalg.norm(dir)
-            hit, location, normal, index = mesh.ray_cast(orig, dir, distance=rad)
-            if hit:
-                #print(hit, location, normal, index)
-                dists_mesh[i,j] = 1 - np.dot(np.array(location) - orig, dir) / (rad * rad)
+    # レイをまとめて飛ばし、当たった点と軸との距離を配列として作成する
+    # 当たらなかった点は 0 とする
+    rads = np.linalg.norm(dirs, axis=-1)
+    caster = mu.get_mesh_ray_caster(mesh)
+    hits, locations, _, _, _ = caster.ray_cast(origs.reshape(-1, 3),
+                                               dirs.reshape(-1, 3),
+                                               distances=rads.ravel())
+    hits = hits.reshape(T.shape)
+    locations = locations.reshape(origs.shape)
+    dists_mesh = np.where(
+        hits,
+        1 - np.sum((locations - origs) * dirs, axis=-1) / (rads * rads),
+        0)
 
     # 平滑化
     if params.window_size > 1:
@@ -919,37 +1132,28 @@ def getSkinMesh(mesh,
 # 骨を、接続ごとに分離した構造を返す
 # use_connect が False ならば、親はないと見なす
 def getBranches(arma):
-    branches = []
-    bones = set(arma.pose.bones)
-
-    # ボーン名 -> 親 の辞書と、親のセットを作成する
-    bone_to_parent = dict()
-    parents = set()
-    for bone in bones:
-        if bone.parent and bone.bone.use_connect:
-            parent = bone.parent
-            bone_to_parent[bone.name] = parent
-            parents.add(parent.name)
-
-    # 子のないボーンのリストを作成し、それぞれの枝を検索する
-    leaf_bones = [bone for bone in bones if bone.name not in parents]
-    for bone in leaf_bones:
-        branch = []
+    topology = get_armature_topology(arma)
+    pose_bones = arma.pose.bones
+    count = len(topology)
 
-        # 親へ遡りながら枝を保存していく
-        while bones:
-            bones.remove(bone)
-            branch.append(bone)
+    # 接続された最初の子を枝の続きとする
+    linked = np.flatnonzero(topology.connected & (topology.parents >= 0))
+    next_bone = np.full(count, -1, dtype=np.int64)
+    next_bone[topology.parents[linked[::-1]]] = linked[::-1]
 
-            parent = bone_to_parent.get(bone.name)
-            if parent and parent in bones:
-                bone = parent
-            else:
-                break
-                
-        branches.append(reversed(branch))
+    # 親の枝の続きでない骨から、枝が始まる
+    is_head = np.ones(count, dtype=bool)
+    is_head[next_bone[next_bone >= 0]] = False
 
-    assert not bones
+    branches = []
+    next_bone = next_bone.tolist()
+    for idx in np.flatnonzero(is_head).tolist():
+        branch = []
+        while idx >= 0:
+            branch.append(pose_bones[idx])
+            idx = next_bone[idx]
+        # 枝は根元から先端の順
+        branches.append(branch)
 
     return branches
 
@@ -1250,6 +1454,41 @@ def is_bone_visible(bone):
 def is_bone_selected(bone):
     return bone.select and is_bone_visible(bone)
 
+################
+def get_bone_visibility(arma):
+    """
+    is_bone_visible() と bone.select を全ての骨についてまとめて得る
+
+    Parameters:
+    -----------
+    arma : bpy.types.Object
+      アーマチュアオブジェクト
+
+    Returns:
+    --------
+    (np.ndarray, np.ndarray)
+      見えているか、選択されているかの bool の配列。arma.data.bones の順
+    """
+    bones = arma.data.bones
+    count = len(bones)
+    hide = np.zeros(count, dtype=bool)
+    bones.foreach_get('hide', hide)
+    hide_select = np.zeros(count, dtype=bool)
+    bones.foreach_get('hide_select', hide_select)
+    select = np.zeros(count, dtype=bool)
+    bones.foreach_get('select', select)
+
+    # 見えているボーンコレクションに属しているか
+    name_to_index = get_armature_topology(arma).name_to_index
+    in_visible_collection = np.zeros(count, dtype=bool)
+    for bcoll in arma.data.collections_all:
+        if bcoll.is_visible:
+            indices = [name_to_index[bone.name] for bone in bcoll.bones]
+            in_visible_collection[indices] = True
+
+    visible = in_visible_collection & ~hide & ~hide_select
+    return visible, select
+
 ################
 def find_flip_side_bone_name(arma, bone_name):
     names = [b.name for b in arma.data.bones]
@@ -1273,11 +1512,7 @@ def get_flip_side_indices(arma):
     list
       Indices of flipped left and right bone.
     """
-    names = [b.name for b in arma.data.bones]
-    flipped_names = [iu.find_flip_side_name_or_self(names, n) for n in names]
-    name_to_index = dict(zip(names, range(len(names))))
-    flipped_indices = [name_to_index[n] for n in flipped_names]
-    return flipped_indices
+    return get_armature_topology(arma).flip_indices.tolist()
 
 ################
 def find_mirror_bone(armature, bone_name, epsilon=1e-10):
@@ -1300,16 +1535,19 @@ def find_mirror_bone(armature, bone_name, epsilon=1e-10):
     string
       Mirror bone name.
     """
-    bone = armature.data.bones[bone_name]
-
-    mirror_head = Vector((-bone.head_local.x, bone.head_local.y, bone.head_local.z))
-    mirror_tail = Vector((-bone.tail_local.x, bone.tail_local.y, bone.tail_local.z))
+    return find_mirror_bones(armature, [bone_name], epsilon=epsilon)[0]
 
-    for b in armature.data.bones:
-        if b != bone and (b.head_local - mirror_head).length < epsilon and (b.tail_local - mirror_tail).length < epsilon:
-            return b.name
-
-    return None
+################
+def get_bone_head_tails(armature):
+    """
+    Returns (number of bones, 2, 3) array of head_local and tail_local.
+    """
+    bones = armature.data.bones
+    heads = np.empty(len(bones) * 3, dtype=np.float32)
+    tails = np.empty(len(bones) * 3, dtype=np.float32)
+    bones.foreach_get('head_local', heads)
+    bones.foreach_get('tail_local', tails)
+    return np.stack((heads.reshape(-1, 3), tails.reshape(-1, 3)), axis=1)
 
 ################
 def find_mirror_bones(armature, bone_names, epsilon=1e-10):
@@ -1332,13 +1570,37 @@ def find_mirror_bones(armature, bone_names, epsilon=1e-10):
     list of strings
       Mirror bone names.
     """
-    mirror_bones = [find_mirror_bone(armature, bn, epsilon=epsilon) for bn in bone_names]
+    bones = armature.data.bones
+    indices = np.array([bones.find(bn) for bn in bone_names], dtype=np.int64)
+    if np.any(indices < 0):
+        missing = [bn for bn, idx in zip(bone_names, indices) if idx < 0]
+        raise KeyError(f'Armature({armature.name}) does not have bones: {missing}')
+
+    # 全ての骨の head と tail を空間ハッシュに入れ、反転した位置でまとめて探す
+    coords = get_bone_head_tails(armature)
+    queries = coords[indices] * np.array((-1, 1, 1), dtype=np.float32)
+    qi, pi = mu.find_pairs_within(coords, queries, epsilon)
+
+    # 自身を除いた、最もインデックスの小さい骨を選ぶ
+    others = pi != indices[qi]
+    qi = qi[others]
+    pi = pi[others]
+    found, first = np.unique(qi, return_index=True)
+    mirror_bones = [None] * len(bone_names)
+    for qq, pp in zip(found.tolist(), pi[first].tolist()):
+        mirror_bones[qq] = bones[pp].name
     return mirror_bones
 
 ################
-def pose_mirror_x_translations(arma, translations, selection):
+def pose_mirror_x_translations(arma, translations, selection,
+                               flipped_indices=None, visible_bones=None):
+    """
+    X 軸ミラーの骨の移動量を計算する。
+    flipped_indices と visible_bones を省略するとアーマチュアから取得する
+    """
     #print(selection)
-    flipped_indices = np.array(get_flip_side_indices(arma))
+    if flipped_indices is None:
+        flipped_indices = get_armature_topology(arma).flip_indices
     has_mirror = flipped_indices != np.arange(flipped_indices.size)
 
     # ミラーを持ち、かつ、ミラーが選択されていない骨を対象とする
@@ -1362,8 +1624,8 @@ def pose_mirror_x_translations(arma, translations, selection):
     mirror_bones[mirror_indices] = True
 
     # 見えている骨のみ移動する
-    visible_bones = np.array([is_bone_visible(b.bone)
-                              for b in arma.pose.bones], dtype=bool)
+    if visible_bones is None:
+        visible_bones, _ = get_bone_visibility(arma)
     mirror_bones &= visible_bones
     new_translations = np.where(mirror_bones[:, np.newaxis],
                                 mirror_translations,
@@ -1405,79 +1667,101 @@ def set_translations(arma, translations, which_to_move):
     which_to_move : np.ndarray
       移動するかどうかを指定する bool の配列
     """
+    topology = get_armature_topology(arma)
+    pose_bones = arma.pose.bones
+    parents = topology.parents
+    translations = np.asarray(translations, dtype=np.float64)
+    which_to_move = np.asarray(which_to_move, dtype=bool)
+
+    # 移動後の bone.matrix を、親から子の順に深さごとにまとめて計算する
+    matrices = get_bone_matrices(pose_bones, 'matrix')
+    bases = get_bone_matrices(pose_bones, 'matrix_basis')
+    moved = np.zeros(len(topology), dtype=bool)
+
+    for level in topology.levels:
+        # 移動するボーン、及び、変更のあったボーンの子を全て設定する
+        level_parents = parents[level]
+        moving = which_to_move[level] | ((level_parents >= 0) & moved[level_parents])
+        indices = level[moving]
+        if not indices.size:
+            continue
+        moved[indices] = True
+
+        # pose.matrix = offset @ matrix_basis
+        idx_parents = parents[indices]
+        offsets = topology.rest_offsets[indices]
+        offsets = np.where((idx_parents >= 0)[:, np.newaxis, np.newaxis],
+                           matrices[idx_parents] @ offsets,
+                           offsets)
+
+        # ボーンの location を計算する
+        simple = topology.simple_inherit[indices]
+        idx = indices[simple]
+        offs = offsets[simple]
+        bases[idx, :3, 3] = np.linalg.solve(
+            offs[:, :3, :3],
+            (translations[idx] - offs[:, :3, 3])[..., np.newaxis])[..., 0]
+
+        # 子のために新しい matrix を計算
+        matrices[idx] = offs @ bases[idx]
+
+        # 継承の方法が既定でない骨は Blender に計算させる
+        for idx in indices[~simple].tolist():
+            bases[idx, :3, 3], matrices[idx] = compute_pose_translation(
+                pose_bones[idx], translations[idx], matrices[parents[idx]], bases[idx])
+
+    if moved.any():
+        locations = bases[:, :3, 3].astype(np.float32)
+        pose_bones.foreach_set('location', locations.ravel())
+        arma.update_tag()
 
-    # 骨の名前 -> index の辞書
-    bone_indices = {b.name: i for i, b in enumerate(arma.pose.bones)}
-
-    # データを親から子の順に作成していくことで、
-    # 移動後の bone.matrix をまとめて計算する
-    @dataclass
-    class BoneData():
-        moved : bool
-        matrix : Matrix
-        matrix_local : Matrix
-
-    # 計算した骨のデータを保存しておく
-    bone_data = dict()
-
-    # 親→子の順にソートした骨の名前
-    sorted_bone_names = get_sorted_bone_names(arma)
-    for bn in sorted_bone_names:
-        idx = bone_indices[bn]
-        bone = arma.pose.bones[idx]
-        has_child = bone.bone.children is not None
-        has_parent = bone.parent is not None
-        if has_parent:
-            parent_data = bone_data[bone.parent.name]
-        else:
-            parent_data = None
+################
+def compute_pose_translation(bone, translation, parent_matrix, matrix_basis):
+    """
+    bone.convert_local_to_pose() を使って、ポーズ座標 translation に
+    骨を移動するための location と、移動後の bone.matrix を得る。
+    parent_matrix は移動後の親の bone.matrix (親がなければ無視する)
+    """
+    parent_args = dict()
+    if bone.parent:
+        parent_args = dict(parent_matrix=Matrix(parent_matrix.tolist()),
+                           parent_matrix_local=bone.parent.bone.matrix_local)
+
+    translation_matrix_l = bone.bone.convert_local_to_pose(
+        Matrix.Translation(translation),
+        bone.bone.matrix_local,
+        invert=True,
+        **parent_args)
+
+    new_matrix_basis = Matrix(matrix_basis.tolist())
+    new_matrix_basis.translation = translation_matrix_l.translation
+    new_matrix = bone.bone.convert_local_to_pose(
+        new_matrix_basis,
+        bone.bone.matrix_local,
+        **parent_args)
+    return np.array(new_matrix_basis.translation), np.array(new_matrix)
 
-        # 移動するボーン、及び、変更のあったボーンの子を全て設定する
-        moving = which_to_move[idx] or has_parent and parent_data.moved
-        if not moving:
-            new_matrix = bone.matrix
-        else:
-            translation_matrix_p = Matrix.Translation(translations[idx])
-
-            # ボーンの location を計算する
-            if has_parent:
-                translation_matrix_l = bone.bone.convert_local_to_pose(
-                    translation_matrix_p,
-                    bone.bone.matrix_local,
-                    parent_matrix = parent_data.matrix,
-                    parent_matrix_local = parent_data.matrix_local,
-                    invert = True)
-            else:
-                translation_matrix_l = bone.bone.convert_local_to_pose(
-                    translation_matrix_p,
-                    bone.bone.matrix_local,
-                    invert = True)
-
-            new_location = translation_matrix_l.translation
-            new_matrix_basis = bone.matrix_basis.copy()
-            new_matrix_basis.translation = new_location
-            
-            # 子のために新しい matrix を計算
-            if not has_child:
-                new_matrix = None
-            else:
-                if has_parent:
-                    new_matrix = bone.bone.convert_local_to_pose(
-                        new_matrix_basis,
-                        bone.bone.matrix_local,
-                        parent_matrix = parent_data.matrix,
-                        parent_matrix_local = parent_data.matrix_local)
-                else:
-                    new_matrix = bone.bone.convert_local_to_pose(
-                        new_matrix_basis,
-                        bone.bone.matrix_local)
+################
+def get_bone_matrices(bones, attr='matrix_local'):
+    """
+    骨の行列をまとめて取得する。
 
-            # 設定する
-            bone.location = new_location
+    Parameters:
+    -----------
+    bones : bpy_prop_collection
+      arma.data.bones や arma.pose.bones
+    attr : string
+      行列のプロパティ名 ('matrix_local', 'matrix', 'matrix_basis' など)
 
-        # 子のためにデータを保存しておく
-        if has_child:
-            bone_data[bn] = BoneData(moving, new_matrix, bone.bone.matrix_local)
+    Returns:
+    --------
+    np.ndarray
+      (骨の数, 4, 4) の行列の配列
+    """
+    buf = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get(attr, buf)
+    # Blender の行列は列優先で格納されているため転置する
+    return buf.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
 
 ################
 def adjust_bendy_bone_size(arma, bone_names, ratio_z, ratio_x,
@@ -1493,11 +1777,8 @@ def adjust_bendy_bone_size(arma, bone_names, ratio_z, ratio_x,
         
 ################
 def compute_bone_epsilon(arma):
-    # Using list comprehension to collect all coordinates
-    all_coords = [coord for bone in arma.data.bones for coord in (bone.head_local, bone.tail_local)]
-
-    # Convert the list into a numpy array
-    all_coords = np.array(all_coords)
+    # Collect all coordinates
+    all_coords = get_bone_head_tails(arma)
 
     # Calculate the absolute values
     abs_coords = np.abs(all_coords)
@@ -1571,6 +1852,12 @@ def rename_bones_for_symmetry(arma, bone_names, epsilon=None):
         rename_dic[bone_1.name] = new_name_1
 
 
+    # 反対側の骨をまとめて探しておく
+    all_bone_set = set(all_bones)
+    existing = [bn for bn in bone_names if bn in all_bone_set]
+    mirrored_bones = dict(zip(existing,
+                              find_mirror_bones(arma, existing, epsilon=epsilon)))
+
     # 骨→反対側の骨 の名前の辞書を作る
     other_bone = dict()
     for bn in bone_names:
@@ -1582,13 +1869,13 @@ def rename_bones_for_symmetry(arma, bone_names, epsilon=None):
             # 既に登録済みなら何もしない
             continue
 
-        flipped_bone = iu.find_flip_side_name(all_bones, bn)
+        flipped_bone = iu.find_flip_side_name(all_bone_set, bn)
         if flipped_bone:
             # お互い.L.Rが付いているなら何もしない
             #print(f'Already flipped: {bn} {flipped_bone}')
             continue
 
-        mirrored_bone = find_mirror_bone(arma, bn, epsilon=epsilon)
+        mirrored_bone = mirrored_bones[bn]
         if mirrored_bone:
             # 対称位置の骨を発見したので登録する
             #print(f'Find mirror: {bn} {mirrored_bone}')
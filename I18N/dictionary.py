@@ -109,6 +109,8 @@ translations_dict = {
         ('*', 'Adjusts the size of the selected bone when it is displayed as a B-bone.'): "選択したボーンをBボーン表示する時のサイズを調整します",
         ('*', 'Influence Radius'): "影響範囲",
         ('*', 'Specify the range of influence of the proportional move.'): "プロポーショナル移動の影響範囲を指定します",
+        ('*', 'Connected Only'): "つながりのみ",
+        ('*', 'Specifies that the distance is measured along the bone hierarchy, so that unconnected chains are not moved.'): "距離を骨の階層に沿って測り、つながっていない骨を動かさないように指定します",
         ('*', 'Block with mesh'): "メッシュでブロックする",
         ('*', 'Specifies whether to stop at the surface of the specified mesh.'): "指定したメッシュの表面で止まるかどうかを指定します",
         ('*', 'Snap to mesh'): "メッシュにスナップする",
@@ -195,6 +197,9 @@ translations_dict = {
         ('*', 'Find the center by considering the area of the polygon.'): "多角形の面積を考慮して中心を求めます",
         ('*', 'Consider the Edge'): "辺を考慮",
         ('*', 'Find the center of the face weighted by edge lengths.'): "辺の長さを考慮して計算します",
+        ('Operator', 'Mesh Proportional Move'): "メッシュのプロポーショナル移動",
+        ('*', 'Proportionally move the vertices of the edit mesh.'): "編集中のメッシュの頂点をプロポーショナル移動します",
+        ('*', 'Specifies the amount (in meters) by which the vertices are to be moved.'): "頂点を移動する量(m)を指定します",
         ('*', 'Material Order Specification List'): "マテリアル順指定リスト",
         ('*', 'A list to specify the order when sorting materials.'): "マテリアルをソートする時に順番を指定するためのリスト",
         ('*', 'Material Selector'): "マテリアル選択",
@@ -306,6 +311,14 @@ translations_dict = {
         ('*', 'Sorts materials in the order specified in the list. The material order list is located in the MaterialTool panel.'): "マテリアルをリストで指定した順番にソートします。マテリアル順指定リストは MaterialTool パネルにあります",
         ('*', 'Remove unused materials'): "未使用マテリアルを削除",
         ('*', 'Remove unused materials from the slot.'): "未使用のマテリアルをスロットから削除します",
+        ('*', 'Build Texture Atlas'): "テクスチャアトラスの作成",
+        ('*', 'Merges materials which differ only in their textures into one material by packing the textures into an atlas.'): "テクスチャだけが異なるマテリアルを、テクスチャをアトラスにまとめて一つのマテリアルに統合します",
+        ('*', 'Atlas Max Size'): "アトラスの最大サイズ",
+        ('*', 'Maximum width and height of the texture atlas.'): "テクスチャアトラスの幅と高さの最大値です",
+        ('*', 'Compact Meshes'): "メッシュのコンパクト化",
+        ('*', 'Removes UV maps and attributes not used by materials and empty vertex groups, and welds duplicated vertices.'): "マテリアルで使われていない UV マップや属性、空の頂点グループを削除し、重複した頂点を結合します",
+        ('*', 'Optimize Vertex Cache'): "頂点キャッシュの最適化",
+        ('*', 'Reorders polygons and vertices of the merged meshes to be efficient for the GPU vertex cache.'): "統合したメッシュのポリゴンと頂点を、GPU の頂点キャッシュ効率が良くなるように並べ替えます",
         ('*', 'Remove Polygons'): "ポリゴン削除",
         ('*', 'Remove polygons according to the condition.'): "条件によってポリゴンを削除します",
         ('*', 'Judgment coarseness'): "判定の粗さ",
@@ -336,13 +349,42 @@ translations_dict = {
         ('*', 'Spread'): "内から広がる",
         ('*', 'Gather'): "外から集まる",
         ('*', 'Project the ray from the outside to the inside.'): "レイを外側から内側へ投射します",
+        ('*', 'Target Bones'): "対象の骨",
+        ('*', 'Sets the bones to add colliders.'): "コライダを追加する骨を設定します",
+        ('*', 'Selected Bones'): "選択中の骨",
+        ('*', 'Add colliders to the selected bones.'): "選択中の骨にコライダを追加します",
+        ('*', 'All Deform Bones'): "全ての変形ボーン",
+        ('*', 'Add colliders to all deform bones of the armature.'): "アーマチュアの全ての変形ボーンにコライダを追加します",
+        ('*', 'Fitting Method'): "フィッティング方法",
+        ('*', 'Sets how to fit the colliders to the ray hits.'): "レイが当たった点にコライダをフィットさせる方法を設定します",
+        ('*', 'Least Squares'): "最小二乗法",
+        ('*', 'Fit to all the hits.'): "当たった全ての点にフィットさせます",
+        ('*', 'Robust'): "ロバスト",
+        ('*', 'Ignore the hits far from the others, such as the hits on fingers or accessories.'): "指やアクセサリーに当たった点など、他から離れた点を無視します",
+        ('*', 'Adaptive Sampling'): "適応的サンプリング",
+        ('*', 'Places colliders densely only where the thickness of the mesh changes.'): "メッシュの太さが変化する所にだけコライダを密に配置します",
+        ('*', 'Adaptive Tolerance'): "適応的サンプリングの許容誤差",
+        ('*', 'Subdivides intervals where the radius or center of the colliders changes more than this value (m).'): "コライダの半径や中心がこの値(m)より大きく変化する区間を細分化します",
         ('Operator', 'Empty to Collider'): "エンプティのコライダ化",
         ('*', 'Sets the currently selected empties as children of the currently selected bones of the active skeleton.'): "選択中のエンプティを、アクティブなスケルトンの選択中のボーンの子として設定します",
         ('Operator', 'Create a mirror of the collider'): "コライダのミラーを作成",
         ('*', 'Creates a mirror of the currently selected collider.'): "選択中のコライダのミラーを作成します",
+        ('Operator', 'Optimize Colliders'): "コライダの最適化",
+        ('*', 'Removes colliders that are mostly covered by the other colliders of the same bone.'): "同じ骨の他のコライダにほぼ覆われているコライダを削除します",
+        ('*', 'Sets the bones whose colliders are optimized.'): "コライダを最適化する骨を設定します",
+        ('*', 'Optimize the colliders of the selected bones.'): "選択中の骨のコライダを最適化します",
+        ('*', 'All Bones'): "全ての骨",
+        ('*', 'Optimize the colliders of all bones.'): "全ての骨のコライダを最適化します",
+        ('*', 'Tolerance'): "許容誤差",
+        ('*', 'Sets the ratio of the collider surface allowed to be left uncovered.'): "覆われずに残ってもよいコライダ表面の割合を設定します",
+        ('*', 'Maximum Colliders per Bone'): "骨ごとの最大コライダ数",
+        ('*', 'Sets the maximum number of colliders per bone. 0 means unlimited.'): "骨ごとのコライダの最大数を設定します。0 は無制限です",
+        ('*', 'Colliders: {before} -> {after}'): "コライダ: {before} → {after}",
         ('Operator', 'Register Spring Bone'): "Springbone.json を登録",
         ('*', "Registers the collider and swing object settings to the skeleton based on the information in the specified springbone.json. Since this function is automatically called in 'Preparation before VRM export', it is usually not necessary to use this function."): "指定した springbone.json の情報を元にコライダと揺れ物の設定をスケルトンに登録します。「VRM 出力前の準備」で自動的に呼ばれるため、通常は使う必要はありません",
         ('*', '{sb_json} information has been registered.'): "{sb_json}の情報を登録しました。",
+        ('*', 'No problems found.'): "問題は見つかりませんでした",
+        ('*', '{count} problems found.'): "{count} 個の問題が見つかりました",
         ('Operator', 'Preparation before VRM export'): "VRM 出力前の準備",
         ('*', 'To export the VRM, merge the meshes, dissolve unwanted bones, clean up the weights, and set the blendshapes.'): "VRM を出力するために、メッシュをマージし、不要な骨を溶解し、ウェイトのクリーンアップを行い、ブレンドシェイプの設定を行います",
         ('Operator', 'Open VRM_Addon_for_Blender page'): "VRM_Addon_for_Blender のページを開く",
@@ -1,6 +1,7 @@
 # -*- encoding:utf-8 -*-
 
 import bpy
+import numpy as np
 from . import internalUtils as iu
 
 ################
@@ -207,29 +208,74 @@ def sort_material_slots(obj, material_order):
         print('No material slots found in the object.')
         return
 
-    # Sort material slots according to the material_order list
-    with iu.mode_context(obj, 'OBJECT'):
-        sorted_slots = []
-        for material_name in material_order:
-            if obj.material_slots.find(material_name) >= 0:
-                sorted_slots.append(material_name)
-
-        # Find and sort the remaining material slots not in material_order
-        remaining_slots = sorted([slot.material.name for slot in obj.material_slots if slot.material.name not in sorted_slots])
-
-        # Combine sorted lists
-        sorted_slots.extend(remaining_slots)
-        #print(sorted_slots)
-
-        # Reorder the material slots using bpy.ops.object.material_slot_move()
-        for idx, material_name in enumerate(sorted_slots):
-            obj.active_material_index = obj.material_slots.find(material_name)
-            assert obj.active_material_index >= 0
-            for _ in range(idx - obj.active_material_index):
-                bpy.ops.object.material_slot_move(direction='DOWN')
-            for _ in range(obj.active_material_index - idx):
-                bpy.ops.object.material_slot_move(direction='UP')
-            assert obj.active_material_index == idx
+    cleanup_material_slots(obj, material_order, remove_unused=False)
+
+################################################################
+def cleanup_material_slots(obj, material_order=None, remove_unused=True):
+    """
+    Remove unused material slots and sort the rest without operators.
+    The material indices of the polygons are remapped in one pass.
+
+    Parameters
+    ----------
+    obj : bpy.types.Object
+        The mesh object whose material slots are cleaned up.
+    material_order : list of str
+        List of material names in the desired order. The rest of the slots
+        follow in the order of the names. None to keep the order.
+    remove_unused : bool
+        Whether to remove the slots not used by any polygon.
+
+    Returns
+    -------
+    int
+        Number of removed slots.
+    """
+
+    mesh = obj.data
+    slots = [(slot.material, slot.link) for slot in obj.material_slots]
+    num_slots = len(slots)
+    if num_slots == 0:
+        return 0
+
+    material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', material_indices)
+    np.clip(material_indices, 0, num_slots - 1, out=material_indices)
+
+    if remove_unused:
+        kept = np.unique(material_indices).tolist()
+    else:
+        kept = list(range(num_slots))
+
+    if material_order is not None:
+        rank = {name: idx for idx, name in reversed(list(enumerate(material_order)))}
+        def sort_key(idx):
+            name = slots[idx][0].name if slots[idx][0] else ''
+            return (rank.get(name, len(rank)), '' if name in rank else name, idx)
+        kept.sort(key=sort_key)
+
+    if kept == list(range(num_slots)):
+        return 0
+
+    remap = np.zeros(num_slots, dtype=np.int32)
+    remap[kept] = np.arange(len(kept), dtype=np.int32)
+
+    # Rewrite the slots once.
+    mesh.materials.clear()
+    for idx in kept:
+        material, link = slots[idx]
+        mesh.materials.append(material if link == 'DATA' else None)
+    for new_idx, idx in enumerate(kept):
+        material, link = slots[idx]
+        if link == 'OBJECT':
+            obj.material_slots[new_idx].link = 'OBJECT'
+            obj.material_slots[new_idx].material = material
+
+    mesh.polygons.foreach_set('material_index', remap[material_indices])
+    mesh.update()
+    obj.active_material_index = 0
+
+    return num_slots - len(kept)
 
 ################
 def collectNodeSocketsFromMaterial(material, func):
@@ -258,3 +304,126 @@ def collectNodeSocketsFromMaterial(material, func):
                     result.add(socket)
 
     return result
+
+################
+def collectReferencedAttributeNames(material):
+    """
+    Get names of UV maps and attributes referenced by the nodes of a material,
+    including the nodes in the node groups.
+
+    Parameters
+    ----------
+    material : bpy.types.Material
+        The material to search for.
+
+    Returns
+    -------
+    (set of str, set of str)
+        Names of the UV maps and names of the other attributes.
+        An empty name means the default (active render) layer.
+    """
+
+    uv_names = set()
+    attribute_names = set()
+    visited = set()
+
+    def collect(node_tree):
+        if not node_tree or node_tree.name in visited:
+            return
+        visited.add(node_tree.name)
+        for node in node_tree.nodes:
+            if node.type in ('UVMAP', 'NORMAL_MAP', 'TANGENT', 'UVALONGSTROKE'):
+                uv_names.add(getattr(node, 'uv_map', ''))
+            elif node.type == 'TEX_IMAGE' and not node.inputs['Vector'].is_linked:
+                uv_names.add('')
+            elif node.type == 'VERTEX_COLOR':
+                attribute_names.add(node.layer_name)
+            elif node.type == 'ATTRIBUTE':
+                attribute_names.add(node.attribute_name)
+                uv_names.add(node.attribute_name)
+            elif node.type == 'GROUP':
+                collect(node.node_tree)
+
+    if material and material.use_nodes:
+        collect(material.node_tree)
+
+    return uv_names, attribute_names
+
+################
+def getAtlasCompatibilityKey(material, precision=5):
+    """
+    Get a key to find materials which can share a texture atlas.
+    Materials with the same key have the same nodes, links and
+    non-texture input values, and differ only in their images.
+
+    Parameters
+    ----------
+    material : bpy.types.Material
+        The material to check.
+    precision : int
+        Number of decimal places to compare the input values.
+
+    Returns
+    -------
+    (tuple, list of str)
+        The key and the names of the image texture nodes,
+        or (None, None) if the material cannot be atlased.
+    """
+
+    if not material or not material.use_nodes:
+        return None, None
+
+    def to_value(value):
+        if isinstance(value, float):
+            return round(value, precision)
+        if isinstance(value, (int, bool, str)) or value is None:
+            return value
+        try:
+            return tuple(to_value(v) for v in value)
+        except TypeError:
+            return getattr(value, 'name', None)
+
+    nodes = []
+    image_nodes = []
+    for node in material.node_tree.nodes:
+        if node.type == 'TEX_IMAGE':
+            vector = node.inputs['Vector']
+            if vector.is_linked:
+                # Only the default UV map can be remapped.
+                from_node = vector.links[0].from_node
+                if from_node.type != 'UVMAP' or from_node.uv_map:
+                    return None, None
+            if not node.image:
+                return None, None
+            image_nodes.append(node.name)
+            nodes.append((node.name, node.bl_idname,
+                          node.interpolation, node.projection, node.extension,
+                          node.image.colorspace_settings.name,
+                          node.image.alpha_mode))
+        elif node.type == 'GROUP':
+            nodes.append((node.name, node.bl_idname,
+                          node.node_tree.name if node.node_tree else None))
+        elif node.type in ('UVMAP', 'NORMAL_MAP', 'TANGENT'):
+            if getattr(node, 'uv_map', ''):
+                return None, None
+            nodes.append((node.name, node.bl_idname))
+        else:
+            nodes.append((node.name, node.bl_idname))
+
+    links = [(link.from_node.name, link.from_socket.identifier,
+              link.to_node.name, link.to_socket.identifier)
+             for link in material.node_tree.links]
+
+    sockets = collectNodeSocketsFromMaterial(
+        material,
+        lambda socket: not socket.is_linked and hasattr(socket, 'default_value'))
+    values = [(socket.node.name, socket.identifier, to_value(socket.default_value))
+              for socket in sockets]
+
+    settings = tuple(to_value(getattr(material, attr, None))
+                     for attr in ('blend_method', 'alpha_threshold',
+                                  'use_backface_culling', 'show_transparent_back',
+                                  'shadow_method'))
+
+    key = (settings, tuple(sorted(nodes)), tuple(sorted(links)), tuple(sorted(values)))
+    return key, sorted(image_nodes)
@@ -1,9 +1,12 @@
 # -*- encoding:utf-8 -*-
 import bpy
-from bpy.types import Object, PropertyGroup
+from bpy.types import Object, PropertyGroup, Operator
 from bpy.props import PointerProperty, FloatProperty, BoolProperty, StringProperty
+import gpu
+from bpy_extras import view3d_utils
+from gpu_extras.batch import batch_for_shader
 import numpy as np
-import random
+import time
 from mathutils import (
     Vector,
     Matrix,
@@ -12,6 +15,7 @@ from dataclasses import dataclass
 
 from . import internalUtils as iu
 from . import mathUtils as mu
+from . import UIUtils as ui
 
 _ = lambda s: s
 from bpy.app.translations import pgettext_iface as iface_
@@ -191,14 +195,17 @@ def get_direction_enum():
 ################
 # ProportionalMover のモディファイアの基底クラス
 class ProportionalMoverModifier():
-    def modify(self, pm, new_locations, which_to_move):
+    def modify(self, pm, indices, new_locations, which_to_move):
         """
-        移動時に呼ばれ、移動先の座標や、どの点を動かすかを調整する
+        移動時に呼ばれ、移動先の座標や、どの点を動かすかを調整する。
+        影響範囲内の点だけが渡される
 
         Parameters:
         -----------
         pm : ProportionalMover
           呼び出し元
+        indices : np.ndarray
+          渡された点の、pm.orig_locations でのインデックス
         new_locations : np.ndarray
           移動先の座標の配列
         which_to_move : np.ndarray
@@ -244,9 +251,24 @@ class ProportionalMover():
         # 選択した点との最短距離(ワールド座標)
         self.__distances = None
 
+        # 選択した点とのユークリッド距離
+        self.__euclidean_distances = None
+
         # 移動量にかける係数
         self.__factors = None
 
+        # 影響範囲内の点のインデックス
+        self.__active_indices = None
+
+        # 移動後のワールド座標。前回移動した点と今回移動する点だけを更新する
+        self.__locations = None
+
+        # 移動後の座標に移動しているかどうか
+        self.__moved = None
+
+        # 前回移動した点のインデックス
+        self.__moved_indices = None
+
         # 移動先の座標決定時に呼ばれるモディファイア
         self.modifiers = []
 
@@ -290,11 +312,34 @@ class ProportionalMover():
         self.__center_location = np.mean(selected_locations, axis=0)
 
         # Save distances for each bone
-        diff_grid = locations[:, np.newaxis] - selected_locations
-        self.__distances = np.min(np.linalg.norm(diff_grid, axis=2), axis=1)
+        self.__euclidean_distances, _ = mu.nearest_distances(locations, selected_locations)
+        self.__distances = self.__euclidean_distances
+
+        # 移動結果のバッファ
+        self.__locations = locations.copy()
+        self.__moved = np.zeros(len(locations), dtype=bool)
+        self.__moved_indices = np.zeros(0, dtype=np.int64)
 
         self.reset_movement()
 
+    ################
+    def set_distances(self, distances=None):
+        """
+        falloff の計算に使う、選択した点との距離を設定する
+
+        Parameters:
+        -----------
+        distances : np.ndarray
+          点ごとの距離。None ならばユークリッド距離に戻す
+        """
+        if distances is None:
+            distances = self.__euclidean_distances
+        if self.__distances is not distances:
+            self.__distances = distances
+
+            # Invalidate parameters
+            self.__invalidate_factors()
+
     ################
     # 移動していない状態にする
     def reset_movement(self):
@@ -304,7 +349,7 @@ class ProportionalMover():
         self.__directions = np.zeros_like(self.__orig_locations)
 
         # Invalidate parameters
-        self.__factors = None
+        self.__invalidate_factors()
 
     ################
     @property
@@ -369,7 +414,7 @@ class ProportionalMover():
             self.__influence_radius = new_value
         
             # Invalidate parameters
-            self.__factors = None
+            self.__invalidate_factors()
 
     ################
     @property
@@ -382,48 +427,72 @@ class ProportionalMover():
             self.__falloff_type = falloff_type
         
             # Invalidate parameters
-            self.__factors = None
+            self.__invalidate_factors()
 
     ################
+    def __invalidate_factors(self):
+        self.__factors = None
+        self.__active_indices = None
+
     @property
     def factors(self):
         # Compute factors
         if self.__factors is None:
-            falloff = mu.falloff_funcs[self.falloff_type]
-            rng = random.Random(0)
-            values = self.distances / self.influence_radius
-            self.__factors =\
-                np.array([0 if val > 1 else falloff(val, rng.random)
-                          for val in values])
+            self.__factors = mu.compute_falloff(self.distances,
+                                                self.influence_radius,
+                                                self.falloff_type)
         return self.__factors
 
-    def compute_move(self, amount, which_to_move=True):
+    # 影響範囲内の点のインデックス。距離や falloff が変わった時だけ計算する
+    @property
+    def active_indices(self):
+        if self.__active_indices is None:
+            self.__active_indices = np.flatnonzero(self.factors > EPSILON)
+        return self.__active_indices
+
+    def compute_move(self, amount, which_to_move=None):
         """
         移動計算を行う。modifiers が設定されている場合、順番に適用される。
+        影響範囲内の点と、前回移動した点だけを計算する
 
         Parameters:
         -----------
         amount : float
           移動量(m)
         which_to_move : np.ndarray
-          移動するかどうかを決定する bool の配列
+          移動してよいかどうかを決定する bool の配列。None なら全て
 
         Returns:
         --------
-        np.ndarray, np.ndarray
-        新しいワールド座標と、移動したかどうかを示す bool の配列
+        np.ndarray, np.ndarray, np.ndarray
+          新しいワールド座標と、移動したかどうかを示す bool の配列、
+          前回から変更のあった点のインデックス。
+          配列は次の呼び出しで更新されるので、変更しないこと
         """
-        factors = self.factors * amount
-        move_vectors = self.directions * factors[:, np.newaxis]
-        new_locations = self.orig_locations + move_vectors
-        which_to_move = np.logical_and(which_to_move, self.factors > EPSILON)
+        indices = self.active_indices
+        if which_to_move is not None:
+            indices = indices[which_to_move[indices]]
+        directions = self.directions
+        if directions.ndim == 2 and len(directions) > 1:
+            directions = directions[indices]
+        new_locations = self.orig_locations[indices] +\
+            directions * (self.factors[indices] * amount)[:, np.newaxis]
+        moving = np.ones(len(indices), dtype=bool)
         for mod in self.modifiers:
-            new_locations, which_to_move =\
-                mod.modify(self, new_locations, which_to_move)
-        new_locations = np.where(which_to_move[:, np.newaxis],
-                                 new_locations,
-                                 self.orig_locations)
-        return new_locations, which_to_move
+            new_locations, moving =\
+                mod.modify(self, indices, new_locations, moving)
+
+        # 前回移動した点を元に戻してから、今回の結果を書き込む
+        prev_indices = self.__moved_indices
+        self.__locations[prev_indices] = self.orig_locations[prev_indices]
+        self.__moved[prev_indices] = False
+        moved_indices = indices[moving]
+        self.__locations[moved_indices] = new_locations[moving]
+        self.__moved[moved_indices] = True
+        self.__moved_indices = moved_indices
+
+        changed_indices = np.union1d(prev_indices, moved_indices)
+        return self.__locations, self.__moved, changed_indices
 
 ################################################################
 def get_target_mesh_name_prop():
@@ -478,7 +547,7 @@ class MeshSnapModifier(ProportionalMoverModifier):
     def __init__(self, prop):
         self.m_prop = prop
     
-    def modify(self, pm, new_locations, which_to_move):
+    def modify(self, pm, indices, new_locations, which_to_move):
         mesh = bpy.data.objects.get(self.m_prop.target_mesh_name)
         if not mesh or mesh.type != 'MESH' or not mesh.visible_get():
             return new_locations, which_to_move
@@ -519,14 +588,14 @@ class MeshBlockModifier(ProportionalMoverModifier):
     def __init__(self, prop):
         self.m_prop = prop
     
-    def modify(self, pm, new_locations, which_to_move):
+    def modify(self, pm, indices, new_locations, which_to_move):
         mesh = bpy.data.objects.get(self.m_prop.target_mesh_name)
         if not mesh or mesh.type != 'MESH' or not mesh.visible_get():
             return new_locations, which_to_move
 
         hits, new_locations = mu.block_with_mesh(
-            pm.orig_locations,
-            pm.prev_locations,
+            pm.orig_locations[indices],
+            pm.prev_locations[indices],
             new_locations,
             mesh,
             which_to_move,
@@ -537,10 +606,936 @@ class MeshBlockModifier(ProportionalMoverModifier):
     def draw(self, context, layout):
         m_prop.draw(context, layout)
 
+################################################################
+class DDDPM_ProportionalMove_pg(PropertyGroup):
+    use_proportional: BoolProperty(
+        name=_('Use Proportional'),
+        description=_('Specifies whether to move proportionally. If unchecked, no proportional movement is performed and only the selected bone is moved.'),
+        default=True,
+    )
+
+    falloff_type: mu.get_falloff_enum()
+    
+    influence_radius: FloatProperty(
+        name=_('Influence Radius'),
+        description=_('Specify the range of influence of the proportional move.'),
+        min=1e-9,
+        default=1.0,
+    )
+
+    use_connected: BoolProperty(
+        name=_('Connected Only'),
+        description=_('Specifies that the distance is measured along the bone hierarchy, so that unconnected chains are not moved.'),
+        default=False,
+    )
+
+    use_block_with_mesh: BoolProperty(
+        name=_('Block with mesh'),
+        description=_('Specifies whether to stop at the surface of the specified mesh.'),
+        default=False)
+    display_block_with_mesh: BoolProperty(default=False)
+    block_with_mesh_prop: PointerProperty(type=DDDPM_MeshBlockModifier_pg)
+
+    use_snap_onto_mesh: BoolProperty(
+        name=_('Snap to mesh'),
+        description=_('Specifies whether to fly rays from the camera and snap them to the surface of the specified mesh.'),
+        default=False)
+    display_snap_onto_mesh: BoolProperty(default=False)
+    snap_onto_mesh_prop: PointerProperty(type=DDDPM_MeshSnapModifier_pg)
+
+    def draw(self, context, layout, show_connected=False):
+        col = layout.column(align=False)
+        col.prop(self, 'use_proportional')
+        box = col.box()
+        box.enabled = self.use_proportional
+        box.prop(self, 'falloff_type')
+        box.prop(self, 'influence_radius')
+        if show_connected:
+            box.prop(self, 'use_connected')
+
+        display, split = ui.splitSwitch(col, self, 'display_block_with_mesh')
+        split.prop(self, 'use_block_with_mesh')
+        if display:
+            box = col.box()
+            box.enabled = self.use_block_with_mesh
+            self.block_with_mesh_prop.draw(context, box)
+    
+        display, split = ui.splitSwitch(col, self, 'display_snap_onto_mesh')
+        split.prop(self, 'use_snap_onto_mesh')
+        if display:
+            box = col.box()
+            box.enabled = self.use_snap_onto_mesh
+            self.snap_onto_mesh_prop.draw(context, box)
+    
+    def copy_from(self, src):
+        self.use_proportional = src.use_proportional
+        self.falloff_type = src.falloff_type
+        self.influence_radius = src.influence_radius
+        self.use_connected = src.use_connected
+
+        self.use_block_with_mesh = src.use_block_with_mesh
+        #self.display_block_with_mesh = src.display_block_with_mesh
+        self.block_with_mesh_prop.copy_from(src.block_with_mesh_prop)
+
+        self.use_snap_onto_mesh = src.use_snap_onto_mesh
+        #self.display_snap_onto_mesh = src.display_snap_onto_mesh
+        self.snap_onto_mesh_prop.copy_from(src.snap_onto_mesh_prop)
+
+################
+# パイメニューの項目を選択するためのオペレーター
+class DDDPM_OT_Falloff(Operator):
+    bl_idname = "scene.dddpm_select_falloff"
+    bl_label = "Select Falloff"
+    bl_options = {'INTERNAL'}
+    data_path: StringProperty()
+    falloff_type: StringProperty()
+
+    def execute(self, context):
+        prop = context.scene.path_resolve(self.data_path)
+        prop.falloff_type = self.falloff_type
+        return {'FINISHED'}
+
+################
+class FalloffPieMenu():
+    """
+    falloff のタイプを選択するパイメニューの基底クラス。
+    Menu と共に継承し、data_path に DDDPM_ProportionalMove_pg の
+    context.scene からのパスを設定する
+    """
+    bl_label = "Select Falloff Type"
+    data_path = None
+
+    def draw(self, context):
+        layout = self.layout
+        pie = layout.menu_pie()
+
+        falloff_items = mu.get_falloff_enum().keywords['items']
+        for falloff_item in falloff_items:
+            op = pie.operator(DDDPM_OT_Falloff.bl_idname,
+                              text=falloff_item[1],
+                              icon=falloff_item[3])
+            op.data_path = self.data_path
+            op.falloff_type = falloff_item[0]
+
+################################################################
+class ProportionalMoveOperator():
+    """
+    ProportionalMover を使ってプロポーショナル移動するモーダルオペレーターの基底クラス。
+    Operator と共に継承し、以下を定義する。
+
+    m_prop : PointerProperty(type=DDDPM_ProportionalMove_pg)
+    move_vector : FloatVectorProperty (size=3)
+    direction : get_direction_enum()
+    scene_prop_path : context.scene から設定 (DDDPM_ProportionalMove_pg) へのパス
+    falloff_menu : falloff を選択するパイメニューの名前
+    setup_elements() : 移動する要素を取得する
+    set_directions_local() : LOCAL_EACH_X|Y|Z の方向を設定する
+    apply_locations() : 移動結果を書き込む
+
+    スナップやブロックの対象の既定値を変えるなら find_target_mesh() を定義する
+    つながりに沿った距離を使えるなら、supports_connected を True にして
+    compute_connected_distances() を定義する
+    """
+
+    scene_prop_path = None
+    falloff_menu = None
+    undo_message = 'Proportional Editing'
+    supports_connected = False
+
+    # マウス移動をまとめて評価する間隔(秒)
+    timer_interval = 1 / 60
+
+    # 1 回の評価にかけてよい時間(秒)。直近の評価の平均が超えると
+    # ドラッグ中はモディファイアを省略する
+    time_budget = 1 / 30
+
+    # 評価時間の平均を取る回数
+    time_window = 3
+
+    ################
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # プロポーショナル移動するクラス
+        self.pm = ProportionalMover()
+
+        # 描画ハンドル
+        self._handle = None
+
+        # context.area.show_menus の保存
+        self.prev_show_menus = None
+
+        # center_location のあるべき位置をマウス座標に変換したもの
+        self.mouse_xy = None
+
+        # center_location のあるべき位置の保存
+        self.prev_center_location = None
+
+        # 数値入力
+        self.number_input = iu.NumberInput()
+
+        # 数値入力開始時の move_vector
+        self.save_move_vector = None
+
+        # 要素の表示・選択状態
+        self.visible = None
+        self.selected = None
+
+        # 表示されていて選択されている要素
+        self.visible_selected = None
+
+        # つながりに沿った、選択した要素との距離
+        self.connected_distances = None
+        self.using_connected = False
+
+        # 方向を示す線のバッチと、作成した時の状態
+        self._lines_batch = None
+        self._lines_key = None
+        self._lines_refs = (None, None)
+
+        # まだ評価していないマウス移動量と、その時の Shift キーの状態
+        self.pending_mouse_diff = None
+        self.pending_shift = False
+
+        # 評価のタイマーと、最後に見たタイマーの経過時間
+        self._timer = None
+        self._timer_duration = None
+
+        # ドラッグ中はモディファイアを省略し、確定時に適用する
+        self.skip_modifiers = False
+
+        # モディファイアを使った直近の評価時間。
+        # 最初の評価はレイキャスタの作成を含むので数えない
+        self.modifier_times = None
+
+    ################
+    def setup_elements(self, context):
+        """
+        移動する要素を取得し、self.visible と self.selected を設定する。
+
+        Returns:
+        --------
+        np.ndarray
+          要素のワールド座標の配列。移動できなければ報告して None を返す
+        """
+        raise NotImplementedError()
+
+    ################
+    def set_directions_local(self, context):
+        """
+        LOCAL_EACH_X|Y|Z の、要素ごとの方向を self.pm に設定する
+        """
+        raise NotImplementedError()
+
+    ################
+    def apply_locations(self, context, locations, which_to_move, indices):
+        """
+        移動後のワールド座標を書き込む。配列は変更しないこと
+
+        Parameters:
+        -----------
+        locations : np.ndarray
+          要素のワールド座標の配列
+        which_to_move : np.ndarray
+          移動する要素を示す bool の配列
+        indices : np.ndarray
+          前回から変更のあった要素のインデックス
+        """
+        raise NotImplementedError()
+
+    ################
+    def compute_connected_distances(self, context, locations, selection):
+        """
+        つながりに沿った、選択した要素との距離を得る
+
+        Parameters:
+        -----------
+        locations : np.ndarray
+          要素のワールド座標の配列
+        selection : np.ndarray
+          選択されている要素を示す bool の配列
+
+        Returns:
+        --------
+        np.ndarray
+          要素ごとの距離。使えない場合は None
+        """
+        return None
+
+    ################
+    def find_target_mesh(self, context):
+        """
+        スナップやブロックの対象とするメッシュの既定値を得る
+
+        Returns:
+        --------
+        bpy.types.Object
+          メッシュオブジェクト。なければ None
+        """
+        return iu.findfirst_selected_object('MESH')
+
+    ################
+    # 設定に応じて、falloff の計算に使う距離を切り替える
+    def update_distances(self):
+        use_connected = (self.m_prop.use_connected and
+                         self.connected_distances is not None)
+        if self.using_connected != use_connected:
+            self.using_connected = use_connected
+            self.pm.set_distances(self.connected_distances if use_connected else None)
+
+    ################
+    def get_scene_prop(self, context):
+        return context.scene.path_resolve(self.scene_prop_path)
+
+    ################
+    # 要素を取得して ProportionalMover を準備する
+    def prepare(self, context):
+        locations = self.setup_elements(context)
+        if locations is None:
+            return False
+        selection = self.visible & self.selected
+        self.visible_selected = selection
+        self.pm.setup(context.space_data, locations, selection)
+
+        # つながりに沿った距離は開始時に一度だけ計算する
+        self.using_connected = False
+        self.connected_distances = None
+        if self.supports_connected:
+            self.connected_distances = \
+                self.compute_connected_distances(context, locations, selection)
+        return True
+
+    ################
+    # 方向ベクトルまたは法線ベクトルを得る
+    def get_direction_vector(self, context):
+        di = DIRECTION_INFO[self.direction]
+        if di.constant_direction:
+            return di.vector
+
+        elif di.uniform_direction:
+            row = di.row_index
+            assert row >= 0, f'Illegal direction: {self.direction}'
+            mtx = np.array(context.active_object.matrix_world)
+            return Vector(mtx[:3, row])
+
+        else:
+            raise RuntimeError()
+
+    ################
+    # 基本の単位ベクトルを得る
+    def get_direction_unit(self, context):
+        di = DIRECTION_INFO[self.direction]
+
+        if not di.uniform_direction:    return Vector((0, 0, 1))
+        if di.normal_direction:         return Vector()
+        if di.constant_direction:       return di.vector
+
+        if self.direction in {'LOCAL_X', 'LOCAL_Y', 'LOCAL_Z'}:
+            mtx = np.array(context.active_object.matrix_world)
+            return Vector(mtx[:3, di.row])
+
+        return Vector()
+
+    ################
+    def compute_mouse_move(self, context, mouse_diff):
+        self.mouse_xy += mouse_diff
+        center_location = Vector(self.pm.center_location)
+
+        # Get the 3D location that corresponds to the new mouse position
+        if self.direction == 'NONE':
+            new_location = view3d_utils.region_2d_to_location_3d(
+                context.region, context.region_data,
+                self.mouse_xy, center_location)
+
+        elif self.direction in {'GLOBAL_YZ', 'GLOBAL_ZX', 'GLOBAL_XY',
+                                'LOCAL_YZ', 'LOCAL_ZX', 'LOCAL_XY'}:
+            vec = self.get_direction_vector(context)
+            new_location = iu.calculate_mouse_ray_plane_intersection(
+                context, self.mouse_xy, center_location, vec)
+
+        elif self.direction in {'GLOBAL_X', 'GLOBAL_Y', 'GLOBAL_Z',
+                                'LOCAL_X', 'LOCAL_Y', 'LOCAL_Z'}:
+            vec = self.get_direction_vector(context)
+            new_location = iu.calculate_mouse_ray_line_intersection(
+                context, self.mouse_xy, center_location, vec)
+
+        elif self.direction in {'LOCAL_EACH_X', 'LOCAL_EACH_Y', 'LOCAL_EACH_Z',
+                                'VIEW_CAMERA', 'VIEW_PIVOT',
+                                'CURSOR_3D', 'OBJECT_ORIGIN'}:
+            unit = iu.calculate_mouse_move_unit(context, center_location)
+            vec = Vector((0, 0, mouse_diff.y * unit))
+            if self.prev_center_location:
+                new_location = self.prev_center_location + vec
+            else:
+                new_location = view3d_utils.region_2d_to_location_3d(
+                    context.region, context.region_data,
+                    self.mouse_xy, center_location) + vec
+
+        else:
+            raise RuntimeError()
+
+        if self.prev_center_location:
+            diff = new_location - self.prev_center_location
+        else:
+            diff = Vector()
+
+        self.prev_center_location = new_location
+        return diff
+
+    ################
+    @staticmethod
+    def draw_callback_pv(self, context):
+        # Set the header text
+        move_vector = Vector(self.move_vector)
+        if self.number_input.is_processing():
+            length = self.number_input.get_display()
+        else:
+            length = f'{move_vector.length:.4f}'
+        move_vector.normalize()
+        txt = f'({move_vector.x:.4f}, {move_vector.y:.4f}, {move_vector.z:.4f}) ({length} m)   Direction: {self.direction}'
+        if self.m_prop.use_proportional:
+            txt += f'   Falloff: {self.m_prop.falloff_type}   Radius: {self.m_prop.influence_radius:.4f} m'
+            if self.using_connected:
+                txt += '   Connected'
+        if self.m_prop.use_block_with_mesh:
+            txt += f'   Block({self.m_prop.block_with_mesh_prop.target_mesh_name})'
+        if self.m_prop.use_snap_onto_mesh:
+            txt += f'   Snap({self.m_prop.snap_onto_mesh_prop.target_mesh_name})'
+        if self.skip_modifiers and\
+           (self.m_prop.use_block_with_mesh or self.m_prop.use_snap_onto_mesh):
+            txt += '   (Applied on release)'
+
+        context.area.header_text_set(txt)
+
+        if self.number_input.is_processing():
+            return
+
+        # Draw direction lines
+        batch, shader = self.get_direction_lines_batch(context)
+        if batch:
+            shader.bind()
+            with iu.BlenderGpuState(blend='ALPHA', line_width=2.0):
+                batch.draw(shader)
+
+        # Draw influence_radius
+        if self.m_prop.use_proportional:
+            shader = iu.get_builtin_shader('UNIFORM_COLOR')
+            shader.bind()
+            shader.uniform_float('color', (0.1, 0.1, 0.1, 0.8))
+            batch = iu.get_unit_circle_batch(shader)
+
+            # 視線に垂直な平面上に円を描く
+            view_rotation = \
+                context.region_data.view_matrix.inverted().to_3x3().to_4x4()
+            matrix = Matrix.Translation(Vector(self.pm.center_location)) @\
+                view_rotation @\
+                Matrix.Scale(self.m_prop.influence_radius, 4)
+            with iu.BlenderGpuState(blend='ALPHA', line_width=4.0):
+                with gpu.matrix.push_pop():
+                    gpu.matrix.multiply_matrix(matrix)
+                    batch.draw(shader)
+
+    ################
+    def get_direction_lines_batch(self, context):
+        """
+        方向を示す線を全てまとめた、頂点色付きのバッチを得る。
+        状態が変わった時だけ作り直す
+
+        Returns:
+        --------
+        (gpu.types.GPUBatch, gpu.types.GPUShader)
+          線がなければバッチは None
+        """
+        di = DIRECTION_INFO[self.direction]
+        shader = iu.get_builtin_shader('SMOOTH_COLOR')
+        unit = max(iu.calculate_mouse_range_at_pivot(context))
+
+        # factors と directions は変更されると別の配列になる
+        factors = self.pm.factors
+        directions = None if di.uniform_direction else self.pm.directions
+        key = (self.direction, unit, self.m_prop.use_proportional)
+        if self._lines_key == key and\
+           self._lines_refs[0] is factors and self._lines_refs[1] is directions:
+            return self._lines_batch, shader
+
+        center_location = self.pm.center_location
+        locations = []
+        vectors = []
+        colors = []
+
+        if not di.uniform_direction:
+            COLOR_TABLE = {
+                'LOCAL_EACH_X': (1, 0, 0, 0.3),
+                'LOCAL_EACH_Y': (0, 1, 0, 0.3),
+                'LOCAL_EACH_Z': (0, 0, 1, 0.3),
+                'VIEW_CAMERA':  (0, 1, 1, 0.3),
+                'VIEW_PIVOT':   (1, 0, 1, 0.3),
+                'CURSOR_3D':    (1, 1, 1, 0.3),
+                'OBJECT_ORIGIN':(1, 1, 0, 0.3),
+            }
+            which_to_move = np.logical_and(factors > EPSILON,
+                                           self.get_which_to_move(context))
+            count = np.count_nonzero(which_to_move)
+            locations.append(self.pm.orig_locations[which_to_move])
+            vectors.append(directions[which_to_move])
+            colors.append(np.tile(COLOR_TABLE[self.direction], (count, 1)))
+
+        # 軸の方向の線
+        AXIS_TABLE = {
+            'X': ({'X', 'ZX', 'XY'}, 0, (1, 0, 0, 0.5)),
+            'Y': ({'Y', 'XY', 'YZ'}, 1, (0, 1, 0, 0.5)),
+            'Z': ({'Z', 'YZ', 'ZX'}, 2, (0, 0, 1, 0.5)),
+        }
+        space, _, axes = self.direction.partition('_')
+        if space in {'GLOBAL', 'LOCAL'}:
+            mtx = np.array(context.active_object.matrix_world)
+            for names, row, color in AXIS_TABLE.values():
+                if axes in names:
+                    axis = np.eye(3)[row] if space == 'GLOBAL' else mtx[:3, row]
+                    locations.append(np.array([center_location]))
+                    vectors.append(np.array([axis]))
+                    colors.append(np.array([color]))
+
+        batch = None
+        if locations:
+            locations = np.concatenate(locations)
+            vectors = np.concatenate(vectors) * unit
+            if len(locations):
+                # 線ごとに 2 頂点
+                pos = np.stack((locations - vectors, locations + vectors), axis=1)
+                color = np.repeat(np.concatenate(colors), 2, axis=0)
+                batch = batch_for_shader(shader, 'LINES',
+                                         {'pos': pos.reshape(-1, 3).astype(np.float32),
+                                          'color': color.astype(np.float32)})
+
+        self._lines_key = key
+        self._lines_refs = (factors, directions)
+        self._lines_batch = batch
+        return batch, shader
+
+    ################
+    # ステータスバーのヘッダーの描画
+    def status_text_fn(self, header, context):
+        row = header.layout.row(align=True)
+
+        row.label(text='Confirm', icon='MOUSE_LMB')
+        row.label(text='Cancel', icon='MOUSE_RMB')
+
+        row.label(text='X Axis', icon='EVENT_X')
+        row.label(text='Y Axis', icon='EVENT_Y')
+        row.label(text='Z Axis', icon='EVENT_Z')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='X Plane', icon='EVENT_X')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='Y Plane', icon='EVENT_Y')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='Z Plane', icon='EVENT_Z')
+
+        row.label(text='Cursor / Origin', icon='EVENT_C')
+        row.label(text='Pivot / Camera', icon='EVENT_V')
+
+        row.label(icon='MOUSE_MMB')
+        row.label(icon='EVENT_W')
+        row.label(icon='EVENT_A')
+        row.label(icon='EVENT_D', text='Radius')
+
+        row.label(text='Proportional On/Off', icon='EVENT_O')
+
+        if self.supports_connected:
+            row.label(icon='EVENT_ALT')
+            row.label(text='Connected On/Off', icon='EVENT_O')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='Falloff type', icon='EVENT_O')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='Snap On/Off', icon='EVENT_S')
+
+        row.label(icon='EVENT_SHIFT')
+        row.label(text='Block On/Off', icon='EVENT_B')
+
+        row.label(text='Precision Mode', icon='EVENT_SHIFT')
+
+        row.label(text='Move', icon='EVENT_G')
+        row.label(text='Rotate', icon='EVENT_R')
+        row.label(text='Resize', icon='EVENT_S')
+
+    ################
+    def reset_movement(self, context):
+        self.pm.reset_movement()
+        self.set_directions(context)
+        self.mouse_xy = view3d_utils.location_3d_to_region_2d(
+            context.region, context.region_data, self.pm.center_location)
+        self.prev_center_location = None
+        self.move_vector = Vector()
+
+    ################
+    def set_directions(self, context):
+        di = DIRECTION_INFO[self.direction]
+        if di.uniform_direction:
+            self.pm.directions = np.array(self.move_vector)[np.newaxis]
+
+        elif not di.global_direction:
+            self.set_directions_local(context)
+
+        elif self.direction == 'VIEW_CAMERA':
+            self.pm.set_directions_from_view_camera()
+
+        elif self.direction == 'VIEW_PIVOT':
+            self.pm.set_directions_from_view_pivot()
+
+        elif self.direction == 'CURSOR_3D':
+            self.pm.set_directions_from_cursor_3d(context)
+
+        elif self.direction == 'OBJECT_ORIGIN':
+            self.pm.set_directions_from_object_origin(context.active_object)
+
+        else:
+            raise RuntimeError()
+
+    ################
+    def update_directions(self):
+        di = DIRECTION_INFO[self.direction]
+        if di.uniform_direction:
+            self.pm.directions = np.array(self.move_vector)[np.newaxis]
+
+    ################
+    def set_cursor(self, context):
+        di = DIRECTION_INFO[self.direction]
+        if di.uniform_direction:
+            context.window.cursor_modal_set('CROSS')
+        else:
+            context.window.cursor_modal_set('MOVE_Y')
+
+    ################
+    # 移動してよい要素を示す bool の配列を得る。変更しないこと
+    def get_which_to_move(self, context):
+        if self.m_prop.use_proportional:
+            return self.visible
+        else:
+            return self.visible_selected
+
+    ################
+    def invoke(self, context, event):
+        if context.area.type != 'VIEW_3D':
+            self.report({'WARNING'}, 'View3D not found, cannot run operator')
+            return {'CANCELLED'}
+
+        # Setup
+        prop = self.get_scene_prop(context)
+        self.m_prop.copy_from(prop)
+        self.direction = 'NONE'
+        self.number_input.set_expression('')
+        self.save_move_vector = None
+
+        # Setup proportional mover param
+        mesh = self.find_target_mesh(context)
+        if mesh:
+            self.m_prop.block_with_mesh_prop.target_mesh_name = mesh.name
+            self.m_prop.snap_onto_mesh_prop.target_mesh_name = mesh.name
+        hidden_meshes = []
+        if self.m_prop.use_block_with_mesh:
+            mesh = bpy.data.objects.get(self.m_prop.block_with_mesh_prop.target_mesh_name)
+            if mesh and mesh.type == 'MESH' and not mesh.visible_get():
+                hidden_meshes.append(mesh.name)
+        if self.m_prop.use_snap_onto_mesh:
+            mesh = bpy.data.objects.get(self.m_prop.snap_onto_mesh_prop.target_mesh_name)
+            if mesh and mesh.type == 'MESH' and not mesh.visible_get():
+                hidden_meshes.append(mesh.name)
+        if hidden_meshes:
+            self.report({'ERROR'},
+                        iface_('Meshes ({hidden_meshes}) are not visible.')\
+                        .format(hidden_meshes=str(hidden_meshes)))
+            return {'CANCELLED'}
+
+        # Get the elements to move
+        if not self.prepare(context):
+            return {'CANCELLED'}
+
+        # Start a new Undo step
+        bpy.ops.ed.undo_push(message=self.undo_message)
+        
+        # Set mouse cursor
+        self.set_cursor(context)
+
+        self.reset_movement(context)
+
+        # Register the drawing callback
+        args = (self, context)
+        self._handle = bpy.types.SpaceView3D.draw_handler_add(
+            self.draw_callback_pv, args, 'WINDOW', 'POST_VIEW'
+        )
+
+        self.prev_show_menus = context.area.show_menus
+
+        # Register the timer to evaluate mouse moves
+        self.pending_mouse_diff = None
+        self.enable_modifiers()
+        self._timer = context.window_manager.event_timer_add(
+            self.timer_interval, window=context.window)
+        self._timer_duration = self._timer.time_duration
+
+        context.workspace.status_text_set(
+            lambda header, context: self.status_text_fn(header, context))
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    ################
+    def execute(self, context):
+        # やり直しパネルからは invoke() を経ずに呼ばれる
+        if self.pm.orig_locations is None:
+            if not self.prepare(context):
+                return {'CANCELLED'}
+            self.set_directions(context)
+
+        prop = self.get_scene_prop(context)
+        prop.copy_from(self.m_prop)
+
+        self.pm.influence_radius = self.m_prop.influence_radius
+        self.pm.falloff_type = self.m_prop.falloff_type
+        self.update_distances()
+        self.update_directions()
+
+        self.pm.modifiers = []
+        if self.m_prop.use_block_with_mesh and not self.skip_modifiers:
+            mod = MeshBlockModifier(self.m_prop.block_with_mesh_prop)
+            self.pm.modifiers.append(mod)
+
+        if self.m_prop.use_snap_onto_mesh and not self.skip_modifiers:
+            mod = MeshSnapModifier(self.m_prop.snap_onto_mesh_prop)
+            self.pm.modifiers.append(mod)
+
+        move_vector = Vector(self.move_vector)
+        di = DIRECTION_INFO[self.direction]
+        if di.uniform_direction:
+            amount = move_vector.length
+        else:
+            amount = move_vector.z
+
+        # Compute locations
+        which_to_move = self.get_which_to_move(context)
+        locations, which_to_move, indices = \
+            self.pm.compute_move(amount, which_to_move)
+
+        self.apply_locations(context, locations, which_to_move, indices)
+        return {'FINISHED'}
+
+    ################
+    def cancel(self, context):
+        bpy.ops.ed.undo()
+        self.finish(context)
+        return {'CANCELLED'}
+
+    ################
+    def finish(self, context):
+        if context.area:
+            context.area.header_text_set(None)
+            context.area.show_menus = self.prev_show_menus
+            context.area.tag_redraw()
+
+        assert self._handle
+        bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+        self._handle = None
+        if self._timer:
+            context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+        context.window.cursor_modal_restore()
+        context.workspace.status_text_set(None)
+
+    ################
+    # モディファイアの省略をやめ、評価時間を測り直す
+    def enable_modifiers(self):
+        self.skip_modifiers = False
+        self.modifier_times = None
+
+    ################
+    def evaluate(self, context):
+        """
+        溜まったマウス移動量を反映して execute() する。
+        直近の評価に時間がかかりすぎている場合は、以降のドラッグ中は
+        モディファイアを省略する
+        """
+        if self.pending_mouse_diff is not None:
+            # Compute mouse movement and get move vector
+            vec = self.compute_mouse_move(context, self.pending_mouse_diff)
+            if self.pending_shift: vec *= 0.1
+            self.move_vector = Vector(self.move_vector) + vec
+            self.pending_mouse_diff = None
+
+        start = time.perf_counter()
+        self.execute(context)
+        if not self.pm.modifiers:
+            return
+
+        elapsed = time.perf_counter() - start
+        if self.modifier_times is None:
+            # レイキャスタを作成した最初の評価は数えない
+            self.modifier_times = []
+            return
+        self.modifier_times = self.modifier_times[1 - self.time_window:] + [elapsed]
+        if len(self.modifier_times) >= self.time_window and\
+           np.mean(self.modifier_times) > self.time_budget:
+            self.skip_modifiers = True
+
+    ################
+    def modal(self, context, event):
+        # 溜まったマウス移動は、前回の評価が終わってからまとめて評価する
+        if event.type == 'TIMER':
+            # 他のタイマーのイベントでは、自分のタイマーの経過時間が変わらない
+            duration = self._timer.time_duration
+            if duration == self._timer_duration:
+                return {'PASS_THROUGH'}
+            self._timer_duration = duration
+
+            if self.pending_mouse_diff is not None:
+                self.evaluate(context)
+                context.area.tag_redraw()
+            return {'RUNNING_MODAL'}
+
+        context.area.tag_redraw()
+
+        ####
+        # Process NumberInput and confirm/cancel
+
+        if self.number_input.process_event(event):
+            if self.save_move_vector is None:
+                self.save_move_vector = Vector(self.move_vector)
+            try:
+                amount = self.number_input.get_value()
+                norm = self.save_move_vector.length
+                if norm < 1e-8:
+                    move_vector = self.get_direction_unit(context) * amount
+                else:
+                    move_vector = self.save_move_vector * amount / norm
+                self.move_vector = move_vector
+            except:
+                if not self.number_input.is_processing():
+                    self.move_vector = self.save_move_vector
+
+            self.execute(context)
+            return {'RUNNING_MODAL'}
+
+        elif event.type in {'LEFTMOUSE', 'SPACE', 'RET', 'NUMPAD_ENTER'}:
+            # 残りのマウス移動と、ドラッグ中に省略したモディファイアを適用する
+            if self.pending_mouse_diff is not None or self.skip_modifiers:
+                self.enable_modifiers()
+                self.evaluate(context)
+            self.finish(context)
+            return {'FINISHED'}
+
+        elif event.type in {'RIGHTMOUSE', 'ESC'}:
+            return self.cancel(context)
+
+        elif self.number_input.is_processing():
+            return {'RUNNING_MODAL'}
+
+        self.save_move_vector = None
+
+        pressed = not event.is_repeat and event.value == 'PRESS'
+
+        ####
+        # Process menus/tools
+
+        if event.type == 'O' and event.shift and pressed:
+            bpy.ops.wm.call_menu_pie(name=self.falloff_menu)
+            return {'RUNNING_MODAL'}
+
+        elif event.type == 'G' and not event.shift and pressed:
+            self.cancel(context)
+            bpy.ops.transform.translate('INVOKE_DEFAULT')
+            return {'CANCELLED'}
+
+        elif event.type == 'R' and not event.shift and pressed:
+            self.cancel(context)
+            bpy.ops.transform.rotate('INVOKE_DEFAULT')
+            return {'CANCELLED'}
+
+        elif event.type == 'S' and not event.shift and pressed:
+            self.cancel(context)
+            bpy.ops.transform.resize('INVOKE_DEFAULT')
+            return {'CANCELLED'}
+
+        ####
+        # Process others
+
+        falloff_type = self.get_scene_prop(context).falloff_type
+        if self.m_prop.falloff_type != falloff_type:
+            self.m_prop.falloff_type = falloff_type
+            update = True
+        else:
+            update = False
+
+        drag = False
+        if event.type == 'MOUSEMOVE':
+            drag = True
+
+        elif event.type in {'WHEELDOWNMOUSE', 'PAGE_UP', 'D'} and event.value == 'PRESS':
+            self.m_prop.influence_radius *= 1.1
+            update = True
+
+        elif event.type in {'WHEELUPMOUSE', 'PAGE_DOWN', 'A'} and event.value == 'PRESS':
+            self.m_prop.influence_radius /= 1.1
+            update = True
+
+        elif event.type in {'MIDDLEMOUSE', 'W'} and pressed:
+            range = iu.calculate_mouse_range_at_pivot(context)
+            self.m_prop.influence_radius = min(range) * .3
+            update=True
+
+        elif event.type in {'X', 'Y', 'Z', 'V', 'C'} and pressed:
+            self.direction = get_next_direction(self.direction, event.ascii)
+            self.set_cursor(context)
+            self.reset_movement(context)
+            update = True
+
+        elif event.type == 'O' and event.alt and pressed:
+            self.m_prop.use_connected ^= True
+            update = True
+
+        elif event.type == 'O' and not event.shift and pressed:
+            self.m_prop.use_proportional ^= True
+            update = True
+
+        elif event.type == 'S' and event.shift and pressed:
+            self.m_prop.use_snap_onto_mesh ^= True
+            self.enable_modifiers()
+            update = True
+
+        elif event.type == 'B' and event.shift and pressed:
+            self.m_prop.use_block_with_mesh ^= True
+            self.enable_modifiers()
+            update = True
+
+        if update or drag:
+            mouse_diff = Vector((event.mouse_x - event.mouse_prev_x,
+                                 event.mouse_y - event.mouse_prev_y))
+            if self.pending_mouse_diff is None:
+                self.pending_mouse_diff = mouse_diff
+            else:
+                self.pending_mouse_diff += mouse_diff
+            self.pending_shift = event.shift
+
+        # マウス移動だけならタイマーで評価する
+        if update:
+            self.evaluate(context)
+
+        return {'RUNNING_MODAL'}
+
+    def draw(self, context):
+        mesh = iu.findfirst_selected_object('MESH')
+        col = self.layout.column(align=False)
+        self.m_prop.draw(context, col, show_connected=self.supports_connected)
+        col.prop(self, 'move_vector')
+
 ################################################################
 classes = (
     DDDPM_MeshSnapModifier_pg,
     DDDPM_MeshBlockModifier_pg,
+    DDDPM_ProportionalMove_pg,
+    DDDPM_OT_Falloff,
 )
 
 def registerClass():
@@ -1,11 +1,9 @@
 # -*- encoding:utf-8 -*-
 
 import bpy
+from bpy.app.handlers import persistent
 from bpy.props import PointerProperty, CollectionProperty, StringProperty, EnumProperty, BoolProperty, IntProperty, FloatProperty, FloatVectorProperty
 from bpy.types import Menu, Panel, Operator, PropertyGroup
-import gpu
-from bpy_extras import view3d_utils
-from gpu_extras.batch import batch_for_shader
 import math
 from mathutils import (
     Vector,
@@ -334,72 +332,6 @@ class DDDBT_adjustBendyBoneSize_propertyGroup(PropertyGroup):
         self.ratio_x = src.ratio_x
         self.use_segments = src.use_segments
 
-################
-class DDDBT_poseProportionalMove_propertyGroup(PropertyGroup):
-    use_proportional: BoolProperty(
-        name=_('Use Proportional'),
-        description=_('Specifies whether to move proportionally. If unchecked, no proportional movement is performed and only the selected bone is moved.'),
-        default=True,
-    )
-
-    falloff_type: mu.get_falloff_enum()
-    
-    influence_radius: FloatProperty(
-        name=_('Influence Radius'),
-        description=_('Specify the range of influence of the proportional move.'),
-        min=1e-9,
-        default=1.0,
-    )
-
-    use_block_with_mesh: BoolProperty(
-        name=_('Block with mesh'),
-        description=_('Specifies whether to stop at the surface of the specified mesh.'),
-        default=False)
-    display_block_with_mesh: BoolProperty(default=False)
-    block_with_mesh_prop: PointerProperty(type=pm.DDDPM_MeshBlockModifier_pg)
-
-    use_snap_onto_mesh: BoolProperty(
-        name=_('Snap to mesh'),
-        description=_('Specifies whether to fly rays from the camera and snap them to the surface of the specified mesh.'),
-        default=False)
-    display_snap_onto_mesh: BoolProperty(default=False)
-    snap_onto_mesh_prop: PointerProperty(type=pm.DDDPM_MeshSnapModifier_pg)
-
-    def draw(self, context, layout):
-        col = layout.column(align=False)
-        col.prop(self, 'use_proportional')
-        box = col.box()
-        box.enabled = self.use_proportional
-        box.prop(self, 'falloff_type')
-        box.prop(self, 'influence_radius')
-
-        display, split = ui.splitSwitch(col, self, 'display_block_with_mesh')
-        split.prop(self, 'use_block_with_mesh')
-        if display:
-            box = col.box()
-            box.enabled = self.use_block_with_mesh
-            self.block_with_mesh_prop.draw(context, box)
-    
-        display, split = ui.splitSwitch(col, self, 'display_snap_onto_mesh')
-        split.prop(self, 'use_snap_onto_mesh')
-        if display:
-            box = col.box()
-            box.enabled = self.use_snap_onto_mesh
-            self.snap_onto_mesh_prop.draw(context, box)
-    
-    def copy_from(self, src):
-        self.use_proportional = src.use_proportional
-        self.falloff_type = src.falloff_type
-        self.influence_radius = src.influence_radius
-
-        self.use_block_with_mesh = src.use_block_with_mesh
-        #self.display_block_with_mesh = src.display_block_with_mesh
-        self.block_with_mesh_prop.copy_from(src.block_with_mesh_prop)
-
-        self.use_snap_onto_mesh = src.use_snap_onto_mesh
-        #self.display_snap_onto_mesh = src.display_snap_onto_mesh
-        self.snap_onto_mesh_prop.copy_from(src.snap_onto_mesh_prop)
-
 ################
 class DDDBT_propertyGroup(PropertyGroup):
     display_createBonesFromSelectedEdges: BoolProperty(default=False)
@@ -432,7 +364,7 @@ class DDDBT_propertyGroup(PropertyGroup):
 
     display_poseProportionalMove: BoolProperty(default=False)
     poseProportionalMoveProp: PointerProperty(
-        type=DDDBT_poseProportionalMove_propertyGroup)
+        type=pm.DDDPM_ProportionalMove_pg)
 
 ################
 class DDDBT_OT_renameChildBonesWithNumber(Operator):
@@ -866,13 +798,13 @@ class DDDBT_OT_adjustBendyBoneSize(Operator):
         self.m_prop.draw(self.layout)
 
 ################
-class DDDBT_OT_poseProportionalMove(Operator):
+class DDDBT_OT_poseProportionalMove(pm.ProportionalMoveOperator, Operator):
     bl_idname = 'pose.dddbt_pose_proportional_move'
     bl_label = _('Pose Proportional Move')
     bl_description = _('Proportionally move the pose bone.')
     bl_options = {'REGISTER', 'UNDO', 'GRAB_CURSOR', 'BLOCKING'}
 
-    m_prop: PointerProperty(type=DDDBT_poseProportionalMove_propertyGroup)
+    m_prop: PointerProperty(type=pm.DDDPM_ProportionalMove_pg)
 
     move_vector: FloatVectorProperty(
         name=_('Move Vector'),
@@ -886,463 +818,57 @@ class DDDBT_OT_poseProportionalMove(Operator):
 
     direction: pm.get_direction_enum()
 
+    scene_prop_path = 'dddtools_bt_prop.poseProportionalMoveProp'
+    falloff_menu = 'DDDBT_MT_Falloff'
+    undo_message = 'Proportional Pose Editing'
+    supports_connected = True
+
     ################
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # プロポーショナル移動するクラス
-        self.pm = pm.ProportionalMover()
-
         # bone.matrix.translation の保存
         self.bone_translations = None
 
-        # 描画ハンドル
-        self._handle = None
-
-        # context.area.show_menus の保存
-        self.prev_show_menus = None
-
-        # center_location のあるべき位置をマウス座標に変換したもの
-        self.mouse_xy = None
-
-        # center_location のあるべき位置の保存
-        self.prev_center_location = None
-
-        # 数値入力
-        self.number_input = iu.NumberInput()
-
-        # 数値入力開始時の move_vector
-        self.save_move_vector = None
-
-    ################
-    # 方向ベクトルまたは法線ベクトルを得る
-    def get_direction_vector(self, context):
-        di = pm.DIRECTION_INFO[self.direction]
-        if di.constant_direction:
-            return di.vector
-
-        elif di.uniform_direction:
-            row = di.row_index
-            assert row >= 0, f'Illegal direction: {self.direction}'
-            mtx = np.array(context.active_object.matrix_world)
-            return Vector(mtx[:3, row])
-
-        else:
-            raise RuntimeError()
-
-    ################
-    # 基本の単位ベクトルを得る
-    def get_direction_unit(self, context):
-        di = pm.DIRECTION_INFO[self.direction]
-
-        if not di.uniform_direction:    return Vector((0, 0, 1))
-        if di.normal_direction:         return Vector()
-        if di.constant_direction:       return di.vector
-
-        if self.direction in {'LOCAL_X', 'LOCAL_Y', 'LOCAL_Z'}:
-            mtx = np.array(context.active_object.matrix_world)
-            return Vector(mtx[:3, di.row])
-
-        return Vector()
-
-    ################
-    def compute_mouse_move(self, context, mouse_diff):
-        self.mouse_xy += mouse_diff
-        center_location = Vector(self.pm.center_location)
-
-        # Get the 3D location that corresponds to the new mouse position
-        if self.direction == 'NONE':
-            new_location = view3d_utils.region_2d_to_location_3d(
-                context.region, context.region_data,
-                self.mouse_xy, center_location)
-
-        elif self.direction in {'GLOBAL_YZ', 'GLOBAL_ZX', 'GLOBAL_XY',
-                                'LOCAL_YZ', 'LOCAL_ZX', 'LOCAL_XY'}:
-            vec = self.get_direction_vector(context)
-            new_location = iu.calculate_mouse_ray_plane_intersection(
-                context, self.mouse_xy, center_location, vec)
-
-        elif self.direction in {'GLOBAL_X', 'GLOBAL_Y', 'GLOBAL_Z',
-                                'LOCAL_X', 'LOCAL_Y', 'LOCAL_Z'}:
-            vec = self.get_direction_vector(context)
-            new_location = iu.calculate_mouse_ray_line_intersection(
-                context, self.mouse_xy, center_location, vec)
-
-        elif self.direction in {'LOCAL_EACH_X', 'LOCAL_EACH_Y', 'LOCAL_EACH_Z',
-                                'VIEW_CAMERA', 'VIEW_PIVOT',
-                                'CURSOR_3D', 'OBJECT_ORIGIN'}:
-            unit = iu.calculate_mouse_move_unit(context, center_location)
-            vec = Vector((0, 0, mouse_diff.y * unit))
-            if self.prev_center_location:
-                new_location = self.prev_center_location + vec
-            else:
-                new_location = view3d_utils.region_2d_to_location_3d(
-                    context.region, context.region_data,
-                    self.mouse_xy, center_location) + vec
-
-        else:
-            raise RuntimeError()
-
-        if self.prev_center_location:
-            diff = new_location - self.prev_center_location
-        else:
-            diff = Vector()
-
-        self.prev_center_location = new_location
-        return diff
+        # 左右反転した骨のインデックス
+        self.flipped_indices = None
 
     ################
-    @staticmethod
-    def draw_callback_pv(self, context):
-        # Set the header text
-        move_vector = Vector(self.move_vector)
-        if self.number_input.is_processing():
-            length = self.number_input.get_display()
-        else:
-            length = f'{move_vector.length:.4f}'
-        move_vector.normalize()
-        txt = f'({move_vector.x:.4f}, {move_vector.y:.4f}, {move_vector.z:.4f}) ({length} m)   Direction: {self.direction}'
-        if self.m_prop.use_proportional:
-            txt += f'   Falloff: {self.m_prop.falloff_type}   Radius: {self.m_prop.influence_radius:.4f} m'
-        if self.m_prop.use_block_with_mesh:
-            txt += f'   Block({self.m_prop.block_with_mesh_prop.target_mesh_name})'
-        if self.m_prop.use_snap_onto_mesh:
-            txt += f'   Snap({self.m_prop.snap_onto_mesh_prop.target_mesh_name})'
-
-        context.area.header_text_set(txt)
-        context.area.tag_redraw()
-
-        # Define the shader
-        if bpy.app.version < (4, 0, 0):
-            shader = gpu.shader.from_builtin('3D_UNIFORM_COLOR')
-        else:
-            shader = gpu.shader.from_builtin('UNIFORM_COLOR')
-        shader.bind()
-
-        if not self.number_input.is_processing():
-            arma = context.active_object
-            center_location = self.pm.center_location
-
-            colors = []
-            locations = np.empty((0, 3))
-            directions = np.empty((0, 3))
-
-            di = pm.DIRECTION_INFO[self.direction]
-
-            if not di.uniform_direction:
-                COLOR_TABLE = {
-                    'LOCAL_EACH_X': (1, 0, 0, 0.3),
-                    'LOCAL_EACH_Y': (0, 1, 0, 0.3),
-                    'LOCAL_EACH_Z': (0, 0, 1, 0.3),
-                    'VIEW_CAMERA':  (0, 1, 1, 0.3),
-                    'VIEW_PIVOT':   (1, 0, 1, 0.3),
-                    'CURSOR_3D':    (1, 1, 1, 0.3),
-                    'OBJECT_ORIGIN':(1, 1, 0, 0.3),
-                }
-                locations = self.pm.orig_locations
-                directions = self.pm.directions
-                colors = np.tile(COLOR_TABLE[self.direction],
-                                 (locations.shape[0], 1))
-
-                which_to_move = np.logical_and(self.pm.factors > pm.EPSILON,
-                                               self.get_which_to_move(context))
-                locations = locations[which_to_move]
-                directions = directions[which_to_move]
-                colors = colors[which_to_move].tolist()
-
-            if self.direction in {'GLOBAL_X', 'GLOBAL_ZX', 'GLOBAL_XY'}:
-                colors.append((1, 0, 0, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [np.array((1, 0, 0))])
-                
-            if self.direction in {'GLOBAL_Y', 'GLOBAL_XY', 'GLOBAL_YZ'}:
-                colors.append((0, 1, 0, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [np.array((0, 1, 0))])
-                
-            if self.direction in {'GLOBAL_Z', 'GLOBAL_YZ', 'GLOBAL_ZX'}:
-                colors.append((0, 0, 1, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [np.array((0, 0, 1))])
-
-            mtx = np.array(arma.matrix_world)
-
-            if self.direction in {'LOCAL_X', 'LOCAL_ZX', 'LOCAL_XY'}:
-                colors.append((1, 0, 0, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [mtx[:3, 0]])
-                
-            if self.direction in {'LOCAL_Y', 'LOCAL_XY', 'LOCAL_YZ'}:
-                colors.append((0, 1, 0, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [mtx[:3, 1]])
-                
-            if self.direction in {'LOCAL_Z', 'LOCAL_YZ', 'LOCAL_ZX'}:
-                colors.append((0, 0, 1, 0.5))
-                locations = np.append(locations, [center_location])
-                directions = np.append(directions, [mtx[:3, 2]])
-            
-            if colors:
-                # (n, 1, 3) の形状にリシェイプ
-                locations = np.reshape(locations, (-1, 1, 3))
-                directions = np.reshape(directions, (-1, 1, 3))
-
-                unit = max(iu.calculate_mouse_range_at_pivot(context))
-                weights = np.linspace(-unit, unit, 10)
-
-                # weights を (1, m, 1) の形状にリシェイプ
-                weights = np.reshape(weights, (1, -1, 1))
-
-                # locations[i] + directions[i] * weights の計算
-                points = locations + directions * weights  # (n, m, 3) の配列
-
-                with iu.BlenderGpuState(blend='ALPHA', line_width=2.0):
-                    for strip, color in zip(points.tolist(), colors):
-                        shader.uniform_float('color', color)
-                        batch = batch_for_shader(shader,
-                                                 'LINE_STRIP',
-                                                 {'pos': strip})
-                        batch.draw(shader)
-
-            # Draw influence_radius
-            if self.m_prop.use_proportional:
-                view_matrix = np.array(context.region_data.view_matrix)
-                angles = np.linspace(0, 2*np.pi, 60)
-                radius = self.m_prop.influence_radius
-                circle_verts = np.stack(
-                    [radius * np.cos(angles),
-                     radius * np.sin(angles),
-                     np.zeros_like(angles)], axis=-1)
-                inv = np.linalg.inv(view_matrix)
-                points = center_location + circle_verts @ inv.T[:3, :3]
-                with iu.BlenderGpuState(blend='ALPHA', line_width=4.0):
-                    shader.uniform_float('color', (0.1, 0.1, 0.1, 0.8))
-                    batch = batch_for_shader(shader, 'LINE_LOOP',
-                                             {'pos': points.tolist()})
-                    batch.draw(shader)
-
-    ################
-    @staticmethod
-    def status_text_fn(self, context):
-        row = self.layout.row(align=True)
-
-        row.label(text='Confirm', icon='MOUSE_LMB')
-        row.label(text='Cancel', icon='MOUSE_RMB')
-
-        row.label(text='X Axis', icon='EVENT_X')
-        row.label(text='Y Axis', icon='EVENT_Y')
-        row.label(text='Z Axis', icon='EVENT_Z')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='X Plane', icon='EVENT_X')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='Y Plane', icon='EVENT_Y')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='Z Plane', icon='EVENT_Z')
-
-        row.label(text='Cursor / Origin', icon='EVENT_C')
-        row.label(text='Pivot / Camera', icon='EVENT_V')
-
-        row.label(icon='MOUSE_MMB')
-        row.label(icon='EVENT_W')
-        row.label(icon='EVENT_A')
-        row.label(icon='EVENT_D', text='Radius')
-
-        row.label(text='Proportional On/Off', icon='EVENT_O')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='Falloff type', icon='EVENT_O')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='Snap On/Off', icon='EVENT_S')
-
-        row.label(icon='EVENT_SHIFT')
-        row.label(text='Block On/Off', icon='EVENT_B')
-
-        row.label(text='Precision Mode', icon='EVENT_SHIFT')
-
-        row.label(text='Move', icon='EVENT_G')
-        row.label(text='Rotate', icon='EVENT_R')
-        row.label(text='Resize', icon='EVENT_S')
-
-    ################
-    def reset_movement(self, context):
-        self.pm.reset_movement()
-        self.set_directions(context)
-        self.mouse_xy = view3d_utils.location_3d_to_region_2d(
-            context.region, context.region_data, self.pm.center_location)
-        self.prev_center_location = None
-        self.move_vector = Vector()
-
-    ################
-    def set_directions(self, context):
-        di = pm.DIRECTION_INFO[self.direction]
-        if di.uniform_direction:
-            self.pm.directions = np.array(self.move_vector)[np.newaxis]
-
-        elif not di.global_direction:
-            armature = context.active_object
-            self.pm.set_directions_local(self.direction, armature)
-
-        elif self.direction == 'VIEW_CAMERA':
-            self.pm.set_directions_from_view_camera()
-
-        elif self.direction == 'VIEW_PIVOT':
-            self.pm.set_directions_from_view_pivot()
-
-        elif self.direction == 'CURSOR_3D':
-            self.pm.set_directions_from_cursor_3d(context)
-
-        elif self.direction == 'OBJECT_ORIGIN':
-            armature = context.active_object
-            self.pm.set_directions_from_object_origin(armature)
-
-        else:
-            raise RuntimeError()
-
-    ################
-    def update_directions(self):
-        di = pm.DIRECTION_INFO[self.direction]
-        if di.uniform_direction:
-            self.pm.directions = np.array(self.move_vector)[np.newaxis]
-
-    ################
-    def set_cursor(self, context):
-        di = pm.DIRECTION_INFO[self.direction]
-        if di.uniform_direction:
-            context.window.cursor_modal_set('CROSS')
-        else:
-            context.window.cursor_modal_set('MOVE_Y')
-
-    ################
-    def get_which_to_move(self, context):
-        armature = context.active_object
-        visible_bones = np.array([bt.is_bone_visible(b.bone)
-                                  for b in armature.pose.bones], dtype=bool)
-        if self.m_prop.use_proportional:
-           which_to_move = visible_bones
-        else:
-            selected_bones = np.array(
-                [b.bone.select for b in armature.pose.bones], dtype=bool)
-            which_to_move = np.logical_and(visible_bones, selected_bones)
-        return which_to_move
-
-    ################
-    def invoke(self, context, event):
-        if context.area.type != 'VIEW_3D':
-            self.report({'WARNING'}, 'View3D not found, cannot run operator')
-            return {'CANCELLED'}
-
+    # 骨の表示・選択状態を保存し、骨のワールド座標を得る。
+    # モーダル中は変化しないので、開始時にのみ呼ぶ
+    def setup_elements(self, context):
         armature = context.active_object
         if not armature or armature.type != 'ARMATURE':
             self.report({'WARNING'}, 'Armature is not active.')
-            return {'CANCELLED'}
+            return None
 
         # Get if bone is selected
-        is_selected_bones = np.array(
-            [b.bone.select and bt.is_bone_visible(b.bone)
-             for b in armature.pose.bones], dtype=bool)
-        if not np.any(is_selected_bones):
+        self.visible, self.selected = bt.get_bone_visibility(armature)
+        if not np.any(self.visible & self.selected):
             self.report({'WARNING'}, 'No bones selected')
-            return {'CANCELLED'}
-
-        # Setup
-        prop = context.scene.dddtools_bt_prop
-        self.m_prop.copy_from(prop.poseProportionalMoveProp)
-        self.direction = 'NONE'
-        self.number_input.set_expression('')
-        self.save_move_vector = None
-
-        # Setup proportional mover param
-        mesh = iu.findfirst_selected_object('MESH')
-        if mesh:
-            self.m_prop.block_with_mesh_prop.target_mesh_name = mesh.name
-            self.m_prop.snap_onto_mesh_prop.target_mesh_name = mesh.name
-        hidden_meshes = []
-        if self.m_prop.use_block_with_mesh:
-            mesh = bpy.data.objects.get(self.m_prop.block_with_mesh_prop.target_mesh_name)
-            if mesh and mesh.type == 'MESH' and not mesh.visible_get():
-                hidden_meshes.append(mesh.name)
-        if self.m_prop.use_snap_onto_mesh:
-            mesh = bpy.data.objects.get(self.m_prop.snap_onto_mesh_prop.target_mesh_name)
-            if mesh and mesh.type == 'MESH' and not mesh.visible_get():
-                hidden_meshes.append(mesh.name)
-        if hidden_meshes:
-            self.report({'ERROR'},
-                        iface_('Meshes ({hidden_meshes}) are not visible.')\
-                        .format(hidden_meshes=str(hidden_meshes)))
-            return {'CANCELLED'}
-
-        # Start a new Undo step
-        bpy.ops.ed.undo_push(message='Proportional Pose Editing')
-        
-        # Set mouse cursor
-        self.set_cursor(context)
+            return None
+        self.flipped_indices = bt.get_armature_topology(armature).flip_indices
 
         # Save translations
-        self.bone_translations = np.array([
-            np.array(bone.matrix.translation)
-            for bone in armature.pose.bones
-        ])
+        self.bone_translations = \
+            bt.get_bone_matrices(armature.pose.bones, 'matrix')[:, :3, 3]
 
         # Compute current locations in world coordinate
         bone_translations_homo = \
             mu.append_homogeneous_coordinate(self.bone_translations)
-        locations =\
-            (bone_translations_homo @ np.array(armature.matrix_world).T)[:, :3]
-        
-        # setup ProportionalMover
-        self.pm.setup(context.space_data, locations, is_selected_bones)
-        self.reset_movement(context)
-
-        # Register the drawing callback
-        args = (self, context)
-        self._handle = bpy.types.SpaceView3D.draw_handler_add(
-            self.draw_callback_pv, args, 'WINDOW', 'POST_VIEW'
-        )
-
-        self.prev_show_menus = context.area.show_menus
-
-        context.workspace.status_text_set(self.status_text_fn)
-        context.window_manager.modal_handler_add(self)
-        return {'RUNNING_MODAL'}
+        return (bone_translations_homo @ np.array(armature.matrix_world).T)[:, :3]
 
     ################
-    @classmethod
-    def poll(self, context):
-        return bt.get_selected_bone_names() and bpy.context.mode == 'POSE'
+    def set_directions_local(self, context):
+        self.pm.set_directions_local(self.direction, context.active_object)
 
     ################
-    def execute(self, context):
-        prop = context.scene.dddtools_bt_prop
-        prop.poseProportionalMoveProp.copy_from(self.m_prop)
-
-        self.pm.influence_radius = self.m_prop.influence_radius
-        self.pm.falloff_type = self.m_prop.falloff_type
-        self.update_directions()
-
-        self.pm.modifiers = []
-        if self.m_prop.use_block_with_mesh:
-            mod = pm.MeshBlockModifier(self.m_prop.block_with_mesh_prop)
-            self.pm.modifiers.append(mod)
-
-        if self.m_prop.use_snap_onto_mesh:
-            mod = pm.MeshSnapModifier(self.m_prop.snap_onto_mesh_prop)
-            self.pm.modifiers.append(mod)
-
-        move_vector = Vector(self.move_vector)
-        di = pm.DIRECTION_INFO[self.direction]
-        if di.uniform_direction:
-            amount = move_vector.length
-        else:
-            amount = move_vector.z
-
-        # Compute locations
-        which_to_move = self.get_which_to_move(context)
-        locations, which_to_move = self.pm.compute_move(amount, which_to_move)
+    def compute_connected_distances(self, context, locations, selection):
+        return bt.compute_hierarchy_distances(context.active_object,
+                                              locations, selection)
 
+    ################
+    def apply_locations(self, context, locations, which_to_move, indices):
         # Compute local translations
         armature = context.active_object
         locations_homo = mu.append_homogeneous_coordinate(locations)
@@ -1358,186 +884,24 @@ class DDDBT_OT_poseProportionalMove(Operator):
             translations, mirror_bones = bt.pose_mirror_x_translations(
                 armature,
                 translations,
-                which_to_move)
-            which_to_move |= mirror_bones
+                which_to_move,
+                flipped_indices=self.flipped_indices,
+                visible_bones=self.visible)
+            which_to_move = which_to_move | mirror_bones
 
         # Set translation
         bt.set_translations(armature, translations, which_to_move)
 
         armature.pose.bones.update()
-        return {'FINISHED'}
-
-    ################
-    def cancel(self, context):
-        bpy.ops.ed.undo()
-        self.finish(context)
-        return {'CANCELLED'}
-
-    ################
-    def finish(self, context):
-        if context.area:
-            context.area.header_text_set(None)
-            context.area.show_menus = self.prev_show_menus
-            context.area.tag_redraw()
-
-        assert self._handle
-        bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
-        self._handle = None
-        context.window.cursor_modal_restore()
-        context.workspace.status_text_set(None)
 
     ################
-    def modal(self, context, event):
-        context.area.tag_redraw()
-
-        ####
-        # Process NumberInput and confirm/cancel
-
-        if self.number_input.process_event(event):
-            if self.save_move_vector is None:
-                self.save_move_vector = Vector(self.move_vector)
-            try:
-                amount = self.number_input.get_value()
-                norm = self.save_move_vector.length
-                if norm < 1e-8:
-                    move_vector = self.get_direction_unit(context) * amount
-                else:
-                    move_vector = self.save_move_vector * amount / norm
-                self.move_vector = move_vector
-            except:
-                if not self.number_input.is_processing():
-                    self.move_vector = self.save_move_vector
-
-            self.execute(context)
-            return {'RUNNING_MODAL'}
-
-        elif event.type in {'LEFTMOUSE', 'SPACE', 'RET', 'NUMPAD_ENTER'}:
-            self.finish(context)
-            return {'FINISHED'}
-
-        elif event.type in {'RIGHTMOUSE', 'ESC'}:
-            return self.cancel(context)
-
-        elif self.number_input.is_processing():
-            return {'RUNNING_MODAL'}
-
-        self.save_move_vector = None
-
-        pressed = not event.is_repeat and event.value == 'PRESS'
-
-        ####
-        # Process menus/tools
-
-        if event.type == 'O' and event.shift and pressed:
-            bpy.ops.wm.call_menu_pie(name='DDDBT_MT_Falloff')
-            return {'RUNNING_MODAL'}
-
-        elif event.type == 'G' and not event.shift and pressed:
-            self.cancel(context)
-            bpy.ops.transform.translate('INVOKE_DEFAULT')
-            return {'CANCELLED'}
-
-        elif event.type == 'R' and not event.shift and pressed:
-            self.cancel(context)
-            bpy.ops.transform.rotate('INVOKE_DEFAULT')
-            return {'CANCELLED'}
-
-        elif event.type == 'S' and not event.shift and pressed:
-            self.cancel(context)
-            bpy.ops.transform.resize('INVOKE_DEFAULT')
-            return {'CANCELLED'}
-
-        ####
-        # Process others
-
-        prop = context.scene.dddtools_bt_prop
-        falloff_type = prop.poseProportionalMoveProp.falloff_type
-        if self.m_prop.falloff_type != falloff_type:
-            self.m_prop.falloff_type = falloff_type
-            update = True
-        else:
-            update = False
-
-        if event.type == 'MOUSEMOVE':
-            update = True
-
-        elif event.type in {'WHEELDOWNMOUSE', 'PAGE_UP', 'D'} and event.value == 'PRESS':
-            self.m_prop.influence_radius *= 1.1
-            update = True
-
-        elif event.type in {'WHEELUPMOUSE', 'PAGE_DOWN', 'A'} and event.value == 'PRESS':
-            self.m_prop.influence_radius /= 1.1
-            update = True
-
-        elif event.type in {'MIDDLEMOUSE', 'W'} and pressed:
-            range = iu.calculate_mouse_range_at_pivot(context)
-            self.m_prop.influence_radius = min(range) * .3
-            update=True
-
-        elif event.type in {'X', 'Y', 'Z', 'V', 'C'} and pressed:
-            self.direction = pm.get_next_direction(self.direction, event.ascii)
-            self.set_cursor(context)
-            self.reset_movement(context)
-            update = True
-
-        elif event.type == 'O' and not event.shift and pressed:
-            self.m_prop.use_proportional ^= True
-            update = True
-
-        elif event.type == 'S' and event.shift and pressed:
-            self.m_prop.use_snap_onto_mesh ^= True
-            update = True
-
-        elif event.type == 'B' and event.shift and pressed:
-            self.m_prop.use_block_with_mesh ^= True
-            update = True
-
-        if update:
-            mouse_diff = Vector((event.mouse_x - event.mouse_prev_x,
-                                 event.mouse_y - event.mouse_prev_y))
-
-            # Compute mouse movement and get move vector
-            vec = self.compute_mouse_move(context, mouse_diff)
-            if event.shift: vec *= 0.1
-            self.move_vector = Vector(self.move_vector) + vec
-
-            self.execute(context)
-
-        return {'RUNNING_MODAL'}
-
-    def draw(self, context):
-        mesh = iu.findfirst_selected_object('MESH')
-        col = self.layout.column(align=False)
-        self.m_prop.draw(context, col)
-        col.prop(self, 'move_vector')
-
-################
-# パイメニューの項目を選択するためのオペレーター
-class DDDBT_OT_Falloff(Operator):
-    bl_idname = "scene.dddbt_select_falloff"
-    bl_label = "Select Falloff"
-    bl_options = {'INTERNAL'}
-    falloff_type: StringProperty()
-
-    def execute(self, context):
-        prop = context.scene.dddtools_bt_prop
-        prop.poseProportionalMoveProp.falloff_type = self.falloff_type
-        return {'FINISHED'}
+    @classmethod
+    def poll(self, context):
+        return bt.get_selected_bone_names() and bpy.context.mode == 'POSE'
 
 ################
-class DDDBT_MT_Falloff(Menu):
-    bl_label = "Select Falloff Type"
-
-    def draw(self, context):
-        layout = self.layout
-        pie = layout.menu_pie()
-
-        falloff_items = mu.get_falloff_enum().keywords['items']
-        for falloff_item in falloff_items:
-            op = pie.operator(DDDBT_OT_Falloff.bl_idname,
-                              text=falloff_item[1],
-                              icon=falloff_item[3])
-            op.falloff_type = falloff_item[0]
+class DDDBT_MT_Falloff(pm.FalloffPieMenu, Menu):
+    data_path = 'dddtools_bt_prop.poseProportionalMoveProp'
 
 ################
 class DDDBT_PT_BoneTool(Panel):
@@ -1578,7 +942,7 @@ class DDDBT_PT_BoneTool(Panel):
         split.operator(DDDBT_OT_poseProportionalMove.bl_idname)
         if display:
             box = col.box()
-            prop.poseProportionalMoveProp.draw(context, box)
+            prop.poseProportionalMoveProp.draw(context, box, show_connected=True)
 
         col.separator()
 
@@ -1630,7 +994,6 @@ classes = (
     DDDBT_buildHandleFromBones_propertyGroup,
     DDDBT_changeBoneLengthDirection_propertyGroup,
     DDDBT_adjustBendyBoneSize_propertyGroup,
-    DDDBT_poseProportionalMove_propertyGroup,
     DDDBT_propertyGroup,
     DDDBT_OT_renameChildBonesWithNumber,
     DDDBT_OT_renameBonesForSymmetry,
@@ -1647,18 +1010,43 @@ classes = (
     DDDBT_OT_changeBoneLengthDirection,
     DDDBT_OT_adjustBendyBoneSize,
     DDDBT_OT_poseProportionalMove,
-    DDDBT_OT_Falloff,
     DDDBT_MT_Falloff,
     DDDBT_PT_BoneTool,
 )
 
+################################################################
+# 骨の階層構造のキャッシュを、骨が変更されたら破棄する
+@persistent
+def clearArmatureTopologyOnUpdate(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Armature):
+            bt.clear_armature_topology(update.id.original)
+
+@persistent
+def clearArmatureTopology(*args):
+    bt.clear_armature_topology()
+
+_handlers = (
+    (bpy.app.handlers.depsgraph_update_post, clearArmatureTopologyOnUpdate),
+    (bpy.app.handlers.undo_post, clearArmatureTopology),
+    (bpy.app.handlers.redo_post, clearArmatureTopology),
+    (bpy.app.handlers.load_post, clearArmatureTopology),
+)
+
+################################################################
 def registerClass():
     for cls in classes:
         bpy.utils.register_class(cls)
     bpy.types.Scene.dddtools_bt_prop = PointerProperty(type=DDDBT_propertyGroup)
     bpy.types.VIEW3D_MT_pose_context_menu.append(draw_pose_menu)
+    for handlers, func in _handlers:
+        handlers.append(func)
 
 def unregisterClass():
+    for handlers, func in _handlers:
+        if func in handlers:
+            handlers.remove(func)
+    bt.clear_armature_topology()
     bpy.types.VIEW3D_MT_pose_context_menu.remove(draw_pose_menu)
     del bpy.types.Scene.dddtools_bt_prop
     for cls in reversed(classes):
@@ -2,8 +2,8 @@
 
 import bpy
 import bmesh
-from bpy.props import BoolProperty, FloatProperty, IntProperty, EnumProperty
-from bpy.types import Panel, Operator
+from bpy.props import BoolProperty, FloatProperty, IntProperty, EnumProperty, PointerProperty, FloatVectorProperty
+from bpy.types import Menu, Panel, Operator, PropertyGroup
 
 import math
 from random import Random
@@ -13,6 +13,8 @@ import numpy as np
 from . import internalUtils as iu
 from . import mathUtils as mu
 from . import SelectTool as st
+from . import UIUtils as ui
+from . import ProportionalMover as pm
 
 _ = lambda s: s
 from bpy.app.translations import pgettext_iface as iface_
@@ -449,6 +451,119 @@ class DDDET_OT_triangulateWithCenterVertex(Operator):
         col = self.layout.column()
         col.prop(self, 'method')
 
+################################################################
+class DDDET_OT_meshProportionalMove(pm.ProportionalMoveOperator, Operator):
+    bl_idname = 'mesh.dddet_mesh_proportional_move'
+    bl_label = _('Mesh Proportional Move')
+    bl_description = _('Proportionally move the vertices of the edit mesh.')
+    bl_options = {'REGISTER', 'UNDO', 'GRAB_CURSOR', 'BLOCKING'}
+
+    m_prop: PointerProperty(type=pm.DDDPM_ProportionalMove_pg)
+
+    move_vector: FloatVectorProperty(
+        name=_('Move Vector'),
+        description=_('Specifies the amount (in meters) by which the vertices are to be moved.'),
+        size=3,
+        default=[0, 0, 0],
+        precision=2,
+        step=1.0,
+        unit='LENGTH',
+    )
+
+    direction: pm.get_direction_enum()
+
+    scene_prop_path = 'dddtools_et_prop.meshProportionalMoveProp'
+    falloff_menu = 'DDDET_MT_Falloff'
+    undo_message = 'Proportional Mesh Editing'
+
+    ################
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # 頂点の元のローカル座標
+        self.vertex_locations = None
+
+    ################
+    def setup_elements(self, context):
+        obj = context.edit_object
+        if not obj or obj.type != 'MESH':
+            self.report({'WARNING'}, 'Mesh is not in edit mode.')
+            return None
+
+        # エディットメッシュの内容をメッシュに反映してからまとめて読む
+        obj.update_from_editmode()
+        vertices = obj.data.vertices
+        count = len(vertices)
+        hide = np.zeros(count, dtype=bool)
+        vertices.foreach_get('hide', hide)
+        select = np.zeros(count, dtype=bool)
+        vertices.foreach_get('select', select)
+        self.visible = ~hide
+        self.selected = select
+        if not np.any(self.visible & self.selected):
+            self.report({'WARNING'}, 'No vertices selected')
+            return None
+
+        co = np.empty(count * 3, dtype=np.float32)
+        vertices.foreach_get('co', co)
+        self.vertex_locations = co.reshape(-1, 3).astype(np.float64)
+
+        mtx = np.array(obj.matrix_world)
+        return self.vertex_locations @ mtx[:3, :3].T + mtx[:3, 3]
+
+    ################
+    # LOCAL_EACH_Z は頂点の法線方向、LOCAL_EACH_X|Y はオブジェクトの軸方向とする
+    def set_directions_local(self, context):
+        obj = context.edit_object
+        row = pm.DIRECTION_INFO[self.direction].row_index
+        mtx = np.array(obj.matrix_world)
+        count = len(self.vertex_locations)
+        if row == 2:
+            normals = np.empty(count * 3, dtype=np.float32)
+            obj.data.vertices.foreach_get('normal', normals)
+            self.pm.directions = normals.reshape(-1, 3) @ np.linalg.inv(mtx[:3, :3])
+        else:
+            self.pm.directions = np.tile(mtx[:3, row], (count, 1))
+
+    ################
+    def apply_locations(self, context, locations, which_to_move, indices):
+        obj = context.edit_object
+
+        # 今回移動する頂点と、前回移動して今回は移動しない頂点だけを書き込む
+        inv = np.linalg.inv(np.array(obj.matrix_world))
+        new_locations = np.where(which_to_move[indices, np.newaxis],
+                                 locations[indices] @ inv[:3, :3].T + inv[:3, 3],
+                                 self.vertex_locations[indices])
+
+        bm = bmesh.from_edit_mesh(obj.data)
+        bm.verts.ensure_lookup_table()
+        verts = bm.verts
+        for idx, co in zip(indices.tolist(), new_locations.tolist()):
+            verts[idx].co = co
+        bmesh.update_edit_mesh(obj.data, loop_triangles=False, destructive=False)
+
+    ################
+    # 編集中のメッシュ自身にはスナップやブロックをしない
+    def find_target_mesh(self, context):
+        return next((obj for obj in context.selected_objects
+                     if obj.type == 'MESH' and obj != context.edit_object), None)
+
+    ################
+    @classmethod
+    def poll(self, context):
+        obj = context.edit_object
+        return obj and obj.type == 'MESH' and context.mode == 'EDIT_MESH'
+
+################
+class DDDET_MT_Falloff(pm.FalloffPieMenu, Menu):
+    data_path = 'dddtools_et_prop.meshProportionalMoveProp'
+
+################################################################
+class DDDET_propertyGroup(PropertyGroup):
+    display_meshProportionalMove: BoolProperty(default=False)
+    meshProportionalMoveProp: PointerProperty(
+        type=pm.DDDPM_ProportionalMove_pg)
+
 ################################################################
 class DDDET_PT_main(Panel):
     bl_idname = 'DDDET_PT_main'
@@ -458,6 +573,7 @@ class DDDET_PT_main(Panel):
     bl_region_type = 'UI'
 
     def draw(self, context):
+        prop = context.scene.dddtools_et_prop
         col = self.layout.column(align=True)
         col.operator(DDDET_OT_selectDividingLoops.bl_idname)
         col.operator(DDDET_OT_triangulateWithCenterVertex.bl_idname)
@@ -466,12 +582,23 @@ class DDDET_PT_main(Panel):
         col.operator(DDDET_OT_convertEmptyAndSphere.bl_idname)
         col.operator(DDDET_OT_selectedInstancesToReal.bl_idname)
 
+        display, split = ui.splitSwitch(col, prop, 'display_meshProportionalMove')
+        split.operator(DDDET_OT_meshProportionalMove.bl_idname)
+        if display:
+            box = col.box()
+            prop.meshProportionalMoveProp.draw(context, box)
+
 ################################################################
 def menu_fn(self, context):
     layout = self.layout
     layout.separator()
     layout.operator(DDDET_OT_selectDividingLoops.bl_idname)
 
+################
+def draw_edit_mesh_menu(self, context):
+    self.layout.operator_context = 'INVOKE_DEFAULT'
+    self.layout.operator(DDDET_OT_meshProportionalMove.bl_idname)
+
 ################################################################
 classes = (
     DDDET_OT_selectDividingLoops,
@@ -480,16 +607,23 @@ classes = (
     DDDET_OT_convertEmptyAndSphere,
     DDDET_OT_selectedInstancesToReal,
     DDDET_OT_triangulateWithCenterVertex,
+    DDDET_OT_meshProportionalMove,
+    DDDET_MT_Falloff,
+    DDDET_propertyGroup,
     DDDET_PT_main,
 )
 
 def registerClass():
     for cls in classes:
         bpy.utils.register_class(cls)
+    bpy.types.Scene.dddtools_et_prop = PointerProperty(type=DDDET_propertyGroup)
     bpy.types.VIEW3D_MT_select_edit_mesh.append(menu_fn)
+    bpy.types.VIEW3D_MT_edit_mesh_context_menu.append(draw_edit_mesh_menu)
 
 def unregisterClass():
+    bpy.types.VIEW3D_MT_edit_mesh_context_menu.remove(draw_edit_mesh_menu)
     bpy.types.VIEW3D_MT_select_edit_mesh.remove(menu_fn)
+    del bpy.types.Scene.dddtools_et_prop
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
 
@@ -2,6 +2,7 @@
 
 import bpy
 from bpy.types import Panel, Operator, PropertyGroup, UIList, Object, Text
+from bpy.app.handlers import persistent
 from bpy.props import PointerProperty, CollectionProperty, StringProperty, EnumProperty, BoolProperty, IntProperty, FloatProperty
 import os
 import traceback
@@ -107,6 +108,24 @@ class DDDVT_propertyGroup(PropertyGroup):
         name=_('Remove unused materials'),
         description=_('Remove unused materials from the slot.'),
         default=False)
+    compactMeshes: BoolProperty(
+        name=_('Compact Meshes'),
+        description=_('Removes UV maps and attributes not used by materials and empty vertex groups, and welds duplicated vertices.'),
+        default=False)
+    buildTextureAtlas: BoolProperty(
+        name=_('Build Texture Atlas'),
+        description=_('Merges materials which differ only in their textures into one material by packing the textures into an atlas.'),
+        default=False)
+    atlasMaxSize: IntProperty(
+        name=_('Atlas Max Size'),
+        description=_('Maximum width and height of the texture atlas.'),
+        min=256,
+        max=16384,
+        default=4096)
+    optimizeVertexCache: BoolProperty(
+        name=_('Optimize Vertex Cache'),
+        description=_('Reorders polygons and vertices of the merged meshes to be efficient for the GPU vertex cache.'),
+        default=False)
 
     display_removePolygons_settings: BoolProperty(
         name='RemovePolygonsSettings',
@@ -210,6 +229,35 @@ class DDDVT_OT_addCollider(Operator):
                ('OUT_TO_IN', _('Gather'), _('Project the ray from the outside to the inside.'))],
         default='IN_TO_OUT',
     )
+    target: EnumProperty(
+        name=_('Target Bones'),
+        description=_('Sets the bones to add colliders.'),
+        items=[('SELECTED', _('Selected Bones'), _('Add colliders to the selected bones.')),
+               ('DEFORM', _('All Deform Bones'), _('Add colliders to all deform bones of the armature.'))],
+        default='SELECTED',
+    )
+    fitMode: EnumProperty(
+        name=_('Fitting Method'),
+        description=_('Sets how to fit the colliders to the ray hits.'),
+        items=[('LEAST_SQUARES', _('Least Squares'), _('Fit to all the hits.')),
+               ('RANSAC', _('Robust'), _('Ignore the hits far from the others, such as the hits on fingers or accessories.'))],
+        default='LEAST_SQUARES',
+    )
+    adaptive: BoolProperty(
+        name=_('Adaptive Sampling'),
+        description=_('Places colliders densely only where the thickness of the mesh changes.'),
+        default=False)
+    adaptiveTolerance: FloatProperty(
+        name=_('Adaptive Tolerance'),
+        description=_('Subdivides intervals where the radius or center of the colliders changes more than this value (m).'),
+        subtype='DISTANCE',
+        default=0.005,
+        min=0.0001,
+        max=0.1,
+        precision=4,
+        step=0.1,
+        unit='LENGTH',
+    )
 
     @classmethod
     def poll(self, context):
@@ -232,7 +280,11 @@ class DDDVT_OT_addCollider(Operator):
                               t_step=self.t_step,
                               numberOfRays=self.numberOfRays,
                               radius=self.radius,
-                              insideToOutside=(self.insideToOutside=='IN_TO_OUT'))
+                              insideToOutside=(self.insideToOutside=='IN_TO_OUT'),
+                              target=self.target,
+                              adaptive=self.adaptive,
+                              adaptiveTolerance=self.adaptiveTolerance,
+                              fitMode=self.fitMode)
 
     def invoke(self, context, event):
         prop = context.scene.dddtools_vt_prop
@@ -248,10 +300,17 @@ class DDDVT_OT_addCollider(Operator):
         col2.enabled = not self.auto_t_to
         col2.prop(self, 't_to')
         col.prop(self, 't_step')
+        col.prop(self, 'adaptive')
+        col2 = col.column()
+        col2.enabled = self.adaptive
+        col2.prop(self, 'adaptiveTolerance')
         col.separator()
         col.prop(self, 'numberOfRays')
         col.prop(self, 'radius')
         col.prop(self, 'insideToOutside')
+        col.prop(self, 'fitMode')
+        col.separator()
+        col.prop(self, 'target')
 
 ################
 class DDDVT_OT_setEmptyAsCollider(Operator):
@@ -310,6 +369,65 @@ class DDDVT_OT_duplicateColliderAsMirror(Operator):
                     
         return {'FINISHED'}
 
+################
+class DDDVT_OT_optimizeColliders(Operator):
+    bl_idname = 'dddvt.optimize_colliders'
+    bl_label = _('Optimize Colliders')
+    bl_description = _('Removes colliders that are mostly covered by the other colliders of the same bone.')
+    bl_options = {'REGISTER', 'UNDO'}
+
+    target: EnumProperty(
+        name=_('Target Bones'),
+        description=_('Sets the bones whose colliders are optimized.'),
+        items=[('SELECTED', _('Selected Bones'), _('Optimize the colliders of the selected bones.')),
+               ('ALL', _('All Bones'), _('Optimize the colliders of all bones.'))],
+        default='ALL',
+    )
+    tolerance: FloatProperty(
+        name=_('Tolerance'),
+        description=_('Sets the ratio of the collider surface allowed to be left uncovered.'),
+        subtype='FACTOR',
+        default=0.02,
+        min=0.0,
+        max=1.0,
+        precision=3,
+        step=1,
+    )
+    maxColliders: IntProperty(
+        name=_('Maximum Colliders per Bone'),
+        description=_('Sets the maximum number of colliders per bone. 0 means unlimited.'),
+        min=0,
+        max=100,
+        default=0,
+    )
+
+    @classmethod
+    def poll(self, context):
+        arma = context.active_object
+        return arma and arma.type == 'ARMATURE'
+
+    def execute(self, context):
+        arma = context.active_object
+        if self.target == 'SELECTED':
+            boneNames = {bone.name for bone in arma.data.bones if bone.select}
+        else:
+            boneNames = None
+        try:
+            before, after = vt.optimizeColliders(arma,
+                                                 boneNames=boneNames,
+                                                 tolerance=self.tolerance,
+                                                 maxColliders=self.maxColliders)
+        except:
+            traceback.print_exc()
+            self.report({'ERROR'},
+                        iface_('An error has occurred. See console for details.'))
+            return {'CANCELLED'}
+
+        self.report({'INFO'},
+                    iface_('Colliders: {before} -> {after}').format(before=before,
+                                                                    after=after))
+        return {'FINISHED'}
+
 ################
 class DDDVT_OT_registerSpringBone(Operator):
     bl_idname = 'dddvt.register_spring_bone'
@@ -339,6 +457,38 @@ class DDDVT_OT_registerSpringBone(Operator):
 
         return {'FINISHED'}
 
+################
+def getExportSettings(scene):
+    """
+    Returns keyword arguments of vt.prepareToExportVRM() from the scene settings.
+    """
+    prop = scene.dddtools_vt_prop
+    excludeMaterials = set([mat.material.name for mat in prop.excludeMaterials
+                            if mat.material])
+
+    mt_prop = scene.dddtools_mt_prop
+    if prop.sortMaterialSlot and mt_prop.orderList:
+        materialOrderList = [item.material.name for item in mt_prop.orderList]
+    else:
+        materialOrderList = None
+
+    return dict(skeleton=prop.skeleton.name if prop.skeleton else None,
+                triangulate=prop.triangulate,
+                removeTransparentPolygons=prop.removePolygons,
+                interval=prop.interval,
+                alphaThreshold=prop.alphaThreshold,
+                excludeMaterials=excludeMaterials,
+                bs_json=prop.bs_json.name if prop.bs_json else None,
+                sb_json=prop.sb_json.name if prop.sb_json else None,
+                removeEmpty=prop.removeEmpty,
+                notExport=prop.notExportBoneGroup,
+                materialOrderList=materialOrderList,
+                removeUnusedMaterialSlots=prop.removeUnusedMaterialSlots,
+                buildTextureAtlas=prop.buildTextureAtlas,
+                atlasMaxSize=prop.atlasMaxSize,
+                compactMeshes=prop.compactMeshes,
+                optimizeVertexCache=prop.optimizeVertexCache)
+
 ################
 class DDDVT_OT_prepareToExportVRM(Operator):
     bl_idname = 'dddvt.prepare_to_export_vrm'
@@ -355,41 +505,13 @@ class DDDVT_OT_prepareToExportVRM(Operator):
             bpy.context.mode == 'OBJECT'
 
     def execute(self, context):
-        prop = context.scene.dddtools_vt_prop
-        excludeMaterials = set([mat.material.name for mat in prop.excludeMaterials])
-        print(excludeMaterials)
-
-        mt_prop = context.scene.dddtools_mt_prop
-        if prop.sortMaterialSlot and mt_prop.orderList:
-            materialOrderList = [item.material.name for item in mt_prop.orderList]
-
-        else:
-            materialOrderList = None
-
-        if prop.sb_json:
-            sb_json = prop.sb_json.name
-        else:
-            sb_json = None
-        mergedObjs = vt.prepareToExportVRM(skeleton=prop.skeleton.name,
-                                           triangulate=prop.triangulate,
-                                           removeTransparentPolygons=prop.removePolygons,
-                                           interval=prop.interval,
-                                           alphaThreshold=prop.alphaThreshold,
-                                           excludeMaterials=excludeMaterials,
-                                           bs_json=prop.bs_json.name,
-                                           sb_json=sb_json,
-                                           removeEmpty=prop.removeEmpty,
-                                           notExport=prop.notExportBoneGroup,
-                                           materialOrderList=materialOrderList,
-                                           removeUnusedMaterialSlots=prop.removeUnusedMaterialSlots)
-        
-        if mergedObjs:
-            if None in mergedObjs:
-                mergedObjs[None].rename(prop.mergedName)
+        settings = getExportSettings(context.scene)
+        print(settings['excludeMaterials'])
 
-            base, ext = os.path.splitext(bpy.data.filepath)
-            filepath = f'{base}.export{ext}'
-            return bpy.ops.wm.save_as_mainfile(filepath=filepath)
+        filepath = vt.prepareAndSaveForExport(settings,
+                                              mergedName=context.scene.dddtools_vt_prop.mergedName)
+        if filepath:
+            return {'FINISHED'}
         else:
             return {'CANCELLED'}
 
@@ -478,6 +600,18 @@ class DDDVT_OT_RemoveTransparentPolygons(Operator):
     def invoke(self, context, event):
         return context.window_manager.invoke_confirm(self, event)
 
+################
+def drawValidationErrors(layout, errors, maxLines=5):
+    if not errors:
+        layout.label(text=iface_('No problems found.'), icon='CHECKMARK')
+        return
+    layout.label(text=iface_('{count} problems found.').format(count=len(errors)),
+                 icon='ERROR')
+    for error in errors[:maxLines]:
+        layout.label(text=error)
+    if len(errors) > maxLines:
+        layout.label(text='...')
+
 ################
 class DDDVT_PT_VRMTool(Panel):
     bl_idname = 'VT_PT_VRMTool'
@@ -514,6 +648,7 @@ class DDDVT_PT_VRMTool(Panel):
                 box.prop_search(prop, 'mesh', context.blend_data, 'objects')
 
             col.operator(DDDVT_OT_duplicateColliderAsMirror.bl_idname)
+            col.operator(DDDVT_OT_optimizeColliders.bl_idname)
 
         # prepareToExportVRM
         display, split = ui.splitSwitch(layout, prop, 'display_prepareToExportVRM')
@@ -521,7 +656,13 @@ class DDDVT_PT_VRMTool(Panel):
         if display:
             col = layout.box().column(align=True)
             if vt.getAddon():
+                bs_errors, sb_errors = vt.getValidationErrors(
+                    prop.bs_json.name if prop.bs_json else None,
+                    prop.sb_json.name if prop.sb_json else None,
+                    prop.skeleton.name if prop.skeleton else None)
                 col.prop_search(prop, 'bs_json', context.blend_data, 'texts')
+                if prop.bs_json:
+                    drawValidationErrors(col.box().column(align=True), bs_errors)
                 if prop.skeleton and prop.skeleton.mode != 'EDIT':
                     col.prop_search(prop, 'notExportBoneGroup', prop.skeleton.data,
                                     'collections')
@@ -530,6 +671,11 @@ class DDDVT_PT_VRMTool(Panel):
                 col.prop(prop, 'saveAsExport')
                 col.prop(prop, 'sortMaterialSlot')
                 col.prop(prop, 'removeUnusedMaterialSlots')
+                col.prop(prop, 'buildTextureAtlas')
+                if prop.buildTextureAtlas:
+                    col.prop(prop, 'atlasMaxSize')
+                col.prop(prop, 'compactMeshes')
+                col.prop(prop, 'optimizeVertexCache')
                 
                 # removePolygons
                 col.separator()
@@ -561,6 +707,8 @@ class DDDVT_PT_VRMTool(Panel):
                 if display:
                     box = col.box().column()
                     box.prop_search(prop, 'sb_json', context.blend_data, 'texts')
+                    if prop.sb_json:
+                        drawValidationErrors(box.column(align=True), sb_errors)
                     box.prop(prop, 'removeEmpty')
 
             else:
@@ -575,6 +723,7 @@ classes = (
     DDDVT_OT_addCollider,
     DDDVT_OT_setEmptyAsCollider,
     DDDVT_OT_duplicateColliderAsMirror,
+    DDDVT_OT_optimizeColliders,
     DDDVT_OT_registerSpringBone,
     DDDVT_OT_prepareToExportVRM,
     DDDVT_OT_openAddonPage,
@@ -585,12 +734,47 @@ classes = (
     DDDVT_PT_VRMTool,
 )
 
+################################################################
+# 検証結果が変わりうる更新があった時だけ、検証結果のキャッシュを破棄する。
+# 移動だけの更新では破棄しない
+_validation_types = (
+    bpy.types.Key,
+    bpy.types.Collection,
+    bpy.types.Action,
+    bpy.types.Material,
+    bpy.types.Armature,
+)
+
+@persistent
+def clearValidationCacheOnUpdate(scene, depsgraph):
+    for update in depsgraph.updates:
+        if isinstance(update.id, _validation_types) or\
+           (isinstance(update.id, bpy.types.Object) and update.is_updated_geometry):
+            vt.clearValidationCache()
+            return
+
+@persistent
+def clearValidationCache(*args):
+    vt.clearValidationCache()
+
+_handlers = (
+    (bpy.app.handlers.depsgraph_update_post, clearValidationCacheOnUpdate),
+    (bpy.app.handlers.undo_post, clearValidationCache),
+    (bpy.app.handlers.redo_post, clearValidationCache),
+    (bpy.app.handlers.load_post, clearValidationCache),
+)
+
 def registerClass():
     for cls in classes:
         bpy.utils.register_class(cls)
     bpy.types.Scene.dddtools_vt_prop = PointerProperty(type=DDDVT_propertyGroup)
+    for handlers, func in _handlers:
+        handlers.append(func)
 
 def unregisterClass():
+    for handlers, func in _handlers:
+        if func in handlers:
+            handlers.remove(func)
     del bpy.types.Scene.dddtools_vt_prop
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
@@ -1,8 +1,11 @@
 # -*- encoding:utf-8 -*-
 
+import os
 import sys
 import re
 import json
+import copy
+import hashlib
 from collections import OrderedDict
 from dataclasses import dataclass
 import bpy, bmesh
@@ -24,8 +27,204 @@ import numpy as np
 re_name_LR = re.compile(r'(.*[._-])([LR])$')
 
 ################################################################
-def textblock2str(textblock):
-    return ''.join([line.body for line in textblock.lines])
+# Cache of the JSON in the text blocks, keyed by the hash of the contents.
+_json_cache = dict()
+
+################
+def loadJsonTextblock(name):
+    """
+    Returns the JSON in the text block, parsing it only when the contents
+    have changed. The returned object is shared, so copy it before modifying.
+
+    Parameters
+    ----------------
+    name : String
+      Name of the text block
+
+    Returns
+    -------
+    (object, String)
+      Parsed JSON and the hash of the contents.
+    """
+    content = bpy.data.texts[name].as_string()
+    digest = hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+    cached = _json_cache.get(name)
+    if cached and cached[0] == digest:
+        return cached[1], digest
+
+    data = json.loads(content, object_pairs_hook=OrderedDict)
+    _json_cache[name] = (digest, data)
+    return data, digest
+
+################
+@dataclass
+class SceneIndex:
+    """
+    Name indexes of the scene to validate the JSON.
+    """
+    objects : dict       # Object name to (type, set of shapekey names)
+    collections : dict   # Collection name to whether it contains meshes
+    actions : set
+    materials : set
+    bones : set
+
+################
+def buildSceneIndex(arma=None):
+    objects = dict()
+    for obj in bpy.data.objects:
+        keys = set()
+        if obj.type == 'MESH' and obj.data.shape_keys:
+            keys = set(obj.data.shape_keys.key_blocks.keys())
+        objects[obj.name] = (obj.type, keys)
+
+    collections = {col.name: any(obj.type == 'MESH' for obj in col.all_objects)
+                   for col in bpy.data.collections}
+
+    return SceneIndex(objects=objects,
+                      collections=collections,
+                      actions=set(bpy.data.actions.keys()),
+                      materials=set(bpy.data.materials.keys()),
+                      bones=set(arma.data.bones.keys()) if arma else set())
+
+################
+def validateBlendShape(bs_dic, index):
+    """
+    Validates blendshape_group.json against the scene.
+    A bind refers to a shapekey of a mesh, or to an action for the meshes
+    in a collection to merge.
+
+    Returns
+    -------
+    list of String
+      Error messages
+    """
+    errors = []
+    if not isinstance(bs_dic, list):
+        return ['blendshape_group.json must be a list.']
+
+    for bs in bs_dic:
+        name = bs.get('name')
+        for bind in bs.get('binds') or []:
+            mesh = bind.get('mesh')
+            key = bind.get('index')
+            if not mesh or not key:
+                errors.append(f'Illegal bind in {name}. mesh:{mesh} index:{key}')
+            elif mesh in index.objects:
+                obj_type, shapekeys = index.objects[mesh]
+                if obj_type != 'MESH':
+                    errors.append(f'Object({mesh}) is not a mesh.')
+                elif not shapekeys:
+                    errors.append(f'Object({mesh}) does not have shape_keys.')
+                elif key not in shapekeys:
+                    errors.append(f'Cannot find shapekey({key}) in mesh({mesh}).')
+            elif mesh in index.collections:
+                if not index.collections[mesh]:
+                    errors.append(f'Collection({mesh}) does not have meshes.')
+                elif key not in index.actions:
+                    errors.append(f'Cannot find action({key}).')
+            else:
+                errors.append(f'Cannot find object({mesh}).')
+
+        for mv in bs.get('materialValues') or []:
+            material = mv.get('materialName')
+            if material not in index.materials:
+                errors.append(f'Cannot find material({material}).')
+
+    # Report each error once.
+    return list(OrderedDict.fromkeys(errors))
+
+################
+def validateSpringBone(sb_dic, index):
+    """
+    Validates spring_bone.json against the bones of the armature.
+
+    Returns
+    -------
+    list of String
+      Error messages
+    """
+    errors = []
+    if not isinstance(sb_dic, list):
+        return ['spring_bone.json must be a list.']
+
+    for group in sb_dic:
+        for bone in group.get('bones') or []:
+            if bone not in index.bones:
+                errors.append(f'Cannot find bone({bone}).')
+        for bone in group.get('colliderGroups') or []:
+            if bone not in index.bones:
+                errors.append(f'Cannot find collider group bone({bone}).')
+        center = group.get('center', -1)
+        if isinstance(center, str) and center not in index.bones:
+            errors.append(f'Cannot find center bone({center}).')
+
+    return list(OrderedDict.fromkeys(errors))
+
+################
+_validation_cache = dict()
+
+################
+def clearValidationCache():
+    _validation_cache.clear()
+
+################
+def getValidationErrors(bs_json, sb_json, skeleton):
+    """
+    Returns error messages of blendshape_group.json and spring_bone.json.
+    The result is cached until the contents of the text blocks change or
+    clearValidationCache() is called on the update of the scene.
+
+    Parameters
+    ----------------
+    bs_json : String
+      Name of textblock of blendshape_group.json
+    sb_json : String
+      Name of textblock of spring_bone.json
+    skeleton : String
+      Name of armature
+
+    Returns
+    -------
+    (list of String, list of String)
+      Errors of blendshape_group.json and spring_bone.json
+    """
+    dics = []
+    digests = []
+    for name in (bs_json, sb_json):
+        if not name or name not in bpy.data.texts:
+            dics.append(None)
+            digests.append(None)
+            continue
+        try:
+            dic, digest = loadJsonTextblock(name)
+            dics.append(dic)
+            digests.append(digest)
+        except ValueError as e:
+            dics.append(e)
+            digests.append(bpy.data.texts[name].as_string())
+
+    key = (bs_json, digests[0], sb_json, digests[1], skeleton)
+    cached = _validation_cache.get(key)
+    if cached:
+        return cached
+
+    arma = bpy.data.objects.get(skeleton) if skeleton else None
+    if arma and arma.type != 'ARMATURE':
+        arma = None
+    index = buildSceneIndex(arma)
+
+    result = []
+    for dic, validate in zip(dics, (validateBlendShape, validateSpringBone)):
+        if dic is None or (validate is validateSpringBone and not arma):
+            result.append([])
+        elif isinstance(dic, ValueError):
+            result.append([f'Invalid JSON: {dic}'])
+        else:
+            result.append(validate(dic, index))
+
+    _validation_cache.clear()
+    _validation_cache[key] = tuple(result)
+    return _validation_cache[key]
 
 ################
 def getAddon(version=(2, 3, 26)):
@@ -44,40 +243,58 @@ def getAddon(version=(2, 3, 26)):
         return None
 
 ################
-def addColliderToBone(mesh,
+@dataclass
+class ColliderRays:
+    """
+    Rays cast around a bone to find the size of the colliders.
+    """
+    boneName : str
+    matrix_parent : Matrix    # World matrix of the bone tail
+    shape : tuple             # (number of rings, number of rays)
+    origins : np.ndarray      # Mesh-local origins of rays
+    directions : np.ndarray   # Mesh-local directions of rays
+    mtxM2B : np.ndarray       # Mesh space to bone space
+
+################
+def getColliderPositions(arma, boneName, t_from=0, t_to=None, t_step=0.05):
+    """
+    Returns the positions of the colliders along the bone.
+    The positions are in bone space whose origin is the bone tail.
+    """
+    bone = arma.pose.bones[boneName]
+    length = (bone.tail - bone.head).length
+    if not t_from:
+        t_from = 0
+    if not t_to:
+        t_to = max(t_from, length - t_step)
+    # print(t_from, t_to, t_step)
+    return np.arange(t_from, t_to, t_step) - length
+
+################
+def buildColliderRays(mesh,
                       arma,
                       boneName,
-                      t_from=0,
-                      t_to=None,
-                      t_step=0.05,
+                      t_values,
                       numberOfRays=32,
                       radius=0.3,
                       insideToOutside=True):
-    if not mesh or not arma:
-        raise ValueError(f'Error: no mesh or no arma in addCollider({mesh}, {arma}, {bone})')
-
+    """
+    Builds rays to cast for the colliders of the bone at t_values.
+    Returns ColliderRays.
+    """
     bone = arma.pose.bones[boneName]
-    length = (bone.tail - bone.head).length
 
     mtx = bone.matrix.copy()
     mtx.translation = bone.tail
     matrix_parent = arma.matrix_world @ mtx # 親のワールド行列
-    matrix_parent_inverse = matrix_parent.inverted()
 
     # ボーン空間からメッシュ空間への変換行列を作成
     mtxB2M = mesh.matrix_world.inverted() @ matrix_parent
-    mtxB2M_rot = mtxB2M.to_3x3()
 
     # メッシュ空間からボーン空間への変換行列を作成
-    mtxM2B = matrix_parent_inverse @ mesh.matrix_world
+    mtxM2B = matrix_parent.inverted() @ mesh.matrix_world
 
     # 全てのレイを作成する
-    if not t_from:
-        t_from = 0
-    if not t_to:
-        t_to = max(t_from, length - t_step)
-    # print(t_from, t_to, t_step)
-    t_values = np.arange(t_from, t_to, t_step) - length
     angle_values = np.linspace(0, math.tau, numberOfRays, endpoint=False)
 
     # meshgridでX, Y, Z座標を生成
@@ -86,7 +303,6 @@ def addColliderToBone(mesh,
     yy = T
     zz = np.sin(Angle)
     zeros = np.zeros(T.shape)
-    ones = np.ones(T.shape)
 
     if insideToOutside:
         # 内から外へ
@@ -97,41 +313,261 @@ def addColliderToBone(mesh,
         dirs = np.stack((-xx, zeros, -zz), axis=-1)
         origs = np.stack((xx * radius, yy, zz * radius), axis=-1)
 
-    cylindricalRays = np.stack((origs, dirs), axis=-2)
-    # print(cylindricalRays)
-
-    params = []
-    for rays in cylindricalRays:
-        hits = np.array([mesh.ray_cast(mtxB2M @ Vector(od[0]),
-                                       mtxB2M_rot @ Vector(od[1]),
-                                       distance=radius) for od in rays])
-        hits = hits[hits[:, 0] == True]
-        # print(hits)
-        if len(hits) >= 3:
-            points = np.array([np.array(mtxM2B @ hit[1]) for hit in hits])
-            points2D = points[:, [0, 2]]
-            size, center = mu.calcFit(points2D)
-            center = np.array([center[0], points[0][1], center[1]])
-            #center = np.array([0, points[0][1], 0])
-            params.append((size, center))
-
-    # print(params)
-    for size, center in params:
-        emptyName = f'Collider_{bone.name}'
-        empty_obj = bpy.data.objects.new(emptyName, None)
-        empty_obj.parent = arma
-        empty_obj.parent_type = 'BONE'
-        empty_obj.parent_bone = bone.name
-        empty_obj.matrix_parent_inverse = matrix_parent_inverse
-        matrix_basis = matrix_parent.copy()
-        matrix_basis.translation = matrix_parent @ Vector(center)
-        empty_obj.matrix_basis = matrix_basis
-        empty_obj.matrix_local = matrix_parent_inverse @ matrix_basis
-        empty_obj.matrix_world = matrix_basis
-        empty_obj.empty_display_type = 'SPHERE'
-        empty_obj.empty_display_size = size
-
-        bpy.context.scene.collection.objects.link(empty_obj)
+    # メッシュ空間に変換する
+    mtx = np.array(mtxB2M)
+    m_origs = (mu.append_homogeneous_coordinate(origs) @ mtx.T)[..., :3]
+    m_dirs = dirs @ mtx[:3, :3].T
+
+    return ColliderRays(boneName=boneName,
+                        matrix_parent=matrix_parent,
+                        shape=T.shape,
+                        origins=m_origs.reshape(-1, 3),
+                        directions=m_dirs.reshape(-1, 3),
+                        mtxM2B=np.array(mtxM2B))
+
+################
+def fitColliderRings(rings, fitMode='LEAST_SQUARES'):
+    """
+    Fits circles to the hit points of all rings in one batched call.
+
+    Parameters
+    ----------------
+    rings : list of np.ndarray
+      Bone-space hit points of each ring.
+
+    fitMode : String
+      'LEAST_SQUARES' to fit all the points,
+      'RANSAC' to ignore outliers such as hits on the other parts.
+
+    Returns
+    -------
+    list of (float, np.ndarray)
+      Size and bone-space center of each ring.
+      None for the rings whose points are degenerate.
+    """
+    if not rings:
+        return []
+
+    points, mask = mu.pad_point_clouds([ring[:, [0, 2]] for ring in rings])
+    if fitMode == 'RANSAC':
+        sizes, centers, _ = mu.calcFitRansacBatch(points, mask)
+    else:
+        sizes, centers = mu.calcFitBatch(points, mask)
+    return [None if np.isnan(size) else
+            (size, np.array([center[0], ring[0][1], center[1]]))
+            for ring, size, center in zip(rings, sizes, centers)]
+
+################
+def castAndFitColliderRings(mesh,
+                            arma,
+                            requests,
+                            numberOfRays=32,
+                            radius=0.3,
+                            insideToOutside=True,
+                            fitMode='LEAST_SQUARES'):
+    """
+    Casts the rays of all requested rings at once and fits circles to them.
+
+    Parameters
+    ----------------
+    requests : list of (String, np.ndarray)
+      Bone names and positions of the rings.
+
+    Returns
+    -------
+    list of (ColliderRays, list)
+      For each request, the rays and the fitted (size, center) of each ring.
+      Rings with less than 3 hits are None.
+    """
+    allRays = [buildColliderRays(mesh, arma, bn, t_values,
+                                 numberOfRays=numberOfRays,
+                                 radius=radius,
+                                 insideToOutside=insideToOutside)
+               for bn, t_values in requests]
+    if not allRays:
+        return []
+
+    # まとめてレイを飛ばす
+    caster = mu.get_mesh_ray_caster(mesh)
+    hits, locations, _, _, _ = caster.ray_cast(
+        np.concatenate([cr.origins for cr in allRays]),
+        np.concatenate([cr.directions for cr in allRays]),
+        distances=radius)
+
+    # 3 点以上当たったリングを集める
+    rings = []
+    owners = []
+    start = 0
+    for ri, cr in enumerate(allRays):
+        count = cr.shape[0] * cr.shape[1]
+        ring_hits = hits[start:start + count].reshape(cr.shape)
+        b_locations = mu.append_homogeneous_coordinate(locations[start:start + count]) @ cr.mtxM2B.T
+        b_locations = b_locations[:, :3].reshape(cr.shape + (3,))
+        start += count
+        for ti, (hit, b_points) in enumerate(zip(ring_hits, b_locations)):
+            if np.count_nonzero(hit) >= 3:
+                rings.append(b_points[hit])
+                owners.append((ri, ti))
+
+    # 円をフィットする
+    result = [(cr, [None] * cr.shape[0]) for cr in allRays]
+    fits = fitColliderRings(rings, fitMode=fitMode)
+    for (ri, ti), param in zip(owners, fits):
+        result[ri][1][ti] = param
+    return result
+
+################
+def refineColliderRings(fits, tolerance):
+    """
+    Finds the intervals of rings to subdivide.
+
+    Parameters
+    ----------------
+    fits : dict
+      Dictionary of ring index to fitted (size, center) or None.
+
+    tolerance : float
+      Intervals whose radius or center changes more than this are subdivided.
+
+    Returns
+    -------
+    list of int
+      Indices of the rings to add.
+    """
+    result = []
+    indices = sorted(fits.keys())
+    for k0, k1 in zip(indices[:-1], indices[1:]):
+        if k1 - k0 <= 1:
+            continue
+        f0 = fits[k0]
+        f1 = fits[k1]
+        if f0 is None and f1 is None:
+            continue
+        if f0 is None or f1 is None or\
+           abs(f0[0] - f1[0]) > tolerance or\
+           np.linalg.norm((f0[1] - f1[1])[[0, 2]]) > tolerance:
+            result.append((k0 + k1) // 2)
+    return result
+
+################
+def createColliderEmpty(arma, boneName, matrix_parent, size, center):
+    """
+    Creates an empty as a collider of the bone.
+    The empty is not linked to any collection.
+    """
+    matrix_parent_inverse = matrix_parent.inverted()
+    emptyName = f'Collider_{boneName}'
+    empty_obj = bpy.data.objects.new(emptyName, None)
+    empty_obj.parent = arma
+    empty_obj.parent_type = 'BONE'
+    empty_obj.parent_bone = boneName
+    empty_obj.matrix_parent_inverse = matrix_parent_inverse
+    matrix_basis = matrix_parent.copy()
+    matrix_basis.translation = matrix_parent @ Vector(center)
+    empty_obj.matrix_basis = matrix_basis
+    empty_obj.matrix_local = matrix_parent_inverse @ matrix_basis
+    empty_obj.matrix_world = matrix_basis
+    empty_obj.empty_display_type = 'SPHERE'
+    empty_obj.empty_display_size = size
+    return empty_obj
+
+################
+def addCollidersToBones(mesh,
+                        arma,
+                        boneNames,
+                        t_from=0,
+                        t_to=None,
+                        t_step=0.05,
+                        numberOfRays=32,
+                        radius=0.3,
+                        insideToOutside=True,
+                        adaptive=False,
+                        adaptiveTolerance=0.005,
+                        coarseSteps=4,
+                        fitMode='LEAST_SQUARES'):
+    """
+    Adds colliders to the bones in one pass.
+    Rays of all bones are cast at once, circles of all rings are fitted in
+    one batched call, and the empties are created and linked together at
+    the end.
+
+    If adaptive is True, rings are first placed every coarseSteps * t_step,
+    and the intervals whose fitted radius or center changes more than
+    adaptiveTolerance are subdivided down to t_step.
+
+    fitMode 'RANSAC' fits the circles ignoring outlier hits.
+
+    Returns the number of the created colliders.
+    """
+    if not mesh or not arma:
+        raise ValueError(f'Error: no mesh or no arma in addCollider({mesh}, {arma}, {boneNames})')
+
+    positions = {bn: getColliderPositions(arma, bn,
+                                          t_from=t_from,
+                                          t_to=t_to,
+                                          t_step=t_step)
+                 for bn in boneNames}
+    kwargs = dict(numberOfRays=numberOfRays,
+                  radius=radius,
+                  insideToOutside=insideToOutside,
+                  fitMode=fitMode)
+
+    # 骨の名前 -> (ColliderRays, {リングのインデックス: フィット結果})
+    results = dict()
+    if not adaptive:
+        requests = [(bn, t_values) for bn, t_values in positions.items()]
+        for cr, fits in castAndFitColliderRings(mesh, arma, requests, **kwargs):
+            results[cr.boneName] = (cr, dict(enumerate(fits)))
+    else:
+        # 粗くリングを置き、変化の大きい区間を細分化していく
+        pending = dict()
+        for bn, t_values in positions.items():
+            count = len(t_values)
+            if count > 0:
+                coarse = list(range(0, count, max(1, coarseSteps)))
+                if coarse[-1] != count - 1:
+                    coarse.append(count - 1)
+                pending[bn] = coarse
+        while pending:
+            requests = [(bn, positions[bn][indices]) for bn, indices in pending.items()]
+            for (bn, indices), (cr, fits) in zip(pending.items(),
+                                                 castAndFitColliderRings(mesh, arma, requests, **kwargs)):
+                if bn not in results:
+                    results[bn] = (cr, dict())
+                results[bn][1].update(zip(indices, fits))
+            pending = dict()
+            for bn, (cr, fits) in results.items():
+                indices = refineColliderRings(fits, adaptiveTolerance)
+                if indices:
+                    pending[bn] = indices
+
+    # エンプティをまとめて作成する
+    empties = [createColliderEmpty(arma, bn, cr.matrix_parent, *fits[k])
+               for bn, (cr, fits) in results.items()
+               for k in sorted(fits.keys()) if fits[k] is not None]
+    collection = bpy.context.scene.collection
+    for empty_obj in empties:
+        collection.objects.link(empty_obj)
+
+    return len(empties)
+
+################
+def addColliderToBone(mesh,
+                      arma,
+                      boneName,
+                      t_from=0,
+                      t_to=None,
+                      t_step=0.05,
+                      numberOfRays=32,
+                      radius=0.3,
+                      insideToOutside=True):
+    return addCollidersToBones(mesh, arma, [boneName],
+                               t_from=t_from,
+                               t_to=t_to,
+                               t_step=t_step,
+                               numberOfRays=numberOfRays,
+                               radius=radius,
+                               insideToOutside=insideToOutside)
 
 ################
 def getSelectedEditableBones():
@@ -145,7 +581,11 @@ def addCollider(meshObj,
                 t_step=0.05,
                 numberOfRays=32,
                 radius=0.3,
-                insideToOutside=True):
+                insideToOutside=True,
+                target='SELECTED',
+                adaptive=False,
+                adaptiveTolerance=0.005,
+                fitMode='LEAST_SQUARES'):
     """
     Adds a collision sphere to the selected bones for the selected mesh.
     You should select one mesh and one armature.
@@ -176,6 +616,20 @@ def addCollider(meshObj,
     insideToOutside : bool
       If true, emits rays from the center of the circle outward.
       If false, emits rays from the edge of the circle towards the center.
+
+    target : String
+      'SELECTED' to add colliders to the selected bones,
+      'DEFORM' to add colliders to all deform bones.
+
+    adaptive : bool
+      If true, places colliders densely only where the radius or center
+      of the fitted circles changes.
+
+    adaptiveTolerance : number
+      Change of radius or center (meter) to subdivide when adaptive.
+
+    fitMode : String
+      'LEAST_SQUARES' or 'RANSAC' to ignore outlier hits.
     """
 
     #print('----------------')
@@ -186,21 +640,99 @@ def addCollider(meshObj,
     #print('mesh:', mesh.name, 'arma:', arma.name)
 
     with iu.mode_context(arma.obj, 'POSE'):
-        selected_bones = bt.get_selected_bone_names()
-        if not selected_bones:
+        if target == 'DEFORM':
+            bones = [bone.name for bone in arma.obj.data.bones if bone.use_deform]
+        else:
+            bones = bt.get_selected_bone_names()
+        if not bones:
             return {'CANCELLED'}, 'Please select a bone'
 
-        for bone in selected_bones:
-            addColliderToBone(mesh.obj, arma.obj, bone,
-                              t_from=t_from,
-                              t_to=t_to,
-                              t_step=t_step,
-                              numberOfRays=numberOfRays,
-                              radius=radius,
-                              insideToOutside=insideToOutside)
+        count = addCollidersToBones(mesh.obj, arma.obj, bones,
+                                    t_from=t_from,
+                                    t_to=t_to,
+                                    t_step=t_step,
+                                    numberOfRays=numberOfRays,
+                                    radius=radius,
+                                    insideToOutside=insideToOutside,
+                                    adaptive=adaptive,
+                                    adaptiveTolerance=adaptiveTolerance,
+                                    fitMode=fitMode)
+        print(f'Added {count} colliders to {len(bones)} bones')
 
     return{'FINISHED'}
     
+################
+def getColliders(arma):
+    """
+    Returns a dictionary of bone name to list of collider empties
+    parented to the bone.
+    """
+    result = dict()
+    for obj in arma.children:
+        if obj.type == 'EMPTY' and obj.empty_display_type == 'SPHERE' and\
+           obj.parent_type == 'BONE' and obj.parent_bone:
+            result.setdefault(obj.parent_bone, []).append(obj)
+    return result
+
+################
+def optimizeColliders(arma,
+                      boneNames=None,
+                      tolerance=0.01,
+                      maxColliders=0,
+                      numberOfSamples=64):
+    """
+    Removes colliders whose surfaces are mostly covered by the other
+    colliders of the same bone.
+
+    Parameters
+    ----------------
+    arma : bpy.types.Object
+      Armature object.
+
+    boneNames : list of String
+      Bones to optimize. None for all bones.
+
+    tolerance : float
+      Ratio of the surface samples allowed to be left uncovered.
+
+    maxColliders : int
+      Maximum number of colliders per bone. 0 for unlimited.
+
+    numberOfSamples : int
+      Number of surface samples per collider.
+
+    Returns
+    -------
+    (int, int)
+      Number of colliders before and after the optimization.
+    """
+    before = 0
+    after = 0
+    for boneName, colliders in getColliders(arma).items():
+        if boneNames is not None and boneName not in boneNames:
+            continue
+
+        centers = np.array([obj.matrix_world.translation for obj in colliders])
+        radii = np.array([obj.empty_display_size *
+                          statistics.mean(abs(sc) for sc in obj.matrix_world.to_scale())
+                          for obj in colliders])
+        keep = mu.select_covering_spheres(centers, radii,
+                                          num_samples=numberOfSamples,
+                                          tolerance=tolerance,
+                                          max_count=maxColliders)
+        keep = set(keep.tolist())
+        for idx, obj in enumerate(colliders):
+            if idx not in keep:
+                bpy.data.objects.remove(obj)
+
+        before += len(colliders)
+        after += len(keep)
+        if len(keep) < len(colliders):
+            print(f'{boneName}: {len(colliders)} -> {len(keep)} colliders')
+
+    print(f'Optimized colliders: {before} -> {after}')
+    return before, after
+
 ################
 def duplicateColliderAsMirror(emptyObj):
     if not emptyObj.obj.parent:
@@ -400,7 +932,282 @@ def removeTransparentPolygons(obj,
     iu.remove_isolated_edges_and_vertices(obj)
 
 ################################################################
-def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
+def bakePoseAsShapekey(meshObj, armaObj, name, weights,
+                       tolerance=1e-6, matrixTolerance=1e-6):
+    """
+    Bake the current pose of the armature into a shapekey of the mesh.
+    Only the vertices weighted to bones that have moved from the rest pose
+    are deformed, and all other vertices keep the basis coordinates.
+
+    Parameters
+    ----------------
+    meshObj : bpy.types.Object
+      Mesh object deformed by armaObj
+
+    armaObj : bpy.types.Object
+      Armature object
+
+    name : String
+      Name of the shapekey
+
+    weights : (np.ndarray, np.ndarray, np.ndarray)
+      Sparse vertex weights from wt.get_sparse_vertex_weights()
+
+    tolerance : float
+      Shapekeys whose maximum vertex offset is less than this are skipped.
+
+    matrixTolerance : float
+      Bones whose deform matrices differ from identity less than this are
+      regarded as not moved.
+
+    Returns
+    -------
+    bool
+      True if the shapekey is added, False if it is skipped.
+    """
+
+    mesh = meshObj.data
+    bones = armaObj.data.bones
+    vi, gi, ww = weights
+
+    # Deform matrix of each bone in armature space.
+    rest = bt.get_bone_matrices(bones, 'matrix_local')
+    pose = bt.get_bone_matrices(armaObj.pose.bones, 'matrix')
+    deform = pose @ np.linalg.inv(rest)
+    moved = np.max(np.abs(deform - np.identity(4)), axis=(1, 2)) > matrixTolerance
+
+    # Map vertex groups to deforming bones.
+    bone_indices = {bone.name: idx for idx, bone in enumerate(bones)
+                    if bone.use_deform}
+    group_to_bone = np.array([bone_indices.get(vg.name, -1)
+                              for vg in meshObj.vertex_groups] + [-1],
+                             dtype=np.int64)
+    bi = group_to_bone[gi] if len(gi) > 0 else np.empty(0, dtype=np.int64)
+    valid = bi >= 0
+
+    # Vertices affected by the moved bones.
+    affected = valid.copy()
+    affected[valid] = moved[bi[valid]]
+    subset = np.unique(vi[affected])
+    if len(subset) == 0:
+        print(f'Skipped shapekey({name}) of {meshObj.name}: no vertices are affected')
+        return False
+
+    number_of_vertices = len(mesh.vertices)
+    basis = np.empty(number_of_vertices * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', basis)
+    basis = basis.reshape(-1, 3)
+
+    mod = next((m for m in meshObj.modifiers
+                if m.type == 'ARMATURE' and m.object == armaObj), None)
+    use_linear = mod is not None and\
+        not mod.use_deform_preserve_volume and\
+        all(bones[int(idx)].bbone_segments <= 1 for idx in np.flatnonzero(moved))
+
+    if use_linear:
+        # Linear blend skinning of the affected vertices only.
+        mtx = np.array(armaObj.matrix_world.inverted() @ meshObj.matrix_world)
+        deform = np.linalg.inv(mtx) @ deform @ mtx
+
+        entries = np.flatnonzero(valid & np.isin(vi, subset))
+        local = np.searchsorted(subset, vi[entries])
+        co = basis[subset].astype(np.float64)
+        co_h = np.hstack((co, np.ones((len(subset), 1))))
+        transformed = np.einsum('eij,ej->ei',
+                                deform[bi[entries], :3, :],
+                                co_h[local])
+        contrib = np.zeros((len(subset), 3))
+        total = np.zeros(len(subset))
+        np.add.at(contrib, local, transformed * ww[entries, np.newaxis])
+        np.add.at(total, local, ww[entries])
+        has_weight = total > 1e-4
+        deformed = co.copy()
+        deformed[has_weight] = contrib[has_weight] / total[has_weight, np.newaxis]
+    else:
+        # Fall back to the evaluated mesh for bendy bones or preserve volume.
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        evaluated = meshObj.evaluated_get(depsgraph)
+        eval_mesh = evaluated.to_mesh()
+        coords = np.empty(len(eval_mesh.vertices) * 3, dtype=np.float32)
+        eval_mesh.vertices.foreach_get('co', coords)
+        evaluated.to_mesh_clear()
+        deformed = coords.reshape(-1, 3)[subset].astype(np.float64)
+
+    max_delta = np.max(np.linalg.norm(deformed - basis[subset], axis=1))
+    if max_delta < tolerance:
+        print(f'Skipped shapekey({name}) of {meshObj.name}: max offset {max_delta:.3g} < {tolerance:.3g}')
+        return False
+
+    if not mesh.shape_keys:
+        meshObj.shape_key_add(name='Basis', from_mix=False)
+    shapekey = meshObj.shape_key_add(name=name, from_mix=False)
+    coords = basis.copy()
+    coords[subset] = deformed
+    shapekey.data.foreach_set('co', coords.ravel())
+    mesh.update()
+
+    print(f'Baked shapekey({name}) of {meshObj.name}: {len(subset)}/{number_of_vertices} vertices')
+    return True
+
+################################################################
+def removeSkippedBinds(bs_dic, skipped):
+    """
+    Remove binds that refer to skipped shapekeys.
+
+    Parameters
+    ----------------
+    bs_dic : list
+      Contents of blendshape_group.json
+
+    skipped : dict
+      Dictionary of mesh name to set of skipped shapekey names.
+    """
+    for bs in bs_dic:
+        binds = bs.get('binds')
+        if binds:
+            bs['binds'] = [bind for bind in binds
+                           if bind.get('index') not in skipped.get(bind.get('mesh'), ())]
+
+################################################################
+def applyModifiersAsMesh(obj, depsgraph):
+    """
+    Replaces the object with a mesh object of its evaluated geometry,
+    without the operators. A curve is replaced by a new mesh object of
+    the same name.
+
+    Returns
+    -------
+    bpy.types.Object
+      The mesh object
+    """
+    if obj.type == 'MESH' and not obj.modifiers:
+        return obj
+
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = bpy.data.meshes.new_from_object(evaluated,
+                                           preserve_all_data_layers=True,
+                                           depsgraph=depsgraph)
+    old = obj.data
+    if obj.type == 'MESH':
+        obj.modifiers.clear()
+        obj.data = mesh
+    else:
+        name = obj.name
+        meshObj = bpy.data.objects.new(f'{name}.mesh', mesh)
+        for collection in obj.users_collection:
+            collection.objects.link(meshObj)
+        meshObj.parent = obj.parent
+        meshObj.parent_type = obj.parent_type
+        meshObj.parent_bone = obj.parent_bone
+        meshObj.matrix_parent_inverse = obj.matrix_parent_inverse.copy()
+        meshObj.matrix_basis = obj.matrix_basis.copy()
+
+        # Copy the materials linked to the object.
+        for src, dst in zip(obj.material_slots, meshObj.material_slots):
+            if src.link == 'OBJECT':
+                dst.link = 'OBJECT'
+                dst.material = src.material
+
+        # Move the children to the new object without moving them.
+        for child in obj.children:
+            matrix_parent_inverse = child.matrix_parent_inverse.copy()
+            child.parent = meshObj
+            child.matrix_parent_inverse = matrix_parent_inverse
+
+        bpy.data.objects.remove(obj)
+        meshObj.name = name
+        obj = meshObj
+
+    # Free the original data as soon as possible.
+    if old.users == 0:
+        if isinstance(old, bpy.types.Mesh):
+            bpy.data.meshes.remove(old)
+        else:
+            bpy.data.curves.remove(old)
+    return obj
+
+################
+def moveOriginToWorldOrigin(obj):
+    """
+    Moves the origin of the mesh object to the world origin
+    without moving the vertices in the world.
+    """
+    matrix = np.array(obj.matrix_world)
+    offset = (np.linalg.pinv(matrix[:3, :3]) @ matrix[:3, 3]).astype(np.float32)
+    if not np.any(offset):
+        return
+
+    mesh = obj.data
+    coords = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coords)
+    mesh.vertices.foreach_set('co', (coords.reshape(-1, 3) + offset).ravel())
+    if mesh.shape_keys:
+        for kb in mesh.shape_keys.key_blocks:
+            kb.data.foreach_get('co', coords)
+            kb.data.foreach_set('co', (coords.reshape(-1, 3) + offset).ravel())
+    mesh.update()
+
+    matrix_world = obj.matrix_world.copy()
+    matrix_world.translation = (0, 0, 0)
+    obj.matrix_world = matrix_world
+
+    # Keep the children in place.
+    compensation = Matrix.Translation(offset.tolist())
+    for child in obj.children:
+        if child.parent_type == 'OBJECT':
+            child.matrix_parent_inverse = compensation @ child.matrix_parent_inverse
+
+################
+def ensureCustomNormals(mesh):
+    """
+    Stores the current normals of the mesh as custom normals.
+    """
+    if mesh.has_custom_normals:
+        return
+    normals = iu.get_corner_normals(mesh)
+    if hasattr(mesh, 'use_auto_smooth'):
+        mesh.use_auto_smooth = True
+    mesh.normals_split_custom_set(normals.tolist())
+
+################
+def triangulateNgons(mesh):
+    """
+    Triangulates only the polygons which have more than 3 vertices.
+
+    Returns
+    -------
+    int
+      Number of triangulated polygons
+    """
+    face_sizes = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', face_sizes)
+    ngons = np.flatnonzero(face_sizes > 3)
+    if len(ngons) == 0:
+        return 0
+
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bm.faces.ensure_lookup_table()
+    bmesh.ops.triangulate(bm, faces=[bm.faces[idx] for idx in ngons.tolist()],
+                          quad_method='BEAUTY', ngon_method='BEAUTY')
+    bm.to_mesh(mesh)
+    bm.free()
+    return len(ngons)
+
+################
+def removeOrphanMeshes(names):
+    """
+    Frees the meshes left without users, e.g. by bpy.ops.object.join().
+    """
+    for name in names:
+        mesh = bpy.data.meshes.get(name)
+        if mesh and mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+
+################################################################
+def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None,
+                shapekeyTolerance=1e-6, skippedShapekeys=None,
+                stageRecords=None):
     """
     Based on the json, merge and triangulate the mesh.
 
@@ -417,6 +1224,15 @@ def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
 
     removeMatDic : dict of MaterialInfo
       Material informations to remove transparent polygons.
+
+    shapekeyTolerance : float
+      Shapekeys whose maximum vertex offset is less than this are not baked.
+
+    skippedShapekeys : dict
+      If given, receives a set of skipped shapekey names for each mesh name.
+
+    stageRecords : list
+      If given, receives the time and the memory usage of each object.
     """
 
     # A dictionary to get a set of actions from mesh names.
@@ -439,30 +1255,20 @@ def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
 
     # For every child meshes, apply modifiers, set origin to (0,0,0),
     # ensure custom normals, and truangulate.
-    cursor_location_save = bpy.context.scene.cursor.location
-    bpy.context.scene.cursor.location = (0, 0, 0)
+    # One object at a time, so that only one evaluated copy is alive.
     bpy.context.view_layer.objects.active = arma.obj
     bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
     for obj in iu.getAllChildren(arma.obj, ['MESH', 'CURVE'], selectable=True):
-        bpy.context.view_layer.objects.active = obj.obj
-        obj.select_set(True)
-        bpy.ops.object.convert(target='MESH')
-        bpy.ops.object.origin_set(type='ORIGIN_CURSOR', center='BOUNDS')
-        bpy.ops.mesh.customdata_custom_splitnormals_add()
-        obj.obj.data.use_auto_smooth = True
-        if triangulate:
-            bm = bmesh.new()
-            bm.from_mesh(obj.obj.data)
-            bmesh.ops.triangulate(bm, faces=bm.faces,
-                                  quad_method='BEAUTY', ngon_method='BEAUTY')
-            bm.to_mesh(obj.obj.data)
-            bm.free()
-        if removeMatDic:
-            delete_transparent_faces(obj.obj, removeMatDic)
-            iu.remove_isolated_edges_and_vertices(obj.obj)
-
-    bpy.context.scene.cursor.location = cursor_location_save
+        with iu.measure_stage('evaluateMesh', stageRecords, obj.name):
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+            meshObj = applyModifiersAsMesh(obj.obj, depsgraph)
+            moveOriginToWorldOrigin(meshObj)
+            ensureCustomNormals(meshObj.data)
+            if triangulate:
+                triangulateNgons(meshObj.data)
+            if removeMatDic:
+                delete_transparent_faces(meshObj, removeMatDic)
+                iu.remove_isolated_edges_and_vertices(meshObj)
 
     # clear pose
     with iu.mode_context(arma.obj, 'POSE'):
@@ -493,8 +1299,11 @@ def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
                 obj.select_set(True)
                 target = obj
         if target:
+            joined = [obj.data.name for obj in collection.all_objects
+                      if obj.type == 'MESH' and obj != target]
             bpy.context.view_layer.objects.active = target
             bpy.ops.object.join()
+            removeOrphanMeshes(joined)
             bpy.ops.object.modifier_add(type='ARMATURE')
             bpy.context.object.modifiers[-1].object = arma.obj
             target.name = mn
@@ -503,13 +1312,16 @@ def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
     # Merge rest of meshes.
     bpy.ops.object.select_all(action='DESELECT')
     target = None
+    joined = []
     for obj in iu.getAllChildMeshes(arma.obj):
         if obj.name not in meshToActions:
             obj.select_set(True)
             target = obj.obj
+            joined.append(obj.data.name)
     if target:
         bpy.context.view_layer.objects.active = target
         bpy.ops.object.join()
+        removeOrphanMeshes(joined)
         bpy.ops.object.modifier_add(type='ARMATURE')
         bpy.context.object.modifiers[-1].object = arma.obj
         result[None] = iu.ObjectWrapper(target.name)
@@ -523,35 +1335,409 @@ def mergeMeshes(arma, bs_dic, triangulate=True, removeMatDic=None):
             print(f'Warning! Mesh {mn} is not merged')
             continue
 
-        for an in sorted(actions):
-            #print(f'action: {an}')
-            action = bpy.data.actions.get(an)
-            if not action:
-                print(f'Warning! Cannot find action {an}')
-                continue
+        with iu.measure_stage('bakeShapekeys', stageRecords, mn):
+            # Read weights once, and deform only the influenced vertices per action.
+            weights = wt.get_sparse_vertex_weights(mesh.obj)
 
-            bpy.context.view_layer.objects.active = mesh.obj
+            for an in sorted(actions):
+                #print(f'action: {an}')
+                action = bpy.data.actions.get(an)
+                if not action:
+                    print(f'Warning! Cannot find action {an}')
+                    continue
 
-            # for stretch bones, call twice
-            anim.action = action
-            anim.action = action
+                bpy.context.view_layer.objects.active = mesh.obj
+
+                # for stretch bones, call twice
+                anim.action = action
+                anim.action = action
+                bpy.context.view_layer.update()
             
-            # At this point, mesh has only a 'Armature' modifier
-            mod = mesh.obj.modifiers[-1]
-            modName = mod.name  # save
-            mod.name = an       # set to action's name
-            bpy.ops.object.modifier_apply_as_shapekey(keep_modifier=True, modifier=an)
-            mod.name = modName  # restore
+                # At this point, mesh has only a 'Armature' modifier
+                if not bakePoseAsShapekey(mesh.obj, arma.obj, an, weights,
+                                          tolerance=shapekeyTolerance):
+                    if skippedShapekeys is not None:
+                        skippedShapekeys.setdefault(mn, set()).add(an)
             
-            # Be sure to reset pose
-            anim.action=None
-            with iu.mode_context(arma.obj, 'POSE'):
-                # for stretch bones, call twice
-                bpy.ops.pose.transforms_clear()
-                bpy.ops.pose.transforms_clear()
+                # Be sure to reset pose
+                anim.action=None
+                with iu.mode_context(arma.obj, 'POSE'):
+                    # for stretch bones, call twice
+                    bpy.ops.pose.transforms_clear()
+                    bpy.ops.pose.transforms_clear()
+
+    return result
+
+################################################################
+def estimateMeshBytes(obj):
+    """
+    Roughly estimates the size in bytes of the mesh data to export.
+    """
+    mesh = obj.data
+    num_vertices = len(mesh.vertices)
+    num_loops = len(mesh.loops)
+    size = num_vertices * 12 + num_loops * 4
+    size += len(mesh.uv_layers) * num_loops * 8
+    for attr in mesh.color_attributes:
+        count = num_vertices if attr.domain == 'POINT' else num_loops
+        size += count * 16
+    if mesh.has_custom_normals:
+        size += num_loops * 12
+    if mesh.shape_keys:
+        size += (len(mesh.shape_keys.key_blocks) - 1) * num_vertices * 12
+    size += sum(len(vtx.groups) for vtx in mesh.vertices) * 8
+    return size
+
+################################################################
+def compactMesh(obj, weldDistance=1e-6):
+    """
+    Compacts the mesh for export.
+    Removes UV maps and color attributes not used by the materials and
+    empty vertex groups, and welds vertices that have the same position,
+    weights and shapekey offsets.
+
+    Parameters
+    ----------------
+    obj : bpy.types.Object
+      Mesh object
+
+    weldDistance : float
+      Vertices whose positions and shapekey offsets are all closer than
+      this are welded.
+
+    Returns
+    -------
+    (int, int)
+      Estimated bytes before and after.
+    """
+    mesh = obj.data
+    bytes_before = estimateMeshBytes(obj)
+
+    # Remove UV maps and color attributes not used by the materials.
+    uv_names = set()
+    attribute_names = set()
+    for mat in mesh.materials:
+        uvs, attrs = mt.collectReferencedAttributeNames(mat)
+        uv_names |= uvs
+        attribute_names |= attrs
+    default_uv = next((uv.name for uv in mesh.uv_layers if uv.active_render), None)
+    if '' in uv_names and default_uv:
+        uv_names.add(default_uv)
+    for name in [uv.name for uv in mesh.uv_layers if uv.name not in uv_names]:
+        if name != default_uv:
+            print(f'Removed UV map({name}) of {obj.name}')
+            mesh.uv_layers.remove(mesh.uv_layers[name])
+    for name in [attr.name for attr in mesh.color_attributes
+                 if attr.name not in attribute_names]:
+        print(f'Removed color attribute({name}) of {obj.name}')
+        mesh.color_attributes.remove(mesh.color_attributes[name])
+
+    # Remove empty vertex groups.
+    vi, gi, ww = wt.get_sparse_vertex_weights(obj)
+    used_groups = set(np.unique(gi[ww > 0]).tolist())
+    empty_groups = [vg.name for vg in obj.vertex_groups if vg.index not in used_groups]
+    for name in empty_groups:
+        obj.vertex_groups.remove(obj.vertex_groups[name])
+    if empty_groups:
+        print(f'Removed empty vertex groups of {obj.name}: {empty_groups}')
+        vi, gi, ww = wt.get_sparse_vertex_weights(obj)
+
+    # Find the vertices whose position and shapekey offsets are close.
+    num_vertices = len(mesh.vertices)
+    coords = np.empty(num_vertices * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coords)
+    coords = coords.reshape(-1, 3)
+    points = [coords]
+
+    if mesh.shape_keys:
+        for kb in mesh.shape_keys.key_blocks[1:]:
+            offsets = np.empty(num_vertices * 3, dtype=np.float32)
+            kb.data.foreach_get('co', offsets)
+            points.append(offsets.reshape(-1, 3) - coords)
+
+    points = np.stack(points, axis=1)
+    qi, pi = mu.find_pairs_within(points, points, weldDistance)
+
+    # Only the vertices with exactly the same weights are welded.
+    weights = [[] for _ in range(num_vertices)]
+    for vv, gg, ws in zip(vi.tolist(), gi.tolist(), np.round(ww, 5).tolist()):
+        if ws > 0:
+            weights[vv].append((gg, ws))
+    weight_ids = dict()
+    weight_keys = np.array([weight_ids.setdefault(tuple(sorted(ws)), len(weight_ids))
+                            for ws in weights], dtype=np.int64)
+    same = (qi != pi) & (weight_keys[qi] == weight_keys[pi])
+
+    targets = mu.group_pairs(num_vertices, qi[same], pi[same])
+    doubles = np.flatnonzero(targets != np.arange(num_vertices))
+
+    if len(doubles) > 0:
+        # Keep custom normals of the remaining loops.
+        normals = iu.get_corner_normals(mesh) if mesh.has_custom_normals else None
+
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bm.verts.ensure_lookup_table()
+        if normals is not None:
+            layer = bm.loops.layers.int.new('_dddt_loop_index')
+            for face in bm.faces:
+                for loop in face.loops:
+                    loop[layer] = loop.index
+        targetmap = {bm.verts[ii]: bm.verts[targets[ii]] for ii in doubles.tolist()}
+        bmesh.ops.weld_verts(bm, targetmap=targetmap)
+        bm.to_mesh(mesh)
+        bm.free()
+
+        if normals is not None:
+            attr = mesh.attributes['_dddt_loop_index']
+            loop_indices = np.empty(len(mesh.loops), dtype=np.int32)
+            attr.data.foreach_get('value', loop_indices)
+            mesh.attributes.remove(attr)
+            mesh.normals_split_custom_set(normals[loop_indices].tolist())
+        mesh.update()
+        print(f'Welded {len(doubles)} vertices of {obj.name}')
+
+    bytes_after = estimateMeshBytes(obj)
+    print(f'Compacted {obj.name}: {bytes_before} -> {bytes_after} bytes (saved {bytes_before - bytes_after} bytes)')
+    return bytes_before, bytes_after
+
+################################################################
+def readImagePixels(image):
+    """
+    Returns the pixels of the image as a (height, width, 4) array.
+    """
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)
+
+################
+def buildTextureAtlas(obj, maxSize=4096, padding=4, cache=None,
+                      excludeMaterials=set()):
+    """
+    Merges compatible materials of the mesh into materials using texture
+    atlases. Materials which differ only in their images are grouped,
+    their images are packed into one atlas per texture node, and the UVs
+    of the polygons are remapped into the atlas.
+
+    Parameters
+    ----------------
+    obj : bpy.types.Object
+      Mesh object
+
+    maxSize : int
+      Maximum width and height of the atlas
+
+    padding : int
+      Pixels to extend the edges of each texture
+
+    cache : dict
+      If given, atlases are shared between calls by the set of materials.
+
+    excludeMaterials : set of String
+      Names of the materials not to merge, such as the materials whose
+      values are changed by blendshapes.
+
+    Returns
+    -------
+    dict
+      Name of the atlas material to the names of the merged materials.
+    """
+    mesh = obj.data
+    result = dict()
+    uv_layer = next((uv for uv in mesh.uv_layers if uv.active_render), None)
+    num_polygons = len(mesh.polygons)
+    if not uv_layer or num_polygons == 0 or len(mesh.materials) < 2:
+        return result
+    if cache is None:
+        cache = dict()
+
+    material_indices = np.empty(num_polygons, dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', material_indices)
+    face_sizes = np.empty(num_polygons, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', face_sizes)
+    loop_starts = np.empty(num_polygons, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    order = np.argsort(loop_starts)
+    loop_materials = np.repeat(material_indices[order], face_sizes[order])
+
+    uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uvs)
+    uvs = uvs.reshape(-1, 2)
+
+    # Group the materials which can share an atlas.
+    groups = OrderedDict()
+    seen = set()
+    for idx, mat in enumerate(mesh.materials):
+        if not mat or mat.name in seen:
+            continue
+        seen.add(mat.name)
+        if mat.name in excludeMaterials:
+            continue
+        in_slot = loop_materials == idx
+        if not np.any(in_slot):
+            continue
+        uv_names, _ = mt.collectReferencedAttributeNames(mat)
+        if uv_names - {'', uv_layer.name}:
+            continue
+        slot_uvs = uvs[in_slot]
+        if np.any(slot_uvs < -1e-4) or np.any(slot_uvs > 1 + 1e-4):
+            print(f'Material({mat.name}): UVs out of [0, 1] are not atlased.')
+            continue
+        key, image_nodes = mt.getAtlasCompatibilityKey(mat)
+        if key is None:
+            continue
+        groups.setdefault(key, (image_nodes, []))[1].append(idx)
+
+    merged_slots = []
+    for image_nodes, slots in groups.values():
+        if len(slots) < 2 or not image_nodes:
+            continue
+        materials = [mesh.materials[idx] for idx in slots]
+        cache_key = tuple(mat.name for mat in materials)
+
+        if cache_key not in cache:
+            # Size of each slot is the largest image of the material.
+            sizes = np.array([[max(mat.node_tree.nodes[name].image.size[axis]
+                                   for name in image_nodes)
+                               for axis in range(2)]
+                              for mat in materials], dtype=np.int64)
+            sizes = np.maximum(sizes, 1)
+            while True:
+                positions, width, height = mu.pack_rectangles(sizes + padding * 2, maxSize)
+                if positions is not None or np.max(sizes) <= 1:
+                    break
+                sizes = np.maximum(sizes // 2, 1)
+            if positions is None:
+                print(f'Cannot pack textures of {list(cache_key)} into {maxSize}px.')
+                cache[cache_key] = None
+                continue
+
+            # Build an atlas image for each image texture node.
+            atlas_mat = materials[0].copy()
+            atlas_mat.name = f'{materials[0].name}_Atlas'
+            for name in image_nodes:
+                images = [mat.node_tree.nodes[name].image for mat in materials]
+                pixels = np.zeros((height, width, 4), dtype=np.float32)
+                for image, (sw, sh), (px, py) in zip(images, sizes.tolist(), positions.tolist()):
+                    src = readImagePixels(image)
+                    # Nearest neighbour resampling with padded edges
+                    xs = np.clip(np.arange(-padding, sw + padding), 0, sw - 1)
+                    ys = np.clip(np.arange(-padding, sh + padding), 0, sh - 1)
+                    xs = ((xs + 0.5) * src.shape[1] / sw).astype(np.int64)
+                    ys = ((ys + 0.5) * src.shape[0] / sh).astype(np.int64)
+                    pixels[py:py + len(ys), px:px + len(xs)] = src[ys][:, xs]
+
+                atlas = bpy.data.images.new(f'{atlas_mat.name}_{name}', width, height,
+                                            alpha=True,
+                                            float_buffer=any(img.is_float for img in images))
+                atlas.colorspace_settings.name = images[0].colorspace_settings.name
+                atlas.alpha_mode = images[0].alpha_mode
+                atlas.pixels.foreach_set(pixels.ravel())
+                atlas.file_format = 'PNG'
+                atlas.pack()
+                atlas_mat.node_tree.nodes[name].image = atlas
+
+            offsets = (positions + padding) / (width, height)
+            scales = sizes / (width, height)
+            cache[cache_key] = (atlas_mat.name, offsets, scales)
+            print(f'Built texture atlas({atlas_mat.name}): {width}x{height} for {list(cache_key)}')
+
+        if not cache[cache_key]:
+            continue
+        atlas_name, offsets, scales = cache[cache_key]
+
+        # Remap UVs and collapse the slots into the first one.
+        for idx, offset, scale in zip(slots, offsets, scales):
+            in_slot = loop_materials == idx
+            uvs[in_slot] = uvs[in_slot] * scale + offset
+            material_indices[material_indices == idx] = slots[0]
+        mesh.materials[slots[0]] = bpy.data.materials[atlas_name]
+        merged_slots.extend(slots[1:])
+        result[atlas_name] = list(cache_key)
+
+    if result:
+        uv_layer.data.foreach_set('uv', uvs.ravel())
+        mesh.polygons.foreach_set('material_index', material_indices)
+        for idx in sorted(merged_slots, reverse=True):
+            mesh.materials.pop(index=idx)
+        mesh.update()
 
     return result
 
+################################################################
+def optimizeMeshVertexCache(obj, cacheSize=32):
+    """
+    Reorders polygons and vertices of the mesh for the GPU vertex cache.
+    Polygons are ordered by Tipsify and vertices are renumbered in the
+    order of first use. Weights, shapekeys, UVs and normals are kept.
+
+    Parameters
+    ----------------
+    obj : bpy.types.Object
+      Mesh object
+
+    cacheSize : int
+      Size of the vertex cache
+
+    Returns
+    -------
+    (float, float)
+      ACMR before and after the optimization.
+    """
+    mesh = obj.data
+    num_vertices = len(mesh.vertices)
+    num_polygons = len(mesh.polygons)
+    if num_polygons == 0:
+        return 0.0, 0.0
+
+    face_sizes = np.empty(num_polygons, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', face_sizes)
+    loop_starts = np.empty(num_polygons, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_vertices)
+
+    # 面の順に並べる
+    loop_order = np.concatenate([np.arange(start, start + size)
+                                 for start, size in zip(loop_starts, face_sizes)])
+    loop_vertices = loop_vertices[loop_order]
+
+    acmr_before = mu.compute_acmr(loop_vertices, face_sizes, cacheSize)
+
+    face_order = mu.tipsify(loop_vertices, face_sizes, num_vertices, cacheSize)
+    face_rank = np.empty(num_polygons, dtype=np.int64)
+    face_rank[face_order] = np.arange(num_polygons)
+
+    # 新しい面の順で、最初に使われた順に頂点を並べる
+    face_starts = np.concatenate(([0], np.cumsum(face_sizes)))
+    new_loop_vertices = np.concatenate([loop_vertices[face_starts[ff]:face_starts[ff + 1]]
+                                        for ff in face_order])
+    _, first = np.unique(new_loop_vertices, return_index=True)
+    used = new_loop_vertices[np.sort(first)]
+    vertex_rank = np.full(num_vertices, num_vertices, dtype=np.int64)
+    vertex_rank[used] = np.arange(len(used))
+    unused = vertex_rank == num_vertices
+    vertex_rank[unused] = np.arange(len(used), num_vertices)
+
+    acmr_after = mu.compute_acmr(vertex_rank[new_loop_vertices],
+                                 face_sizes[face_order], cacheSize)
+
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    bm.verts.index_update()
+    bm.faces.index_update()
+    face_rank = face_rank.tolist()
+    vertex_rank = vertex_rank.tolist()
+    bm.faces.sort(key=lambda face: face_rank[face.index])
+    bm.verts.sort(key=lambda vtx: vertex_rank[vtx.index])
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.update()
+
+    print(f'Optimized vertex cache of {obj.name}: ACMR {acmr_before:.3f} -> {acmr_after:.3f}')
+    return acmr_before, acmr_after
+
 ################################################################
 def deleteBones(arma, boneGroupName):
     """
@@ -625,7 +1811,7 @@ def migrateSpringBone(arma, sb_json, removeEmpty):
     applyCollidersScale(arma.obj)
 
     # migrate
-    sb_dic = json.loads(textblock2str(bpy.data.texts[sb_json]),object_pairs_hook=OrderedDict)
+    sb_dic = copy.deepcopy(loadJsonTextblock(sb_json)[0])
     va.editor.vrm0.migration.migrate_vrm0_secondary_animation(
         ext.vrm0.secondary_animation,
         sb_dic,
@@ -633,37 +1819,36 @@ def migrateSpringBone(arma, sb_json, removeEmpty):
         arma.obj.data)
 
 ################################################################
-def checkBrendShape(bs_dic):
-    has_error = False
-    meshes = set()
+def removeMissingMaterialValues(bs_dic, index):
+    """
+    Remove materialValues that refer to missing materials, so that a
+    stale material does not block the migration of all the blendshapes.
+
+    Parameters
+    ----------------
+    bs_dic : list
+      Contents of blendshape_group.json
+
+    index : SceneIndex
+      Name indexes of the scene
+    """
     for bs in bs_dic:
-        binds = bs.get('binds')
-        if binds:
-            for bind in binds:
-                mesh = bind.get('mesh')
-                index = bind.get('index')
-                if mesh:
-                    meshes.add(mesh)
-                    mesh_obj = bpy.data.objects.get(mesh)
-                    if mesh_obj and mesh_obj.type == 'MESH' and\
-                       mesh_obj.data.shape_keys and\
-                       index not in mesh_obj.data.shape_keys.key_blocks:
-                        has_error = True
-                        print(f'Warning! Cannot find shapekey({index}) in mesh({mesh}).')
-
-    for mesh in meshes:
-        mesh_obj = bpy.data.objects.get(mesh)
-        if not mesh_obj:
-            has_error = True
-            print(f'Warning! Cannot find object({mesh}).')
-        elif mesh_obj.type != 'MESH':
-            has_error = True
-            print(f'Warning! Object({mesh}) is not a mesh.')
-        elif not mesh_obj.data.shape_keys:
-            has_error = True
-            print(f'Warning! Object({mesh}) does not have shepe_keys')
-
-    return not has_error
+        values = bs.get('materialValues')
+        if values:
+            for mv in values:
+                if mv.get('materialName') not in index.materials:
+                    print(f"Warning! Cannot find material({mv.get('materialName')}). Removed from {bs.get('name')}.")
+            bs['materialValues'] = [mv for mv in values
+                                    if mv.get('materialName') in index.materials]
+
+################
+def checkBrendShape(bs_dic):
+    index = buildSceneIndex()
+    removeMissingMaterialValues(bs_dic, index)
+    errors = validateBlendShape(bs_dic, index)
+    for error in errors:
+        print(f'Warning! {error}')
+    return not errors
 
 ################################################################
 def migrateBlendShape(armature, bs_json):
@@ -675,7 +1860,7 @@ def migrateBlendShape(armature, bs_json):
 
     # clear old data
     ext.vrm0.blend_shape_master.blend_shape_groups.clear()
-    bs_dic = json.loads(textblock2str(bpy.data.texts[bs_json]),object_pairs_hook=OrderedDict)
+    bs_dic = copy.deepcopy(loadJsonTextblock(bs_json)[0])
     
     # migrate blendshape_group.json
     if checkBrendShape(bs_dic):
@@ -696,7 +1881,12 @@ def prepareToExportVRM(skeleton='skeleton',
                        removeUnusedMaterialSlots=False,
                        neutral='Neutral',
                        sb_json=None,
-                       removeEmpty=True):
+                       removeEmpty=True,
+                       buildTextureAtlas=False,
+                       atlasMaxSize=4096,
+                       compactMeshes=False,
+                       optimizeVertexCache=False,
+                       stageRecords=None):
     """
     Prepares to export.
     
@@ -712,6 +1902,17 @@ def prepareToExportVRM(skeleton='skeleton',
         Name of shapekey of basic face expression
     sb_json : String
         Name of textblock of spring_bone.json
+    buildTextureAtlas : bool
+        Whether to merge materials which differ only in their textures
+    atlasMaxSize : int
+        Maximum width and height of the texture atlas
+    compactMeshes : bool
+        Whether to remove unused data and weld duplicated vertices
+    optimizeVertexCache : bool
+        Whether to reorder polygons and vertices for the GPU vertex cache
+    stageRecords : list
+        If given, receives the time and the memory usage of each stage.
+        The stages after mergeMeshes are recorded for each merged mesh.
     """
 
     arma = iu.ObjectWrapper(skeleton)
@@ -724,45 +1925,123 @@ def prepareToExportVRM(skeleton='skeleton',
 
     # clear old data
     ext.vrm0.blend_shape_master.blend_shape_groups.clear()
-    bs_dic = json.loads(textblock2str(bpy.data.texts[bs_json]),object_pairs_hook=OrderedDict)
+    # removeSkippedBinds() modifies the bs_dic.
+    bs_dic = copy.deepcopy(loadJsonTextblock(bs_json)[0])
 
     if removeTransparentPolygons:
         removeMatDic = buildRemoveMatDic(interval, alphaThreshold, excludeMaterials)
     else:
         removeMatDic = None
 
-    mergedObjs = mergeMeshes(arma, bs_dic, triangulate=triangulate, removeMatDic=removeMatDic)
+    skippedShapekeys = dict()
+    with iu.measure_stage('mergeMeshes', stageRecords):
+        mergedObjs = mergeMeshes(arma, bs_dic, triangulate=triangulate,
+                                 removeMatDic=removeMatDic,
+                                 skippedShapekeys=skippedShapekeys,
+                                 stageRecords=stageRecords)
+    if skippedShapekeys:
+        print(f'Skipped shapekeys: {skippedShapekeys}')
+        removeSkippedBinds(bs_dic, skippedShapekeys)
 
     #print('---------------- mergedObjs:')
     #print(mergedObjs)
 
-    deleteBones(arma, notExport)
-
+    with iu.measure_stage('deleteBones', stageRecords):
+        deleteBones(arma, notExport)
+
+    # Run all the stages on one merged mesh before the next one, so that
+    # the intermediate data of only one mesh is alive at a time.
+    atlasCache = dict()
+    # Blendshapes refer to the materials by name and may offset their UVs,
+    # so the materials they change are kept out of the atlases.
+    blendShapeMaterials = {mv.get('materialName')
+                           for bs in bs_dic
+                           for mv in bs.get('materialValues') or []}
+    saved = 0
     for pose, obj in mergedObjs.items():
-        if pose:
-            # FIXME
-            #  not work...
-            #iu.setShapekeyToBasis(obj, shapekey=neutral)
-            pass
-        wt.cleanupWeights(obj)
-
-        if removeUnusedMaterialSlots:
-            print(f'removeUnusedMaterialSlots obj:{obj.name}')
-            with iu.mode_context(obj.obj, 'OBJECT'):
-                bpy.ops.object.material_slot_remove_unused()
-
-        if materialOrderList:
-            print(f'sort_material_slots obj:{obj.name}')
-            mt.sort_material_slots(obj.obj, materialOrderList)
+        if buildTextureAtlas:
+            with iu.measure_stage('buildTextureAtlas', stageRecords, obj.name):
+                merged = buildTextureAtlas(obj.obj, maxSize=atlasMaxSize,
+                                           cache=atlasCache,
+                                           excludeMaterials=blendShapeMaterials)
+                if materialOrderList:
+                    # The atlas takes the place of the first merged material.
+                    for atlasName, names in merged.items():
+                        materialOrderList = [atlasName if name == names[0] else name
+                                             for name in materialOrderList
+                                             if name not in names[1:]]
+
+        with iu.measure_stage('cleanupMeshes', stageRecords, obj.name):
+            if pose:
+                # FIXME
+                #  not work...
+                #iu.setShapekeyToBasis(obj, shapekey=neutral)
+                pass
+            wt.cleanupWeights(obj)
+
+            if removeUnusedMaterialSlots or materialOrderList:
+                removed = mt.cleanup_material_slots(obj.obj, materialOrderList,
+                                                    remove_unused=removeUnusedMaterialSlots)
+                print(f'cleanup_material_slots obj:{obj.name} removed:{removed}')
+
+        if compactMeshes:
+            with iu.measure_stage('compactMeshes', stageRecords, obj.name):
+                before, after = compactMesh(obj.obj)
+                saved += before - after
+
+        if optimizeVertexCache:
+            with iu.measure_stage('optimizeVertexCache', stageRecords, obj.name):
+                optimizeMeshVertexCache(obj.obj)
+
+    if compactMeshes:
+        print(f'Compacted meshes: saved {saved} bytes')
 
     # migrate blendshape_group.json
-    if checkBrendShape(bs_dic):
-        va.editor.vrm0.migration.migrate_vrm0_blend_shape_groups(
-            ext.vrm0.blend_shape_master,
-            bs_dic)
+    with iu.measure_stage('migrateBlendShape', stageRecords):
+        if checkBrendShape(bs_dic):
+            va.editor.vrm0.migration.migrate_vrm0_blend_shape_groups(
+                ext.vrm0.blend_shape_master,
+                bs_dic)
 
     # migrate spring_bone.json
     if sb_json:
-        migrateSpringBone(arma, sb_json, removeEmpty)
+        with iu.measure_stage('migrateSpringBone', stageRecords):
+            migrateSpringBone(arma, sb_json, removeEmpty)
 
     return mergedObjs
+
+################################################################
+def prepareAndSaveForExport(settings, mergedName='MergedBody', filepath=None,
+                            stageRecords=None):
+    """
+    Prepares to export and saves the result as *.export.blend.
+
+    Parameters
+    ----------------
+    settings : dict
+        Keyword arguments of prepareToExportVRM()
+    mergedName : String
+        Name for the merged mesh of the rest meshes
+    filepath : String
+        Path to save. None to save as *.export.blend next to the current file.
+    stageRecords : list
+        If given, receives the time spent in each stage.
+
+    Returns
+    -------
+    String
+        Saved path, or None if nothing is merged.
+    """
+    mergedObjs = prepareToExportVRM(**settings, stageRecords=stageRecords)
+    if not mergedObjs:
+        return None
+
+    if None in mergedObjs:
+        mergedObjs[None].rename(mergedName)
+
+    if not filepath:
+        base, ext = os.path.splitext(bpy.data.filepath)
+        filepath = f'{base}.export{ext}'
+    with iu.measure_stage('save', stageRecords):
+        bpy.ops.wm.save_as_mainfile(filepath=filepath)
+    return filepath
@@ -46,6 +46,38 @@ def get_vertex_weights(mesh_obj):
 
     return vertex_weights
 
+################
+def get_sparse_vertex_weights(mesh_obj):
+    """
+    Get vertex weights as sparse arrays.
+    Only the weights actually assigned to the vertices are listed, so
+    the cost is proportional to the number of assignments rather than
+    (number of vertices) x (number of vertex groups).
+
+    Parameters:
+    -----------
+    mesh_obj : bpy.types.Object
+      Mesh object
+
+    Returns:
+    --------
+    (np.ndarray, np.ndarray, np.ndarray)
+      Vertex indices, vertex group indices and weights.
+    """
+
+    vertex_indices = []
+    group_indices = []
+    weights = []
+    for vtx in mesh_obj.data.vertices:
+        for vge in vtx.groups:
+            vertex_indices.append(vtx.index)
+            group_indices.append(vge.group)
+            weights.append(vge.weight)
+
+    return (np.array(vertex_indices, dtype=np.int64),
+            np.array(group_indices, dtype=np.int64),
+            np.array(weights, dtype=np.float64))
+
 ################
 def set_vertex_weights(mesh_obj, vertex_weights,
                        which_to_set=None,
@@ -449,14 +481,43 @@ def cleanupVertexGroups(mesh):
     return result
 
 ################################################################
-def findAncestorDeformerBone(bone, excludeBones):
-    if not excludeBones:
-        excludeBones = dict()
-    result = None
-    while bone:
-        if bone.bone.use_deform and bone.name not in excludeBones:
-            return bone
-        bone = bone.parent
+def findAncestorDeformerBones(arma, boneNames, excludeBones):
+    """
+    Finds the nearest deforming ancestor of each bone at once.
+
+    Parameters
+    ----------------
+    arma : bpy.types.Object
+        armature
+
+    boneNames : Array of String
+        Names of bones whose ancestors are searched.
+
+    excludeBones : Collection of String
+        Names of bones which are not regarded as deformers.
+
+    Returns
+    ----------------
+    Dictionary of bone name to ancestor bone name, or None if not found.
+    """
+    topology = bt.get_armature_topology(arma)
+    excluded = np.zeros(len(topology), dtype=bool)
+    if excludeBones:
+        excluded[topology.indices(name for name in excludeBones
+                                  if name in topology.name_to_index)] = True
+
+    # Nearest deformer of each bone including itself, from parents to children
+    candidates = topology.deform & ~excluded
+    nearest = np.where(candidates, np.arange(len(topology)), -1)
+    topology.propagate_down(nearest,
+                            lambda child, parent: np.where(child >= 0, child, parent))
+
+    result = dict()
+    for boneName, idx in zip(boneNames, topology.indices(boneNames).tolist()):
+        parent = topology.parents[idx]
+        ancestor = nearest[parent] if parent >= 0 else -1
+        result[boneName] = topology.names[ancestor] if ancestor >= 0 else None
+    return result
 
 ################################################################
 def dissolveWeightedBones(arma, boneNames):
@@ -478,11 +539,11 @@ def dissolveWeightedBones(arma, boneNames):
     # find ancestor bone to which vertex-weight to be moved
     with iu.mode_context(arma.obj, 'POSE'):
         targetBones = dict()
+        ancestors = findAncestorDeformerBones(arma.obj, boneNames, set(boneNames))
         for boneName in boneNames:
-            bone = arma.obj.pose.bones[boneName]
-            toBone = findAncestorDeformerBone(bone.parent, boneNames)
+            toBone = ancestors[boneName]
             if toBone:
-                targetBones[boneName] = toBone.name
+                targetBones[boneName] = toBone
             else:
                 print(f'Warning: Failed to find ancestor bone of {boneName}!')
                 return None
@@ -559,12 +620,8 @@ def set_weight_for_selected_bones(mesh_object, armature_object, weight):
     return count_verts, bone_names, ''
 
 ################
-# FIXME
-# mathUtils の falloff を ndarray に対応させて使いたい
 def calculate_factors(distances, radius):
-    values = distances / radius
-    factors = np.where(values <= 1, (1 - values) ** 2, 0)
-    return factors
+    return mu.compute_falloff(distances, radius, 'SHARP')
 
 ################
 def calculate_vertex_distances_by_poligon_connections(mesh_obj,
@@ -0,0 +1,266 @@
+# -*- encoding:utf-8 -*-
+
+"""
+Batch 'Preparation before VRM export' for many .blend files.
+
+Launcher (any Python 3):
+    python batchExportVRM.py --blender /path/to/blender --workers 4 \
+        [--config config.json] [--manifest manifest.json] a.blend b.blend ...
+
+The files may be glob patterns such as "models/**/*.blend", which are
+expanded by the launcher itself.
+
+Each file is processed by its own headless Blender process:
+    blender -b a.blend --python batchExportVRM.py -- --worker ...
+
+Settings are taken from the VRMTool panel saved in each file, and the
+values in the config file (keyword arguments of prepareToExportVRM() and
+'mergedName') override them. The result of every file, including the
+time and the peak memory of each stage, is written to the manifest.
+
+With --memory-budget, a file is started only when the estimated memory of
+the running processes fits in the budget. The memory of a file is
+estimated as its size times the largest ratio of peak RSS to file size
+seen so far (--memory-factor until the first file finishes).
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+################################################################
+def load_config(path):
+    if not path:
+        return dict()
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+################################################################
+# Worker (runs inside Blender)
+
+################
+def enable_addon(module_name):
+    """
+    Returns the addon package, registering it if it is not enabled yet.
+    """
+    import importlib
+    import bpy
+
+    package = sys.modules.get(module_name)
+    if package and hasattr(bpy.types.Scene, 'dddtools_vt_prop'):
+        return package
+
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(addon_dir)
+    if parent_dir not in sys.path:
+        sys.path.insert(0, parent_dir)
+    package = importlib.import_module(module_name)
+    if not hasattr(bpy.types.Scene, 'dddtools_vt_prop'):
+        package.register()
+    return package
+
+################
+def run_worker(args):
+    import bpy
+
+    result = {
+        'file': bpy.data.filepath,
+        'status': 'FAILED',
+        'output': None,
+        'stages': [],
+    }
+    start = time.perf_counter()
+    try:
+        package = enable_addon(args.addon_module)
+        ui_vt = sys.modules[f'{package.__name__}.UI_VRMTool']
+        vt = sys.modules[f'{package.__name__}.VRMTool']
+        iu = sys.modules[f'{package.__name__}.internalUtils']
+
+        if bpy.context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+
+        config = load_config(args.config)
+        mergedName = config.pop('mergedName',
+                                bpy.context.scene.dddtools_vt_prop.mergedName)
+        settings = ui_vt.getExportSettings(bpy.context.scene)
+        settings.update(config)
+        if 'excludeMaterials' in config:
+            settings['excludeMaterials'] = set(config['excludeMaterials'])
+
+        output = vt.prepareAndSaveForExport(settings,
+                                            mergedName=mergedName,
+                                            filepath=args.output,
+                                            stageRecords=result['stages'])
+        if output:
+            result['status'] = 'FINISHED'
+            result['output'] = output
+        else:
+            result['status'] = 'CANCELLED'
+    except Exception:
+        result['error'] = traceback.format_exc()
+        traceback.print_exc()
+    else:
+        result['peakRss'] = max((stage['peakRss'] for stage in result['stages']
+                                 if stage.get('peakRss')), default=None)
+
+    result['time'] = time.perf_counter() - start
+    if args.result:
+        with open(args.result, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+################################################################
+# Launcher
+
+################
+def export_file(args, blend_path):
+    """
+    Processes a .blend file in a headless Blender and returns its result.
+    """
+    fd, result_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    command = [args.blender, '-b', blend_path,
+               '--python-exit-code', '1',
+               '--python', os.path.abspath(__file__),
+               '--',
+               '--worker',
+               '--addon-module', args.addon_module,
+               '--result', result_path]
+    if args.config:
+        command += ['--config', os.path.abspath(args.config)]
+
+    start = time.perf_counter()
+    proc = subprocess.run(command, capture_output=True, text=True,
+                          encoding='utf-8', errors='replace')
+    elapsed = time.perf_counter() - start
+
+    result = {'file': blend_path, 'status': 'FAILED'}
+    try:
+        with open(result_path, encoding='utf-8') as f:
+            result.update(json.load(f))
+    except (OSError, ValueError):
+        result['error'] = proc.stderr[-4000:] or proc.stdout[-4000:]
+    finally:
+        os.remove(result_path)
+
+    result['file'] = blend_path
+    result['returncode'] = proc.returncode
+    result['wallTime'] = elapsed
+    peak = result.get('peakRss')
+    peak = f'{peak / 2**30:6.2f}GB' if peak else '     -  '
+    print(f"{result['status']:>9} {elapsed:8.2f}s {peak} {blend_path}")
+    return result
+
+################
+def export_files(args, files):
+    """
+    Processes the files with up to args.workers Blender processes,
+    keeping the estimated memory of the running processes in the budget.
+    """
+    workers = max(1, args.workers)
+    budget = args.memory_budget * 2**30
+    ratio = args.memory_factor
+
+    pending = list(files)
+    running = dict()
+    results = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while pending and len(running) < workers:
+                estimate = os.path.getsize(pending[0]) * ratio
+                reserved = sum(estimate for _, estimate in running.values())
+                # Always run at least one file, even if it exceeds the budget.
+                if budget > 0 and running and reserved + estimate > budget:
+                    break
+                path = pending.pop(0)
+                running[executor.submit(export_file, args, path)] = (path, estimate)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, _ = running.pop(future)
+                result = future.result()
+                results[path] = result
+                size = os.path.getsize(path)
+                if result.get('peakRss') and size:
+                    ratio = max(ratio, result['peakRss'] / size)
+
+    return [results[path] for path in files]
+
+################
+def expand_files(patterns):
+    """
+    Expands the glob patterns, as the shell does not on Windows.
+    Reports the patterns that match nothing.
+    """
+    files = []
+    for pattern in patterns:
+        if os.path.isfile(pattern):
+            matches = [pattern]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            print(f'No files match: {pattern}')
+        files += [os.path.abspath(path) for path in matches]
+    return list(dict.fromkeys(files))
+
+################
+def run_launcher(args):
+    files = expand_files(args.files)
+    if not files:
+        print('No .blend files are specified.')
+        return 1
+
+    start = time.perf_counter()
+    results = export_files(args, files)
+
+    manifest = {
+        'config': load_config(args.config),
+        'workers': args.workers,
+        'memoryBudget': args.memory_budget,
+        'time': time.perf_counter() - start,
+        'files': results,
+    }
+    with open(args.manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    failed = [r['file'] for r in results if r['status'] != 'FINISHED']
+    print(f'{len(results) - len(failed)}/{len(results)} files exported. Manifest: {args.manifest}')
+    return 1 if failed else 0
+
+################################################################
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Batch preparation before VRM export.')
+    parser.add_argument('files', nargs='*', help='.blend files or glob patterns to export')
+    parser.add_argument('--blender', default='blender', help='Path to Blender executable')
+    parser.add_argument('--workers', type=int, default=1, help='Number of Blender processes')
+    parser.add_argument('--config', help='JSON file overriding the settings of the files')
+    parser.add_argument('--memory-budget', type=float, default=0,
+                        help='Memory for all the Blender processes in GB (0 for no limit)')
+    parser.add_argument('--memory-factor', type=float, default=10,
+                        help='Initial estimate of the peak memory as a multiple of the file size')
+    parser.add_argument('--manifest', default='export_manifest.json', help='Path of the manifest to write')
+    parser.add_argument('--addon-module', default=os.path.basename(os.path.dirname(os.path.abspath(__file__))),
+                        help='Module name of this addon')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+################################################################
+if __name__ == '__main__':
+    if '--' in sys.argv:
+        # Blender passes the script arguments after '--'
+        args = parse_args(sys.argv[sys.argv.index('--') + 1:])
+    else:
+        args = parse_args(sys.argv[1:])
+
+    if args.worker:
+        run_worker(args)
+    else:
+        sys.exit(run_launcher(args))
@@ -1,5 +1,7 @@
 # -*- encoding:utf-8 -*-
 
+import os
+import sys
 import bpy
 import bmesh
 import gpu
@@ -16,6 +18,7 @@ import numpy as np
 import uuid
 import json
 import re
+import time
 from . import mathUtils as mu
 from dataclasses import dataclass
 
@@ -133,6 +136,126 @@ def mode_context(obj, mode):
         if prev_active:
             bpy.context.view_layer.objects.active = prev_active.obj
 
+################################################################
+def get_memory_usage():
+    """
+    現在のプロセスの常駐メモリ量 (RSS) とそのピークを返す
+
+    Returns:
+    --------
+    (int, int)
+      RSS とピークのバイト数。取得できない値は None
+    """
+    if sys.platform.startswith('linux'):
+        rss = peak = None
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+                    elif line.startswith('VmHWM:'):
+                        peak = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return rss, peak
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        psapi = ctypes.windll.psapi
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.c_void_p,
+                                               wintypes.DWORD]
+        if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(),
+                                      ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize, counters.PeakWorkingSetSize
+        return None, None
+
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in bytes on macOS
+    return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+################
+def reset_peak_memory():
+    """
+    RSS のピークをリセットする (Linux のみ)
+
+    Returns:
+    --------
+    bool
+      リセットできたら True
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+################
+_measure_stage_depth = 0
+
+@contextmanager
+def measure_stage(name, records=None, target=None):
+    """
+    ブロック内の処理時間とメモリ使用量を計測し、records に追加する
+
+    Parameters:
+    -----------
+    name : string
+      処理の名前
+    records : list
+      {'stage': 名前, 'time': 秒, 'rss': バイト, 'peakRss': バイト} が
+      追加されるリスト。None なら何もしない。
+      peakRss はピークをリセットできない環境ではプロセス開始からのピーク。
+      入れ子になったステージではピークをリセットせず、peakRss は None になる
+      (外側のステージのピークに含まれる)
+    target : string
+      処理対象の名前。指定すると 'object' として追加される
+    """
+    global _measure_stage_depth
+    outermost = _measure_stage_depth == 0
+    if records is not None and outermost:
+        reset_peak_memory()
+    _measure_stage_depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _measure_stage_depth -= 1
+        if records is not None:
+            rss, peak = get_memory_usage()
+            if not outermost:
+                peak = None
+            record = {'stage': name,
+                      'time': time.perf_counter() - start,
+                      'rss': rss,
+                      'peakRss': peak}
+            if target is not None:
+                record['object'] = target
+            records.append(record)
+
 ################################################################
 def replaceImagePath(strFrom=None , strTo=None):
     """
@@ -323,6 +446,29 @@ def blendShapekeyToBasis(meshObj, shapekey, blend=1.0, remove_shapekey=True):
                 bpy.context.active_object.active_shape_key_index = idx
                 bpy.ops.object.shape_key_remove(all=False)
 
+################
+def get_corner_normals(mesh):
+    """
+    Get normals of each loop (face corner) as an array.
+
+    Parameters:
+    -----------
+    mesh : bpy.types.Mesh
+      Mesh data
+
+    Returns:
+    --------
+    np.ndarray
+      (number of loops, 3) array of normals
+    """
+    normals = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+    if bpy.app.version < (4, 1, 0):
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get('normal', normals)
+    else:
+        mesh.corner_normals.foreach_get('vector', normals)
+    return normals.reshape(-1, 3)
+
 ################
 def remove_isolated_edges_and_vertices(obj):
     """
@@ -810,6 +956,77 @@ class BlenderGpuState:
         for state_name in self._state_names.keys():
             self._set_gpu_state(state_name, self._original_state[state_name])
 
+################
+# シェーダーとバッチのキャッシュ
+_gpu_cache = dict()
+
+################
+def get_builtin_shader(name, dimension=3):
+    """
+    組み込みシェーダーを得る。Blender 4.0 より前は 2D_ か 3D_ を付けた名前になる
+
+    Parameters:
+    -----------
+    name : str
+      'UNIFORM_COLOR' や 'SMOOTH_COLOR'
+    dimension : int
+      座標の次元 (Blender 4.0 より前のみ使用)
+    """
+    if bpy.app.version < (4, 0, 0):
+        name = f'{dimension}D_{name}'
+    key = ('shader', name)
+    shader = _gpu_cache.get(key)
+    if shader is None:
+        shader = _gpu_cache[key] = gpu.shader.from_builtin(name)
+    return shader
+
+################
+def get_cached_batch(key, shader, batch_type, content_fn):
+    """
+    バッチを作成してキャッシュする。GPU のリソースなので、描画中に呼ぶこと
+
+    Parameters:
+    -----------
+    key : hashable
+      キャッシュのキー
+    shader : gpu.types.GPUShader
+    batch_type : str
+      'LINES' や 'LINE_LOOP'
+    content_fn : function
+      バッチの内容の辞書を返す関数。キャッシュがない時だけ呼ばれる
+    """
+    key = ('batch', key, batch_type, id(shader))
+    batch = _gpu_cache.get(key)
+    if batch is None:
+        batch = _gpu_cache[key] = batch_for_shader(shader, batch_type, content_fn())
+    return batch
+
+################
+def get_unit_circle_batch(shader, dimension=3, segments=60):
+    """
+    原点を中心とする XY 平面上の半径 1 の円のバッチを得る
+    """
+    def content():
+        angles = np.linspace(0, 2*np.pi, segments, endpoint=False)
+        verts = np.zeros((segments, dimension), dtype=np.float32)
+        verts[:, 0] = np.cos(angles)
+        verts[:, 1] = np.sin(angles)
+        return {'pos': verts}
+    return get_cached_batch(('unit_circle', dimension, segments),
+                            shader, 'LINE_LOOP', content)
+
+################
+def get_unit_line_batch(shader, dimension=3):
+    """
+    (-1, 0) から (1, 0) への線分のバッチを得る
+    """
+    def content():
+        verts = np.zeros((2, dimension), dtype=np.float32)
+        verts[:, 0] = (-1, 1)
+        return {'pos': verts}
+    return get_cached_batch(('unit_line', dimension),
+                            shader, 'LINES', content)
+
 ################
 def draw_circle_2d(context, center, radius, color):
     # Compute the right direction vector
@@ -825,32 +1042,22 @@ def draw_circle_2d(context, center, radius, color):
     # Compute the radius in 2D
     radius_2D = abs(right_location_2D.x - center_location_2D.x) * radius
 
-    # Define circle vertices in 2D
-    angles = np.linspace(0, 2*np.pi, 60)
-    circle_verts_2D = np.stack([
-        radius_2D * np.cos(angles) + center_location_2D.x,
-        radius_2D * np.sin(angles) + center_location_2D.y], axis=-1)
-
     # Define the shader
-    if bpy.app.version < (4, 0, 0):
-        shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
-    else:
-        shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    shader = get_builtin_shader('UNIFORM_COLOR', dimension=2)
     shader.bind()
     shader.uniform_float('color', color)
 
-    # Create batch and draw the circle
-    cv2 = [Vector(v) for v in circle_verts_2D]
-    batch = batch_for_shader(shader, 'LINE_LOOP', {'pos': cv2})
-    batch.draw(shader)
-    
+    # Draw the unit circle scaled to the radius
+    batch = get_unit_circle_batch(shader, dimension=2)
+    with gpu.matrix.push_pop():
+        gpu.matrix.translate(center_location_2D)
+        gpu.matrix.scale((radius_2D, radius_2D))
+        batch.draw(shader)
+
 ################
 def draw_line_2d(context, point, direction, color):
     # Define the shader
-    if bpy.app.version < (4, 0, 0):
-        shader = gpu.shader.from_builtin('2D_UNIFORM_COLOR')
-    else:
-        shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    shader = get_builtin_shader('UNIFORM_COLOR', dimension=2)
     shader.bind()
     shader.uniform_float('color', color)
 
@@ -864,10 +1071,17 @@ def draw_line_2d(context, point, direction, color):
     dir = point2 - point1
     dir.normalize()
     size = max(context.region.width, context.region.height)
-    points = np.linspace(point1 - dir * size, point1 + dir * size, 10)
-    coords = [Vector(v) for v in points]
-    batch = batch_for_shader(shader, 'LINE_LOOP', {'pos': coords})
-    batch.draw(shader)
+
+    # Draw the unit line rotated and scaled along the edge
+    batch = get_unit_line_batch(shader, dimension=2)
+    with gpu.matrix.push_pop():
+        gpu.matrix.translate(point1)
+        gpu.matrix.multiply_matrix(Matrix(((dir.x, -dir.y, 0, 0),
+                                           (dir.y, dir.x, 0, 0),
+                                           (0, 0, 1, 0),
+                                           (0, 0, 0, 1))))
+        gpu.matrix.scale((size, size))
+        batch.draw(shader)
     
 ################
 def calculate_mouse_ray_plane_intersection(context,
@@ -1,11 +1,18 @@
 # -*- encoding:utf-8 -*-
 
 import bpy
+import sys
 import math
+import itertools
+import warnings
+from collections import deque
 from mathutils import (
     Vector,
     Matrix,
 )
+from mathutils.bvhtree import BVHTree
+from mathutils.kdtree import KDTree
+from bpy.app.handlers import persistent
 import numpy as np
 
 ################################################################
@@ -13,6 +20,82 @@ import numpy as np
 # Dr.レオさん作の関数を多次元に拡張したもの
 # https://programming-surgeon.com/script/sphere-fit/
 
+def pad_point_clouds(point_clouds):
+    """
+    長さの異なる点群を、マスク付きの (B, N, D) の配列にまとめる
+
+    Parameters:
+    -----------
+    point_clouds : list of np.ndarray
+      (N_i, D) の点群のリスト
+
+    Returns:
+    --------
+    np.ndarray, np.ndarray
+      (B, N, D) の点群と、(B, N) の有効な点のマスク
+    """
+    count = len(point_clouds)
+    length = max((len(pc) for pc in point_clouds), default=0)
+    dimension = point_clouds[0].shape[1] if count else 0
+    points = np.zeros((count, length, dimension))
+    mask = np.zeros((count, length), dtype=bool)
+    for ii, pc in enumerate(point_clouds):
+        points[ii, :len(pc)] = pc
+        mask[ii, :len(pc)] = True
+    return points, mask
+
+################
+def calcFitBatch(points, mask=None, max_condition=1e12):
+    """
+    複数の点群をまとめて球面近似する
+
+    Parameters:
+    -----------
+    points : np.ndarray
+      (B, N, D) の点群
+    mask : np.ndarray
+      (B, N) の有効な点のマスク。None なら全て有効
+    max_condition : float
+      これより条件数が大きい (点が退化している) 点群は NaN を返す
+
+    Returns:
+    --------
+    np.ndarray, np.ndarray
+      (B,) の半径と (B, D) の中心
+    """
+    points = np.asarray(points, dtype=np.float64)
+    batch, _, dimension = points.shape
+    if mask is None:
+        weights = np.ones(points.shape[:2])
+    else:
+        weights = np.asarray(mask, dtype=np.float64)
+    counts = weights.sum(axis=1)
+    inv_counts = 1 / np.maximum(counts, 1)
+
+    # 重心を原点に移してから計算し、桁落ちを防ぐ
+    mean = np.einsum('bn,bnd->bd', weights, points) * inv_counts[:, np.newaxis]
+    centered = (points - mean[:, np.newaxis]) * weights[..., np.newaxis]
+    sq = np.einsum('bnd,bnd->bn', centered, centered)
+
+    # 重心が原点なので、式②③ の v_1 の項は消える
+    A = 2 * np.einsum('bni,bnj->bij', centered, centered) * inv_counts[:, np.newaxis, np.newaxis]
+    b = np.einsum('bn,bnd->bd', sq, centered) * inv_counts[:, np.newaxis]
+
+    singular = counts <= dimension
+    if batch > 0:
+        singular |= ~(np.linalg.cond(A) < max_condition)
+    A[singular] = np.eye(dimension)
+    b[singular] = 0
+
+    centers = np.linalg.solve(A, b[..., np.newaxis])[..., 0] + mean
+    distances = np.linalg.norm(points - centers[:, np.newaxis], axis=2)
+    radii = np.einsum('bn,bn->b', weights, distances) * inv_counts
+
+    radii[singular] = np.nan
+    centers[singular] = np.nan
+    return radii, centers
+
+################
 def calcFit(point_cloud):
     """
     入力
@@ -21,41 +104,88 @@ def calcFit(point_cloud):
         radius : 近似球の半径 スカラー
         sphere_center : 球の中心座標  numpyのarray
     """
+    radii, centers = calcFitBatch(np.asarray(point_cloud)[np.newaxis])
+    if np.isnan(radii[0]):
+        raise np.linalg.LinAlgError('Singular matrix')
+    return radii[0], centers[0]
 
-    dimension = point_cloud.shape[1]
-    A_1 = np.zeros((dimension, dimension))
-
-    #Aのカッコの中の１項目用に変数A_1をおく
-    v_1 = np.zeros(dimension)
-    v_2 = 0.0
-    v_3 = np.zeros(dimension)
-    #ベクトルの１乗、２乗、３乗平均の変数をv_1, v_2, v_3とする
-    #１乗、３乗はベクトル、２乗はスカラーとなる
-
-    N = len(point_cloud)
-    #Nは点群の数
-
-    # シグマの計算
-    for v in point_cloud:
-        v_1 += v
-        v_2 += np.dot(v, v)
-        v_3 += np.dot(v, v) * v
-
-        A_1 += np.dot(np.array([v]).T, np.array([v]))
+################
+def calcFitRansacBatch(points, mask=None,
+                       num_hypotheses=64, tolerance=0.1, seed=0):
+    """
+    外れ値に強い RANSAC で、複数の点群をまとめて球面近似する。
+    全ての点群の全ての仮説を一度に評価し、最も多くの点を含む仮説の
+    インライアに最小二乗法で当てはめ直す。
 
-    v_1 /= N
-    v_2 /= N
-    v_3 /= N
-    A = 2 * (A_1 / N - np.dot(np.array([v_1]).T, np.array([v_1])))
-    # 式②
-    b = v_3 - v_2 * v_1
-    # 式③
-    sphere_center = np.dot(np.linalg.inv(A), b)
-    #　式①
-    radius = (sum(np.linalg.norm(np.array(point_cloud) - sphere_center, axis=1))
-              /len(point_cloud))
+    Parameters:
+    -----------
+    points : np.ndarray
+      (B, N, D) の点群
+    mask : np.ndarray
+      (B, N) の有効な点のマスク。None なら全て有効
+    num_hypotheses : int
+      点群ごとの仮説の数
+    tolerance : float
+      球面からの距離が、点群の大きさ (中央値からの距離の中央値) の
+      この割合以内の点をインライアとする
+    seed : int
+      乱数のシード
 
-    return(radius, sphere_center)
+    Returns:
+    --------
+    np.ndarray, np.ndarray, np.ndarray
+      (B,) の半径、(B, D) の中心、(B, N) のインライアのマスク
+    """
+    points = np.asarray(points, dtype=np.float64)
+    batch, length, dimension = points.shape
+    if batch == 0 or length == 0:
+        return (np.full(batch, np.nan), np.full((batch, dimension), np.nan),
+                np.zeros((batch, length), dtype=bool))
+    if mask is None:
+        mask = np.ones((batch, length), dtype=bool)
+    mask = np.asarray(mask, dtype=bool)
+    counts = mask.sum(axis=1)
+    sample_size = dimension + 1
+
+    # 有効な点を前に詰めたインデックスから、仮説ごとに点を選ぶ
+    rng = np.random.default_rng(seed)
+    order = np.argsort(~mask, axis=1, kind='stable')
+    picks = (rng.random((batch, num_hypotheses, sample_size)) *
+             counts[:, np.newaxis, np.newaxis]).astype(np.int64)
+    picks = np.minimum(picks, np.maximum(counts - 1, 0)[:, np.newaxis, np.newaxis])
+    picks = np.take_along_axis(order[:, np.newaxis, :],
+                               picks.reshape(batch, 1, -1), axis=2)
+    samples = points[np.arange(batch)[:, np.newaxis], picks.reshape(batch, -1)]
+    samples = samples.reshape(batch * num_hypotheses, sample_size, dimension)
+
+    # しきい値は、重心からの距離の中央値 (外れ値に影響されにくい大きさ) に比例させる
+    masked = np.where(mask[..., np.newaxis], points, np.nan)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        spread = np.linalg.norm(masked - np.nanmedian(masked, axis=1, keepdims=True), axis=2)
+        thresholds = tolerance * np.nan_to_num(np.nanmedian(spread, axis=1))
+
+    # 全ての仮説を当てはめ、全ての点との残差でまとめて評価する
+    radii, centers = calcFitBatch(samples)
+    radii = radii.reshape(batch, num_hypotheses)
+    centers = centers.reshape(batch, num_hypotheses, dimension)
+    distances = np.linalg.norm(points[:, np.newaxis] - centers[:, :, np.newaxis], axis=3)
+    residuals = np.abs(distances - radii[..., np.newaxis])
+    with np.errstate(invalid='ignore'):
+        inliers = (residuals <= thresholds[:, np.newaxis, np.newaxis]) & mask[:, np.newaxis]
+    scores = inliers.sum(axis=2)
+
+    # インライアが同数なら残差の小さい仮説を選ぶ
+    errors = np.where(inliers, residuals, 0).sum(axis=2)
+    best = np.lexsort((errors, -scores), axis=-1)[:, 0]
+    best_inliers = inliers[np.arange(batch), best]
+
+    # インライアが足りない点群は全ての点を使う
+    too_few = best_inliers.sum(axis=1) < sample_size
+    best_inliers[too_few] = mask[too_few]
+
+    radii, centers = calcFitBatch(points, best_inliers)
+    return radii, centers, best_inliers
 
 ################################################################
 def calcCircumcenter(verts):
@@ -241,6 +371,472 @@ def fit_centroid_of_polygon(verts):
 
     return center[:3]
 
+################################################################
+def fibonacci_sphere(num_samples):
+    """
+    単位球面上にほぼ均等に点を配置する
+
+    Parameters:
+    -----------
+    num_samples : int
+      点の数
+
+    Returns:
+    --------
+    np.ndarray
+      (num_samples, 3) の単位ベクトル
+    """
+    indices = np.arange(num_samples) + 0.5
+    zz = 1 - 2 * indices / num_samples
+    rr = np.sqrt(1 - zz * zz)
+    theta = math.pi * (3 - math.sqrt(5)) * indices
+    return np.stack((rr * np.cos(theta), rr * np.sin(theta), zz), axis=-1)
+
+################
+def select_covering_spheres(centers, radii,
+                            num_samples=64,
+                            tolerance=0.01,
+                            max_count=0,
+                            epsilon=1e-6):
+    """
+    球の集合から、全体の表面を覆う少数の球を貪欲法で選ぶ。
+    各球の表面にサンプル点を置き、覆われていない点を最も多く覆う球を
+    順に選んでいく (貪欲集合被覆)。
+
+    Parameters:
+    -----------
+    centers : np.ndarray
+      (M, 3) の球の中心
+    radii : np.ndarray
+      (M,) の球の半径
+    num_samples : int
+      球ひとつあたりのサンプル点の数
+    tolerance : float
+      覆われずに残ってもよいサンプル点の割合
+    max_count : int
+      選ぶ球の最大数。0 ならば無制限
+    epsilon : float
+      球に含まれるかどうかを判定する際の許容誤差 (半径に対する割合)
+
+    Returns:
+    --------
+    np.ndarray
+      選ばれた球のインデックス (昇順)
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    count = len(radii)
+    if count <= 1:
+        return np.arange(count)
+
+    # (M * K, 3) のサンプル点
+    samples = (centers[:, np.newaxis, :] +
+               radii[:, np.newaxis, np.newaxis] * fibonacci_sphere(num_samples)).reshape(-1, 3)
+
+    # covers[i, j] : 球 i がサンプル点 j を覆っているか
+    dists = np.linalg.norm(samples[np.newaxis, :, :] - centers[:, np.newaxis, :], axis=-1)
+    covers = dists <= (radii * (1 + epsilon))[:, np.newaxis]
+
+    uncovered = np.ones(samples.shape[0], dtype=bool)
+    allowed = tolerance * samples.shape[0]
+    selected = []
+    while np.count_nonzero(uncovered) > allowed:
+        if max_count > 0 and len(selected) >= max_count:
+            break
+        gains = np.count_nonzero(covers[:, uncovered], axis=1)
+        best = np.argmax(gains)
+        if gains[best] == 0:
+            break
+        selected.append(best)
+        uncovered &= ~covers[best]
+
+    return np.sort(np.array(selected, dtype=np.int64))
+
+################################################################
+# 空間ハッシュによる近傍探索
+
+################
+def find_pairs_within(points, queries, epsilon):
+    """
+    全ての座標の距離が epsilon 未満になる、点とクエリの組を探す。
+    最初の座標を大きさ epsilon のセルに分け、隣接する 3^D 個のセルだけを調べる。
+
+    Parameters:
+    -----------
+    points : np.ndarray
+      (N, G, D) の点。G 個の D 次元座標の組 (例えば骨の head と tail)
+    queries : np.ndarray
+      (M, G, D) のクエリ
+    epsilon : float
+      近いと見なす距離
+
+    Returns:
+    --------
+    np.ndarray, np.ndarray
+      クエリのインデックスと点のインデックス。(クエリ, 点) の順にソートされ、重複はない
+    """
+    points = np.asarray(points, dtype=np.float64)
+    queries = np.asarray(queries, dtype=np.float64)
+    empty = np.zeros(0, dtype=np.int64)
+    if epsilon <= 0 or len(points) == 0 or len(queries) == 0:
+        return empty, empty
+
+    dimension = points.shape[2]
+    point_cells = np.floor(points[:, 0] / epsilon).astype(np.int64)
+    query_cells = np.floor(queries[:, 0] / epsilon).astype(np.int64)
+
+    # セルの座標をハッシュ値にする。衝突しても候補が増えるだけで、後で距離を確かめる
+    primes = np.array([73856093, 19349663, 83492791, 2654435761, 40503, 1000003][:dimension],
+                      dtype=np.int64)
+    def cell_hash(cells):
+        with np.errstate(over='ignore'):
+            return (cells * primes).sum(axis=1)
+
+    point_keys = cell_hash(point_cells)
+    order = np.argsort(point_keys, kind='stable')
+    sorted_keys = point_keys[order]
+
+    all_qi = []
+    all_pi = []
+    for offset in itertools.product((-1, 0, 1), repeat=dimension):
+        query_keys = cell_hash(query_cells + np.array(offset, dtype=np.int64))
+        starts = np.searchsorted(sorted_keys, query_keys, side='left')
+        ends = np.searchsorted(sorted_keys, query_keys, side='right')
+
+        # セルに含まれる点を全て候補にする
+        counts = ends - starts
+        qi = np.repeat(np.arange(len(queries)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pi = order[np.repeat(starts, counts) + local]
+        all_qi.append(qi)
+        all_pi.append(pi)
+
+    # ハッシュが衝突すると同じ組が複数回見つかるので、距離を確かめて重複を除く
+    qi = np.concatenate(all_qi)
+    pi = np.concatenate(all_pi)
+    distances = np.linalg.norm(points[pi] - queries[qi], axis=2)
+    close = np.all(distances < epsilon, axis=1)
+    pairs = np.unique(np.stack((qi[close], pi[close]), axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+################
+def group_pairs(count, first, second):
+    """
+    組で繋がった要素をまとめ、各要素のグループの代表 (最小のインデックス) を得る
+
+    Parameters:
+    -----------
+    count : int
+      要素の数
+    first : np.ndarray
+      組の一方のインデックス
+    second : np.ndarray
+      組のもう一方のインデックス
+
+    Returns:
+    --------
+    np.ndarray
+      (count,) の各要素が属するグループの最小のインデックス
+    """
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    labels = np.arange(count)
+    while True:
+        # 組の小さい方のラベルを両方に伝え、ラベルのラベルを辿って短絡する
+        smaller = np.minimum(labels[first], labels[second])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, first, smaller)
+        np.minimum.at(new_labels, second, smaller)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+################
+def nearest_distances(points, targets):
+    """
+    points の各点から、最も近い targets の点までの距離を得る。
+    targets から KD 木を作るので、O((N+S) log S) の時間と O(N+S) のメモリで済む
+
+    Parameters:
+    -----------
+    points : np.ndarray
+      (N, 3) の点
+    targets : np.ndarray
+      (S, 3) の探索対象の点
+
+    Returns:
+    --------
+    np.ndarray, np.ndarray
+      最も近い点までの距離と、その点の targets のインデックス。
+      targets が空ならば距離は inf、インデックスは -1
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 3)
+    distances = np.full(len(points), np.inf)
+    indices = np.full(len(points), -1, dtype=np.int64)
+    if len(targets) == 0:
+        return distances, indices
+
+    kd = KDTree(len(targets))
+    for index, co in enumerate(targets.tolist()):
+        kd.insert(co, index)
+    kd.balance()
+
+    for ii, co in enumerate(points.tolist()):
+        _, index, distance = kd.find(co)
+        distances[ii] = distance
+        indices[ii] = index
+    return distances, indices
+
+################################################################
+# 頂点キャッシュの最適化
+
+################
+def compute_acmr(loop_vertices, face_sizes, cache_size=32):
+    """
+    FIFO の頂点キャッシュを想定した ACMR (三角形あたりの平均キャッシュミス数) を計算する
+
+    Parameters:
+    -----------
+    loop_vertices : np.ndarray
+      面の順に並べた、各面の頂点インデックス
+    face_sizes : np.ndarray
+      各面の頂点数
+    cache_size : int
+      キャッシュの大きさ
+
+    Returns:
+    --------
+    float
+      ACMR
+    """
+    num_triangles = int(np.sum(np.maximum(np.asarray(face_sizes) - 2, 0)))
+    if num_triangles == 0:
+        return 0.0
+
+    cache = deque()
+    cached = set()
+    misses = 0
+    for vtx in np.asarray(loop_vertices).tolist():
+        if vtx not in cached:
+            misses += 1
+            cache.append(vtx)
+            cached.add(vtx)
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+
+    return misses / num_triangles
+
+################
+def tipsify(loop_vertices, face_sizes, num_vertices, cache_size=32):
+    """
+    Tipsify (Sander et al. 2007) で、頂点キャッシュ効率の良い面の順序を計算する。
+    三角形以外の面もそのまま扱える。
+
+    Parameters:
+    -----------
+    loop_vertices : np.ndarray
+      面の順に並べた、各面の頂点インデックス
+    face_sizes : np.ndarray
+      各面の頂点数
+    num_vertices : int
+      頂点数
+    cache_size : int
+      キャッシュの大きさ
+
+    Returns:
+    --------
+    np.ndarray
+      新しい面の順序 (元の面のインデックスの配列)
+    """
+    loop_vertices = np.asarray(loop_vertices, dtype=np.int64)
+    face_sizes = np.asarray(face_sizes, dtype=np.int64)
+    num_faces = len(face_sizes)
+    if num_faces == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # 面 -> 頂点
+    face_starts = np.concatenate(([0], np.cumsum(face_sizes)))
+    face_verts = [loop_vertices[face_starts[ii]:face_starts[ii + 1]].tolist()
+                  for ii in range(num_faces)]
+
+    # 頂点 -> 面 (CSR)
+    loop_faces = np.repeat(np.arange(num_faces), face_sizes)
+    order = np.argsort(loop_vertices, kind='stable')
+    adjacency_faces = loop_faces[order].tolist()
+    counts = np.bincount(loop_vertices, minlength=num_vertices)
+    adjacency_starts = np.concatenate(([0], np.cumsum(counts))).tolist()
+
+    live = counts.tolist()                  # 未出力の隣接面の数
+    cache_time = [0] * num_vertices         # キャッシュに入った時刻
+    emitted = [False] * num_faces
+    dead_end = []
+    result = []
+
+    time_stamp = cache_size + 1
+    cursor = 0
+    fanning = int(loop_vertices[0])
+    while fanning >= 0:
+        candidates = []
+        for face in adjacency_faces[adjacency_starts[fanning]:adjacency_starts[fanning + 1]]:
+            if emitted[face]:
+                continue
+            emitted[face] = True
+            result.append(face)
+            for vtx in face_verts[face]:
+                dead_end.append(vtx)
+                candidates.append(vtx)
+                live[vtx] -= 1
+                if time_stamp - cache_time[vtx] > cache_size:
+                    cache_time[vtx] = time_stamp
+                    time_stamp += 1
+
+        # 次の扇の中心を選ぶ
+        fanning = -1
+        priority = -1
+        for vtx in candidates:
+            if live[vtx] > 0:
+                pp = 0
+                if time_stamp - cache_time[vtx] + 2 * live[vtx] <= cache_size:
+                    pp = time_stamp - cache_time[vtx]
+                if pp > priority:
+                    priority = pp
+                    fanning = vtx
+
+        if fanning < 0:
+            # 行き止まり
+            while dead_end:
+                vtx = dead_end.pop()
+                if live[vtx] > 0:
+                    fanning = vtx
+                    break
+            else:
+                while cursor < num_vertices:
+                    if live[cursor] > 0:
+                        fanning = cursor
+                        break
+                    cursor += 1
+
+    return np.array(result, dtype=np.int64)
+
+################################################################
+# 矩形のパッキング
+
+################
+def pack_rectangles_skyline(sizes, width):
+    """
+    スカイライン法 (bottom-left) で、幅 width の領域に矩形を詰め込む
+
+    Parameters:
+    -----------
+    sizes : np.ndarray
+      (N, 2) の矩形の幅と高さ (整数)
+    width : int
+      領域の幅
+
+    Returns:
+    --------
+    np.ndarray, int
+      (N, 2) の各矩形の左下の位置と、使用した高さ。
+      入りきらない矩形があれば None, 0
+    """
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    count = sizes.shape[0]
+    positions = np.zeros((count, 2), dtype=np.int64)
+    if count == 0:
+        return positions, 0
+    if np.any(sizes[:, 0] > width):
+        return None, 0
+
+    # 高さ、幅の大きい順に詰める
+    order = np.lexsort((-sizes[:, 0], -sizes[:, 1]))
+
+    # スカイラインの線分 [x, y, 幅]
+    skyline = [[0, 0, int(width)]]
+    for idx in order.tolist():
+        ww, hh = sizes[idx].tolist()
+
+        # 最も低く置ける位置を探す
+        best = None
+        for ii, (xx, _, _) in enumerate(skyline):
+            if xx + ww > width:
+                break
+            yy = 0
+            remaining = ww
+            jj = ii
+            while remaining > 0:
+                yy = max(yy, skyline[jj][1])
+                remaining -= skyline[jj][2]
+                jj += 1
+            if best is None or yy < best[0]:
+                best = (yy, xx, ii)
+
+        yy, xx, ii = best
+        positions[idx] = (xx, yy)
+
+        # スカイラインを更新する
+        skyline.insert(ii, [xx, yy + hh, ww])
+        end = xx + ww
+        jj = ii + 1
+        while jj < len(skyline) and skyline[jj][0] < end:
+            shrink = end - skyline[jj][0]
+            if skyline[jj][2] <= shrink:
+                skyline.pop(jj)
+            else:
+                skyline[jj][0] += shrink
+                skyline[jj][2] -= shrink
+                break
+
+        # 同じ高さの線分をまとめる
+        kk = 0
+        while kk < len(skyline) - 1:
+            if skyline[kk][1] == skyline[kk + 1][1]:
+                skyline[kk][2] += skyline[kk + 1][2]
+                skyline.pop(kk + 1)
+            else:
+                kk += 1
+
+    height = int(np.max(positions[:, 1] + sizes[:, 1]))
+    return positions, height
+
+################
+def pack_rectangles(sizes, max_size):
+    """
+    矩形を 2 のべき乗の大きさの領域に詰め込む。
+    面積が最小になる幅を選ぶ。
+
+    Parameters:
+    -----------
+    sizes : np.ndarray
+      (N, 2) の矩形の幅と高さ (整数)
+    max_size : int
+      領域の幅と高さの最大値
+
+    Returns:
+    --------
+    np.ndarray, int, int
+      (N, 2) の各矩形の左下の位置と、領域の幅と高さ。
+      入りきらなければ None, 0, 0
+    """
+    sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+    if sizes.shape[0] == 0:
+        return sizes.copy(), 0, 0
+    area = int(np.sum(sizes[:, 0] * sizes[:, 1]))
+    min_width = max(int(np.max(sizes[:, 0])), int(math.sqrt(area)) // 2, 1)
+
+    best = (None, 0, 0)
+    width = 1 << (min_width - 1).bit_length()
+    while width <= max_size:
+        positions, height = pack_rectangles_skyline(sizes, width)
+        if positions is not None:
+            height = 1 << (max(height, 1) - 1).bit_length()
+            if height <= max_size and\
+               (best[0] is None or width * height < best[1] * best[2]):
+                best = (positions, width, height)
+        width *= 2
+    return best
+
 ################
 def gaussian_window(window_size, std_dev):
     """ガウス分布を使用したウィンドウを生成します。
@@ -319,14 +915,16 @@ def convolve_tube(mesh, window_size, std_dev):
     return smooth_mesh
 
 ################
+# falloff 関数。val は 0 以上 1 以下の値またはその配列
+# rng は np.random.Generator (RANDOM のみ使用)
 def falloff_smooth(val, _=None):
     return 1 - 3 * val**2 + 2 * val**3
 
 def falloff_sphere(val, _=None):
-    return math.sqrt(1 - val**2)
+    return np.sqrt(1 - val**2)
 
 def falloff_root(val, _=None):
-    return math.sqrt(1 - val)
+    return np.sqrt(1 - val)
 
 def falloff_inverse_square(val, _=None):
     return 1 - val**2
@@ -338,10 +936,10 @@ def falloff_linear(val, _=None):
     return 1 - val
 
 def falloff_constant(val, _=None):
-    return 1
+    return np.ones_like(val, dtype=np.float64)
 
 def falloff_random(val, rng):
-    return (1 - val) * (1 - (2 * rng() - 1) * val)
+    return (1 - val) * (1 - (2 * rng.random(np.shape(val)) - 1) * val)
 
 falloff_funcs = {
     'SMOOTH'            : falloff_smooth,
@@ -354,6 +952,33 @@ falloff_funcs = {
     'RANDOM'            : falloff_random,
 }
 
+def compute_falloff(distances, radius, falloff_type='SMOOTH', seed=0):
+    """
+    距離の配列から falloff の係数の配列を得る
+
+    Parameters:
+    -----------
+    distances : np.ndarray
+      距離の配列
+    radius : float
+      影響範囲。これより遠いと係数は 0 になる
+    falloff_type : str
+      falloff_funcs のキー
+    seed : int
+      RANDOM の乱数の種。同じ値なら同じ結果になる
+
+    Returns:
+    --------
+    np.ndarray
+      係数の配列
+    """
+    values = np.asarray(distances, dtype=np.float64) / radius
+    inside = values <= 1
+    factors = np.zeros_like(values)
+    rng = np.random.default_rng(seed)
+    factors[inside] = falloff_funcs[falloff_type](values[inside], rng)
+    return factors
+
 def get_falloff_enum():
     return bpy.props.EnumProperty(
         name='Falloff Type',
@@ -430,6 +1055,149 @@ class ViewData():
             l_ray_origins = (l_locations_homo @ mtx)[:, :3]
         return l_ray_origins
 
+################
+class MeshRayCaster():
+    """
+    メッシュオブジェクトに対して、まとめてレイを飛ばすためのクラス。
+    評価済みメッシュから BVH ツリーを一度だけ作成し、使い回す。
+    座標は全てメッシュのローカル座標で扱う。
+    """
+    def __init__(self, obj, depsgraph=None):
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+        self.name = obj.name
+        self.bvh = BVHTree.FromObject(obj, depsgraph)
+
+    def ray_cast(self, origins, directions, distances=None, which_to_use=None,
+                 epsilon=1e-10):
+        """
+        まとめてレイを飛ばす
+
+        Parameters:
+        -----------
+        origins : np.ndarray
+          (N, 3) のレイの基点
+        directions : np.ndarray
+          (N, 3) のレイの向き。正規化されていなくても良い
+        distances : float or np.ndarray
+          レイの最大距離。None なら無制限
+        which_to_use : np.ndarray
+          どのレイを飛ばすかの bool の配列。None なら全て
+        epsilon : float
+          ゼロ除算を回避するための、十分に小さい数
+
+        Returns:
+        --------
+        np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray
+          当たったかどうか (N,)、当たった位置 (N, 3)、法線 (N, 3)、
+          ポリゴンのインデックス (N,)、距離 (N,)
+          当たらなかったレイの位置と法線は 0、インデックスは -1、距離は inf
+        """
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        count = origins.shape[0]
+        directions = directions / (np.linalg.norm(directions, axis=-1) + epsilon)[:, np.newaxis]
+        if distances is None:
+            distances = np.full(count, sys.float_info.max)
+        else:
+            distances = np.broadcast_to(np.asarray(distances, dtype=np.float64), (count,))
+        if which_to_use is None:
+            indices = range(count)
+        else:
+            indices = np.flatnonzero(np.broadcast_to(which_to_use, (count,))).tolist()
+
+        hits = np.zeros(count, dtype=bool)
+        locations = np.zeros((count, 3))
+        normals = np.zeros((count, 3))
+        faces = np.full(count, -1, dtype=np.int64)
+        dists = np.full(count, np.inf)
+
+        ray_cast = self.bvh.ray_cast
+        l_origins = origins.tolist()
+        l_directions = directions.tolist()
+        l_distances = distances.tolist()
+        for ii in indices:
+            location, normal, index, dist = ray_cast(l_origins[ii],
+                                                     l_directions[ii],
+                                                     l_distances[ii])
+            if location is not None:
+                hits[ii] = True
+                locations[ii] = location
+                normals[ii] = normal
+                faces[ii] = index
+                dists[ii] = dist
+
+        return hits, locations, normals, faces, dists
+
+# オブジェクトの session_uid -> MeshRayCaster
+_mesh_ray_casters = dict()
+
+################
+def get_mesh_ray_caster(obj, depsgraph=None):
+    """
+    obj に対する MeshRayCaster を取得する。
+    評価済みメッシュの形状が変わるまで、以前に作成したものを返す
+    (clearMeshRayCastersOnUpdate() を参照)。
+
+    Parameters:
+    -----------
+    obj : bpy.types.Object
+      メッシュオブジェクト
+    depsgraph : bpy.types.Depsgraph
+      None ならば現在のものを使う
+
+    Returns:
+    --------
+    MeshRayCaster
+      レイキャスタ
+    """
+    # 評価を済ませて、形状の変更をハンドラに通知させる
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    key = obj.session_uid
+    caster = _mesh_ray_casters.get(key)
+    if caster is None:
+        caster = MeshRayCaster(obj, depsgraph)
+        _mesh_ray_casters[key] = caster
+    return caster
+
+################
+def clear_mesh_ray_casters(obj=None):
+    """
+    キャッシュしている MeshRayCaster を破棄する
+
+    Parameters:
+    -----------
+    obj : bpy.types.Object
+      破棄するオブジェクト。None なら全て
+    """
+    if obj is None:
+        _mesh_ray_casters.clear()
+    else:
+        _mesh_ray_casters.pop(obj.session_uid, None)
+
+################
+# 評価済みメッシュの形状が変わったら、レイキャスタを破棄する
+@persistent
+def clearMeshRayCastersOnUpdate(scene, depsgraph):
+    if not _mesh_ray_casters:
+        return
+    for update in depsgraph.updates:
+        if update.is_updated_geometry and isinstance(update.id, bpy.types.Object):
+            clear_mesh_ray_casters(update.id.original)
+
+@persistent
+def clearMeshRayCasters(*args):
+    clear_mesh_ray_casters()
+
+_handlers = (
+    (bpy.app.handlers.depsgraph_update_post, clearMeshRayCastersOnUpdate),
+    (bpy.app.handlers.undo_post, clearMeshRayCasters),
+    (bpy.app.handlers.redo_post, clearMeshRayCasters),
+    (bpy.app.handlers.load_post, clearMeshRayCasters),
+)
+
 ################
 def project_onto_mesh(locations,
                       mesh,
@@ -482,17 +1250,11 @@ def project_onto_mesh(locations,
     l_directions_norm = np.linalg.norm(l_directions, axis=-1)
     l_directions /= (l_directions_norm + epsilon)[:, np.newaxis]
 
-    dt = np.dtype([('hit', bool),
-                   ('location', object),
-                   ('normal', object),
-                   ('index', int)])
-    zero = Vector()
-    hits = np.array([
-        mesh.ray_cast(orig, dir) if use else (False, zero, zero, -1)
-        for orig, dir, use in zip(l_ray_origins, l_directions, which_to_use)], dtype=dt)
+    caster = get_mesh_ray_caster(mesh)
+    hits, l_hit_locations, l_hit_normals, _, _ = caster.ray_cast(
+        l_ray_origins, l_directions, which_to_use=which_to_use)
 
     # Compute hit locations
-    l_hit_locations = np.array([np.array(l[:]) for l in hits['location']])
     dists = np.linalg.norm(l_hit_locations - l_ray_origins, axis=-1)
     dists = np.maximum(0, dists - mesh_thickness)
     l_new_locations = l_ray_origins + l_directions * dists[:, np.newaxis]
@@ -501,9 +1263,8 @@ def project_onto_mesh(locations,
     new_locations = (l_new_locations_homo @ mesh_to_world)[:, :3]
 
     # Compute if rays are hit on surface
-    hits_on_surface = hits['hit']
+    hits_on_surface = hits
     if backface_culling:
-        l_hit_normals = np.array([np.array(n[:]) for n in hits['normal']])
         dot_products = np.sum(l_hit_normals * l_directions, axis=-1)
         hits_on_surface = np.logical_and(hits_on_surface, dot_products < 0)
 
@@ -549,7 +1310,7 @@ def block_with_mesh(orig_locations,
 
     if next_locations.size == 0 or not np.any(which_to_use):
         # Do nothing
-        return False, locations
+        return False, next_locations
 
     # Compute local locations
     mtx = np.array(mesh.matrix_world.inverted()).T[:, :3]
@@ -564,22 +1325,15 @@ def block_with_mesh(orig_locations,
 
     l_orig_to_next = l_next_locations - l_orig_locations
 
-    dt = np.dtype([('hit', bool),
-                   ('location', object),
-                   ('normal', object),
-                   ('index', int)])
-    zero = Vector()
-    hits = np.array([
-        mesh.ray_cast(loc, dir) if use else (False, zero, zero, -1)
-        for loc, dir, use in zip(l_prev_locations, l_directions, which_to_use)], dtype=dt)
+    caster = get_mesh_ray_caster(mesh)
+    hits, locations, normals, _, _ = caster.ray_cast(
+        l_prev_locations, l_directions, which_to_use=which_to_use)
 
     # Compute hit location
-    locations = np.array([np.array(l[:]) for l in hits['location']])
-    normals = np.array([np.array(n[:]) for n in hits['normal']])
     dists = np.linalg.norm(locations - l_prev_locations, axis=-1)
     dists = np.minimum(dists - mesh_thickness, l_directions_norm)
     dot_products = np.sum(l_orig_to_next * l_directions, axis=-1)
-    hits_on_surface = np.logical_and(hits['hit'], dot_products > 0)
+    hits_on_surface = np.logical_and(hits, dot_products > 0)
     l_hit_locations = l_prev_locations + l_directions * dists[:, np.newaxis]
 
     # Compute world locations
@@ -764,3 +1518,14 @@ def closest_axis(vector):
     closest = axes[np.argmax(cosine_similarity)]
     
     return closest
+
+################################################################
+def registerClass():
+    for handlers, func in _handlers:
+        handlers.append(func)
+
+def unregisterClass():
+    for handlers, func in _handlers:
+        if func in handlers:
+            handlers.remove(func)
+    clear_mesh_ray_casters()